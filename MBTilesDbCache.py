@@ -4,9 +4,15 @@ from pathlib import Path
 from kivy.logger import Logger
 from kivy.clock import Clock
 from kivy.event import EventDispatcher
-from kivy.properties import StringProperty, ListProperty, NumericProperty, DictProperty, BooleanProperty
+from kivy.properties import StringProperty, ListProperty, NumericProperty, DictProperty, BooleanProperty, \
+    OptionProperty
 
-from mbtiles import DEFAULT_TILES_SUBDOMAINS, DEFAULT_TILE_FORMAT, DEFAULT_CACHE_DIR, MAX_DOWNLOAD_TIME, DEFAULT_TIMEOUT
+from mbtiles import DEFAULT_TILES_SUBDOMAINS, DEFAULT_TILE_FORMAT, DEFAULT_CACHE_DIR, MAX_DOWNLOAD_TIME, \
+    DEFAULT_RATE_LIMIT, DEFAULT_RATE_BURST, DEFAULT_WORKERS, DEFAULT_CACHE_BACKEND, DEFAULT_CACHE_QUOTA_MB, \
+    DEFAULT_CACHE_TTL, DEFAULT_CACHE_SHARED
+from mbtiles.coverage import load_geojson, load_route, corridor_polygons
+from mbtiles.exceptions import UpdateMismatchError
+from mbtiles.quota import CacheQuota
 from mbtiles.tiles_threaded import MBTilesBuilderThreaded
 from providers import BROWSER_USER_AGENT
 from tools.binding_manager import BindingManager
@@ -16,10 +22,14 @@ from tools.quadkey_url import QuadKeyUrl
 class MBTilesDbCache(EventDispatcher):
     url = StringProperty(None, allownone=True)
     bbox = ListProperty(None, allownone=True)
+    polygons = ListProperty([])  # replaces bbox when set, see load_geojson
     zoom_from = NumericProperty(None, allownone=True)
     zoom_to = NumericProperty( None, allownone=True)
     subdomains = ListProperty(DEFAULT_TILES_SUBDOMAINS)
-    tile_timeout = NumericProperty(DEFAULT_TIMEOUT)
+    rate_limit = NumericProperty(DEFAULT_RATE_LIMIT)
+    rate_burst = NumericProperty(DEFAULT_RATE_BURST)
+    workers = NumericProperty(DEFAULT_WORKERS)
+    async_download = BooleanProperty(False)
     filepath = StringProperty(None, allownone=True)
     attribution = StringProperty(None, allownone=True)
     use_attribution = BooleanProperty(False)
@@ -28,6 +38,11 @@ class MBTilesDbCache(EventDispatcher):
 
     cache = BooleanProperty(True)
     cache_dir = StringProperty(DEFAULT_CACHE_DIR)
+    cache_backend = OptionProperty(DEFAULT_CACHE_BACKEND, options=['disk', 'sqlite', 'dedup'])
+    cache_quota_mb = NumericProperty(DEFAULT_CACHE_QUOTA_MB)
+    cache_ttl = NumericProperty(DEFAULT_CACHE_TTL)
+    cache_shared = BooleanProperty(DEFAULT_CACHE_SHARED)
+    mbtiles_sources = ListProperty([])
     valid = BooleanProperty(False)
     downloading = BooleanProperty(False)
     progress = ListProperty([0,0])
@@ -35,12 +50,20 @@ class MBTilesDbCache(EventDispatcher):
     approximate_size_max_sample_count = NumericProperty(20)
     time_to_download = NumericProperty(MAX_DOWNLOAD_TIME)
     time_to_download_averaging_period_s = NumericProperty(3)
+    missing_tiles = NumericProperty(0)
     __events__ = ['on_success', 'on_error', 'on_connection_lost', 'on_finish']
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._bindings = BindingManager()
         self._builder = self._create_builder()
+        self._cache_quota = CacheQuota(self.cache_dir, self.cache_quota_mb * 1024 * 1024)
+        self.bind(
+            cache=self._update_cache_quota,
+            cache_dir=self._update_cache_quota,
+            cache_quota_mb=self._update_cache_quota,
+        )
+        self._update_cache_quota()
 
         self._trigger_update_time_to_download = Clock.create_trigger(
             self._update_time_to_download,
@@ -55,6 +78,7 @@ class MBTilesDbCache(EventDispatcher):
         self.bind(
             url=self._trigger_handle_input_change,
             bbox=self._trigger_handle_input_change,
+            polygons=self._trigger_handle_input_change,
             zoom_from=self._trigger_handle_input_change,
             zoom_to=self._trigger_handle_input_change,
             subdomains=self._trigger_handle_input_change,
@@ -64,6 +88,7 @@ class MBTilesDbCache(EventDispatcher):
         self.bind(
             url=self._trigger_update_valid,
             bbox=self._trigger_update_valid,
+            polygons=self._trigger_update_valid,
             zoom_from=self._trigger_update_valid,
             zoom_to=self._trigger_update_valid,
             filepath=self._trigger_update_valid,
@@ -83,7 +108,13 @@ class MBTilesDbCache(EventDispatcher):
                     or builder.tiles_subdomains != self.subdomains
                     or builder.tiles_headers != self.headers
                     or builder.tile_format != self.tile_format
-                    or builder.timeout != self.tile_timeout))):
+                    or builder.rate_limit != self.rate_limit
+                    or builder.rate_burst != self.rate_burst
+                    or builder.workers != self.workers
+                    or builder.async_download != self.async_download
+                    or builder.cache_backend != self.cache_backend
+                    or builder.cache.shared != self.cache_shared
+                    or builder.mbtiles_sources != self.mbtiles_sources))):
             self._builder = self._create_builder()
         return self._builder
 
@@ -91,11 +122,18 @@ class MBTilesDbCache(EventDispatcher):
         self._bindings.unbind_items()
         builder = MBTilesBuilderThreaded(
             cache=self.cache,
+            cache_backend=self.cache_backend,
+            cache_ttl=self.cache_ttl,
+            cache_shared=self.cache_shared,
+            mbtiles_sources=list(self.mbtiles_sources),
             tiles_dir=self.cache_dir,
             tiles_headers=self.headers,
             tiles_url=QuadKeyUrl.from_url(self.url),
             tiles_subdomains=self.subdomains,
-            timeout=self.tile_timeout,
+            rate_limit=self.rate_limit,
+            rate_burst=self.rate_burst,
+            workers=self.workers,
+            async_download=self.async_download,
             tile_format=self.tile_format,
             filepath=self.filepath,
             attribution=self.attribution,
@@ -111,15 +149,47 @@ class MBTilesDbCache(EventDispatcher):
         self._bindings.bind_item(self, 'attribution', lambda i,v: setattr(builder, 'attribution', v))
         self._bindings.bind_item(self, 'headers', lambda i,v: setattr(builder, 'tiles_headers', v))
         self._bindings.bind_item(self, 'tile_format', lambda i,v: setattr(builder, 'tile_format', v))
+        self._bindings.bind_item(self, 'cache_ttl', lambda i,v: setattr(builder, 'cache_ttl', v))
         self._bindings.bind_item(self, 'bbox', lambda i,v: trigger_update_coverage())
+        self._bindings.bind_item(self, 'polygons', lambda i,v: trigger_update_coverage())
         self._bindings.bind_item(self, 'zoom_from', lambda i,v: trigger_update_coverage())
         self._bindings.bind_item(self, 'zoom_to', lambda i,v: trigger_update_coverage())
         self._update_coverage(builder)
         return builder
 
+    @property
+    def error(self):
+        """
+        Reason of the last download failure to show to the user, empty if unknown
+        """
+        error = self._builder.error if self._builder else None
+        return str(error) if isinstance(error, UpdateMismatchError) else ''
+
+    @property
+    def has_coverage(self):
+        return (self.bbox is not None or bool(self.polygons)) and None not in (self.zoom_from, self.zoom_to)
+
+    def load_geojson(self, path):
+        """
+        Cover the polygons of the GeoJSON file at `path` instead of the bounding box
+        """
+        self.polygons = load_geojson(path)
+
+    def load_route(self, path, buffer_km):
+        """
+        Cover the corridor of `buffer_km` along the route of the GPX or GeoJSON file
+        at `path` instead of the bounding box
+        """
+        self.polygons = corridor_polygons(load_route(path), buffer_km)
+
     def _update_coverage(self, builder):
-        if None in (self.bbox, self.zoom_from, self.zoom_to):
+        if not self.has_coverage:
             builder.clear_coverage()
+        elif self.polygons:
+            builder.set_polygon_coverage(
+                polygons=list(self.polygons),
+                zoomlevels=list(range(self.zoom_from, self.zoom_to + 1))
+            )
         else:
             builder.set_coverage(
                 bbox=(self.bbox[1], self.bbox[0], self.bbox[3], self.bbox[2]),
@@ -136,17 +206,20 @@ class MBTilesDbCache(EventDispatcher):
             self._trigger_update_time_to_download()
 
     def _update_approximate_size(self, *_):
-        if not None in (self.bbox, self.zoom_from, self.zoom_to) and self.url:
+        if self.has_coverage and self.url:
             self.builder.get_approximate_size_mb_full(
                 max_sample_count=self.approximate_size_max_sample_count,
                 setter_cb=lambda size: setattr(self, 'approximate_size_mb', round(size, 2))
             )
+            self.builder.count_cached_tiles_full(
+                setter_cb=lambda cached: self._trigger_update_time_to_download()
+            )
 
     def _update_time_to_download(self, *_):
         self.time_to_download = self.builder.calculate_average_download_time(reset=True)
 
     def _update_valid(self, *_):
-        if None in (self.bbox, self.zoom_from, self.zoom_to, self.filepath) or not self.url:
+        if not self.has_coverage or self.filepath is None or not self.url:
             self.valid = False
             return
         if not Path(self.filepath).parent.exists():
@@ -154,12 +227,12 @@ class MBTilesDbCache(EventDispatcher):
             return
         self.valid = True
 
-    def download(self, rewrite = False):
+    def download(self, rewrite = False, update = False):
         if self.valid:
             Logger.info('Download started')
             self.downloading = True
             self._progress_cb(0, 0)
-            self.builder.run(rewrite)
+            self.builder.run(rewrite, update)
         else:
             Logger.info('Download skipped')
             self.dispatch('on_finish')
@@ -171,7 +244,7 @@ class MBTilesDbCache(EventDispatcher):
             self._trigger_update_approximate_size()
 
     def on_success(self, *_):
-        pass
+        self.missing_tiles = len(self.builder.missing_tiles)
 
     def on_error(self, *_):
         pass
@@ -201,6 +274,21 @@ class MBTilesDbCache(EventDispatcher):
     def on_time_to_download(self, *_):
         Logger.info(f'Time to download: {self.time_to_download}')
 
+    def _update_cache_quota(self, *_):
+        self._cache_quota.folder = self.cache_dir
+        self._cache_quota.max_bytes = self.cache_quota_mb * 1024 * 1024
+        if self.cache and self.cache_quota_mb:
+            self._cache_quota.start()
+        else:
+            self._cache_quota.stop()
+
+    def close_cache(self):
+        """
+        Stop evicting old tiles from the cache, it is kept for the next session
+        """
+        self._cache_quota.stop()
+
     def clear_cache(self):
+        self._cache_quota.stop()
         if self.cache and Path(self.cache_dir).is_dir():
             shutil.rmtree(self.cache_dir)
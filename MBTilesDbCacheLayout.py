@@ -22,7 +22,8 @@ from TextInputRangedTitledLayout import TextInputRangedTitledLayout
 from consts import DEFAULT_MIN_ZOOM, DEFAULT_MAX_ZOOM, DEFAULT_MAPS_DIRECTORY, CUSTOM_PROVIDER_KEY, FONT_SIZE_MEDIUM, \
     DROPDOWN_DOWN_PNG, DROPDOWN_UP_PNG, FOLDER_PNG, HEADER_BACKGROUND, HEADER_TEXT_COLOR, \
     DEFAULT_MAP_BASENAME
-from mbtiles import DEFAULT_TILES_SUBDOMAINS, DEFAULT_TILE_FORMAT, MAX_DOWNLOAD_TIME, DEFAULT_TIMEOUT
+from mbtiles import DEFAULT_TILES_SUBDOMAINS, DEFAULT_TILE_FORMAT, MAX_DOWNLOAD_TIME, DEFAULT_RATE_LIMIT, \
+    DEFAULT_RATE_BURST, DEFAULT_CACHE_TTL
 from providers import PROVIDERS, BROWSER_USER_AGENT, DEFAULT_PROVIDER
 from tools.utils import format_seconds
 from uix import (
@@ -40,7 +41,9 @@ class MBTilesDbCacheLayout(ColoredLayout, FloatLayout):
     subdomains = ListProperty()
     headers = DictProperty({"User-Agent": BROWSER_USER_AGENT})
     tile_format = StringProperty(DEFAULT_TILE_FORMAT)
-    tile_timeout = NumericProperty(DEFAULT_TIMEOUT)
+    rate_limit = NumericProperty(DEFAULT_RATE_LIMIT)
+    rate_burst = NumericProperty(DEFAULT_RATE_BURST)
+    cache_ttl = NumericProperty(DEFAULT_CACHE_TTL)
     side = NumericProperty(defaultvalue=13, allownone=True)
     min_side = NumericProperty(1)
     max_side = NumericProperty(25)
@@ -94,7 +97,9 @@ class MBTilesDbCacheLayout(ColoredLayout, FloatLayout):
             self.attribution = ''
             self.tile_format = type(self).tile_format.defaultvalue
             self.headers = type(self).headers.defaultvalue
-            self.tile_timeout = 0
+            self.rate_limit = 0
+            self.rate_burst = type(self).rate_burst.defaultvalue
+            self.cache_ttl = type(self).cache_ttl.defaultvalue
         else:
             provider_data = PROVIDERS[self.provider]
             self.min_zoom = provider_data.min_zoom
@@ -104,7 +109,9 @@ class MBTilesDbCacheLayout(ColoredLayout, FloatLayout):
             self.attribution = provider_data.attribution
             self.tile_format = provider_data.format
             self.headers = {"User-Agent": provider_data.user_agent}
-            self.tile_timeout = provider_data.timeout
+            self.rate_limit = provider_data.rate_limit
+            self.rate_burst = provider_data.rate_burst
+            self.cache_ttl = provider_data.cache_ttl
 
     def _update_filepath(self, *_):
         if self.directory and self.file_basename:
@@ -126,7 +133,10 @@ class MBTilesDbCacheLayout(ColoredLayout, FloatLayout):
             use_attribution=self.use_attribution,
             tile_format=self.tile_format,
             headers=self.headers,
-            tile_timeout=self.tile_timeout,
+            rate_limit=self.rate_limit,
+            rate_burst=self.rate_burst,
+            cache_ttl=self.cache_ttl,
+            mbtiles_sources=[self.directory],
         )
         self.bind(
             provider_url=downloader.setter('url'),
@@ -138,7 +148,10 @@ class MBTilesDbCacheLayout(ColoredLayout, FloatLayout):
             attribution=downloader.setter('attribution'),
             tile_format=downloader.setter('tile_format'),
             headers=downloader.setter('headers'),
-            tile_timeout=downloader.setter('tile_timeout'),
+            rate_limit=downloader.setter('rate_limit'),
+            rate_burst=downloader.setter('rate_burst'),
+            cache_ttl=downloader.setter('cache_ttl'),
+            directory=lambda i, v: setattr(downloader, 'mbtiles_sources', [v]),
         )
         downloader.bind(
             downloading=self.setter('downloading'),
@@ -151,10 +164,14 @@ class MBTilesDbCacheLayout(ColoredLayout, FloatLayout):
 
     def show_exception_popup(self, *_):
         self.info_popup.text = f'Map downloading failed.'
+        if self.downloader.error:
+            self.info_popup.text += f'\n{self.downloader.error}'
         self.info_popup.open()
 
     def show_success_popup(self, *_):
         self.info_popup.text = f'Map downloading finished successfully.'
+        if self.downloader.missing_tiles:
+            self.info_popup.text += f'\n{self.downloader.missing_tiles} tiles are not available from the provider and were skipped.'
         self.info_popup.open()
 
     def download_with_validation(self, *_):
@@ -167,9 +184,9 @@ class MBTilesDbCacheLayout(ColoredLayout, FloatLayout):
             return
         self.download()
 
-    def download(self, rewrite=False):
+    def download(self, rewrite=False, update=False):
         self.progress = [0,0]
-        self.downloader.download(rewrite=rewrite)
+        self.downloader.download(rewrite=rewrite, update=update)
 
     def download_copy(self):
         if self.filepath:
@@ -203,10 +220,12 @@ class MBTilesDbCacheLayout(ColoredLayout, FloatLayout):
         self.info_popup = InfoPopup(size_hint=(0.5, 0.5))
         self.file_exists_popup = FileExistsPopup(
             size_hint=(0.5, 0.5),
-            text='The specified file already exists. Do you want to overwrite it or save copy?',
+            text='The specified file already exists. Do you want to overwrite it, add missing tiles to it '
+                 'or save copy?',
         )
         self.file_exists_popup.bind(
             on_overwrite=lambda *_: Clock.schedule_once(lambda *_: self.download(True), 0.5),
+            on_update=lambda *_: Clock.schedule_once(lambda *_: self.download(update=True), 0.5),
             on_copy=lambda *_: Clock.schedule_once(lambda *_: self.download_copy(), 0.5),
         )
 
@@ -12,6 +12,7 @@ from kivy.properties import ListProperty
 
 from MBTilesDbCacheLayout import MBTilesDbCacheLayout
 from consts import DEFAULT_MAPS_DIRECTORY
+from mbtiles import DEFAULT_CACHE_QUOTA_MB, DEFAULT_CACHE_SHARED
 
 
 class MBTilesDbCacheApp(App):
@@ -21,15 +22,24 @@ class MBTilesDbCacheApp(App):
     def build_config(self, config):
         config.adddefaultsection('input')
         config.setdefault('input', 'touch_filter', 'mouse')
+        config.adddefaultsection('cache')
+        config.setdefault('cache', 'clear_on_exit', 0)
+        config.setdefault('cache', 'quota_mb', DEFAULT_CACHE_QUOTA_MB)
+        config.setdefault('cache', 'shared', int(DEFAULT_CACHE_SHARED))
 
     def on_stop(self):
-        self.main_layout.downloader.clear_cache()
+        if self.config.getboolean('cache', 'clear_on_exit'):
+            self.main_layout.downloader.clear_cache()
+        else:
+            self.main_layout.downloader.close_cache()
 
     def build(self):
         self._update_touch_filter()
         self.main_layout = MBTilesDbCacheLayout(
             directory=os.getenv('MAP_DIR', DEFAULT_MAPS_DIRECTORY)
         )
+        self.main_layout.downloader.cache_quota_mb = self.config.getfloat('cache', 'quota_mb')
+        self.main_layout.downloader.cache_shared = self.config.getboolean('cache', 'shared')
         return self.main_layout
 
     def _update_touch_filter(self):
@@ -20,11 +20,55 @@ DEFAULT_TILE_FORMAT = 'image/png'
 DEFAULT_TILE_SCHEME = 'wmts'
 """ Number of retries for remove tiles downloading """
 DEFAULT_DOWNLOAD_RETRIES = 10
-""" Timeout between tiles downloading requests """
-DEFAULT_TIMEOUT = 0.25
+""" Max average number of tiles downloading requests per s to one provider """
+DEFAULT_RATE_LIMIT = 4
+""" Number of tiles downloading requests allowed at once after idle time """
+DEFAULT_RATE_BURST = 8
+""" Number of retries of a tile the provider keeps answering with a throttling status, before failing """
+DEFAULT_THROTTLE_RETRIES = 10
 """ Timeout between tiles downloading attempt if no connection """
 DEFAULT_CONNECTION_MAX_TIMEOUT = 15
+""" Number of tiles downloaded in parallel by threaded builder """
+DEFAULT_WORKERS = 8
+""" Max number of keep-alive connections per tiles host """
+DEFAULT_POOL_MAXSIZE = 16
+""" Time in s after which unused tiles host connections are closed """
+DEFAULT_POOL_IDLE_TIMEOUT = 60
+""" Max number of requests in flight for asynchronous downloading """
+DEFAULT_ASYNC_CONCURRENCY = 512
+""" Max number of requests in flight per tiles host for asynchronous downloading """
+DEFAULT_ASYNC_HOST_CONCURRENCY = 64
+""" Timeout of a single tile request in s """
+DEFAULT_REQUEST_TIMEOUT = 30
+""" Order of the zoom levels tiles are gathered in: 'asc' (overview first) or 'desc' """
+DEFAULT_TILES_ORDER = 'asc'
+""" Number of tiles inserted into MBTiles file per transaction """
+DEFAULT_WRITER_BATCH_SIZE = 500
+""" Max number of downloaded tiles waiting to be inserted into MBTiles file """
+DEFAULT_WRITER_QUEUE_SIZE = 256
 DEFAULT_CACHE_DIR = 'cached_tiles'
+""" Tiles cache storage: 'disk' (file per tile), 'sqlite' (database per provider)
+or 'dedup' (file per distinct tile content) """
+DEFAULT_CACHE_BACKEND = 'disk'
+""" Memory budget of the tiles cache kept in front of the cache backend (MB), 0 to disable """
+DEFAULT_MEMORY_CACHE_MB = 16
+""" Time after which a cached tile is revalidated with the provider (s), 0 to use cached tiles forever """
+DEFAULT_CACHE_TTL = 30 * 24 * 3600
+""" Number of fetch times of cached tiles without metadata saved per transaction """
+DEFAULT_META_BACKFILL_BATCH_SIZE = 500
+""" Max time a process waits for another one fetching the same tile into a shared cache (s) """
+DEFAULT_CACHE_LOCK_TIMEOUT = 60
+""" HTTP status codes meaning the provider has no tile at the requested position """
+DEFAULT_MISSING_STATUS_CODES = (204, 404, 410)
+""" Time during which a tile found missing is not requested again (s), 0 to always request it """
+DEFAULT_MISSING_TTL = 7 * 24 * 3600
+""" The tiles cache folder is used by several processes at the same time (e.g. on a network share),
+tiles are locked with files while they are fetched """
+DEFAULT_CACHE_SHARED = False
+""" Size quota of the tiles cache folder (MB), least recently used tiles are evicted beyond it, 0 for no limit """
+DEFAULT_CACHE_QUOTA_MB = 2048
+""" Time between two checks of the tiles cache size (s) """
+DEFAULT_CACHE_QUOTA_INTERVAL = 60
 MAX_DOWNLOAD_TIME = 2678400  # 31 days in s
 
 
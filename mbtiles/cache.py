@@ -1,13 +1,173 @@
 import os
 import re
 import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 from gettext import gettext as _
 
+from . import DEFAULT_CACHE_LOCK_TIMEOUT
+from .mbutil import tile_hash
 from .utils import flip_y
 from kivy.logger import Logger
 
+""" Time between two saves of the last use times of tiles read from a cache database (s) """
+USE_FLUSH_INTERVAL = 10
+""" The use time of a tile file read from a Disk cache is updated at most this often (s), see quota.MIN_AGE """
+TOUCH_INTERVAL = 60
+
+_written_lock = threading.Lock()
+_written = {}  # cache root folder -> bytes of tiles saved since the last `take_written`
+
+
+def _record_written(folder, size):
+    key = os.path.normcase(os.path.abspath(folder))
+    with _written_lock:
+        _written[key] = _written.get(key, 0) + size
+
+
+def take_written(folder):
+    """
+    Return the bytes of tiles saved by this process to the caches under `folder`
+    since the previous call, overwritten tiles included
+    """
+    with _written_lock:
+        return _written.pop(os.path.normcase(os.path.abspath(folder)), 0)
+
+
+def _create_meta_table(con):
+    con.execute("""CREATE TABLE IF NOT EXISTS meta (
+        zoom_level integer, tile_column integer, tile_row integer,
+        fetched real, etag text, last_modified text,
+        PRIMARY KEY (zoom_level, tile_column, tile_row))""")
+    con.execute("""CREATE TABLE IF NOT EXISTS missing (
+        zoom_level integer, tile_column integer, tile_row integer,
+        fetched real, status_code integer,
+        PRIMARY KEY (zoom_level, tile_column, tile_row))""")
+
+
+def _add_column(con, table, column, column_type):
+    """
+    Add `column` to `table` of a database created before the column existed
+    """
+    if column in [row[1] for row in con.execute("PRAGMA table_info(%s)" % table)]:
+        return
+    try:
+        con.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, column_type))
+    except sqlite3.OperationalError:
+        pass  # added meanwhile by another process
+
+
+def _write_atomic(path, body):
+    """
+    Write `body` to `path` through a temporary file renamed over it, so that
+    readers (threads or other processes) never see a partially written file
+    """
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    try:
+        for attempt in range(2):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(body)
+                break
+            except FileNotFoundError:
+                if attempt:
+                    raise
+                # the empty folder was removed meanwhile by the cache eviction
+        os.replace(tmp_path, path)
+    except OSError:
+        # e.g. the file is being read by another process on Windows, it keeps the copy written first
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        if not os.path.exists(path):
+            raise
+
+
+class FileLock(object):
+    """
+    Lock shared between processes, held by the process that created the lock file
+    """
+    def __init__(self, path, timeout=None):
+        """
+        path -- the lock file
+        timeout -- max time to wait for the lock in s, a lock file older than it is considered
+                   left by a dead process (default DEFAULT_CACHE_LOCK_TIMEOUT)
+        """
+        self.path = path
+        if timeout is None:
+            timeout = DEFAULT_CACHE_LOCK_TIMEOUT
+        self.timeout = timeout
+        self.locked = False
+
+    def acquire(self):
+        """
+        Wait for the lock, return False if it could not be acquired within `timeout`
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                self.locked = True
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.stat(self.path).st_mtime > self.timeout:
+                        Logger.warning(_("Break stale lock %s") % self.path)
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    continue  # released meanwhile
+            except FileNotFoundError:
+                continue  # lock folder removed meanwhile
+            if time.monotonic() > deadline:
+                Logger.warning(_("Timeout waiting for lock %s") % self.path)
+                return False
+            time.sleep(0.05)
+
+    def release(self):
+        if self.locked:
+            self.locked = False
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _subdirs(folder):
+    """ Yield the entries of `folder` subfolders named by a number (zoom levels, columns) """
+    for entry in _subdirs_all(folder):
+        if entry.name.isdigit():
+            yield entry
+
+
+def _subdirs_all(folder):
+    """ Yield the entries of `folder` subfolders """
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir():
+            yield entry
+
 
 class Cache(object):
+    shared = False  # used by several processes at the same time, see `lock`
+
     def __init__(self, **kwargs):
         self.extension = kwargs.get('extension', '.png')
         self._scheme = 'tms'
@@ -26,9 +186,84 @@ class Cache(object):
     def read(self, z_x_y):
         raise NotImplementedError
 
+    def exists(self, z_x_y):
+        return self.read(z_x_y) is not None
+
+    def contains_many(self, tiles):
+        """
+        Return the set of (z, x, y) of `tiles` found in the cache
+        """
+        return {tuple(z_x_y) for z_x_y in tiles if self.exists(z_x_y)}
+
+    def count_cached(self, tiles):
+        """
+        Return the number of `tiles` found in the cache
+        """
+        return len(self.contains_many(tiles))
+
+    def count_cached_tileset(self, tileset):
+        """
+        Return the number of cached tiles within `tileset`, a `TileSet`
+        """
+        return self.count_cached(tileset)
+
     def save(self, body, z_x_y):
         raise NotImplementedError
 
+    def read_meta(self, z_x_y):
+        """
+        Return the freshness metadata of a cached tile: a dict of its `fetched` time
+        and HTTP validators (`etag`, `last_modified`), None if unknown
+        """
+        return None
+
+    def save_meta(self, z_x_y, meta):
+        pass
+
+    def save_meta_many(self, metas):
+        """
+        Save the freshness metadata of many tiles, `metas` a dict (z, x, y) -> meta
+        """
+        for z_x_y, meta in metas.items():
+            self.save_meta(z_x_y, meta)
+
+    def read_missing(self, z_x_y):
+        """
+        Return the (fetch time, status code) of a tile known to be missing at the provider,
+        None if unknown
+        """
+        return None
+
+    def save_missing(self, z_x_y, status_code):
+        """
+        Record that the provider answered `status_code` instead of the tile
+        """
+        pass
+
+    @contextmanager
+    def lock(self, z_x_y):
+        """
+        Hold the tile while it is fetched, so that only one of the processes
+        sharing the cache downloads it
+        """
+        yield
+
+    def usage(self):
+        """
+        Yield (last use time, size in bytes, key) of the entries the cache can evict,
+        see `CacheQuota`. Databases, their sidecar files and lock files are not entries.
+        """
+        return iter(())
+
+    def evict(self, keys):
+        """
+        Remove the entries of `keys`, as yielded by `usage`
+        """
+        pass
+
+    def close(self):
+        pass
+
     def remove(self, z_x_y):
         raise NotImplementedError
 
@@ -40,6 +275,15 @@ class Dummy(Cache):
     def read(self, z_x_y):
         return None
 
+    def exists(self, z_x_y):
+        return False
+
+    def contains_many(self, tiles):
+        return set()
+
+    def count_cached_tileset(self, tileset):
+        return 0
+
     def save(self, body, z_x_y):
         pass
 
@@ -52,7 +296,18 @@ class Dummy(Cache):
 
 class Disk(Cache):
     def __init__(self, basename, folder, **kwargs):
+        """
+        Stores each tile as a file `folder/<basename>/z/x/y<extension>`.
+
+        shared -- lock the tiles being fetched with lock files, for a folder
+                  shared by several processes (default False)
+        """
         super(Disk, self).__init__(**kwargs)
+        self.shared = kwargs.get('shared', False)
+        self._index = None  # zoom -> set of x << zoom | y of cached tiles, built on first use
+        self._index_lock = threading.Lock()
+        self._meta_con = None
+        self._meta_lock = threading.Lock()
         self._basename = None
         self._basefolder = folder
         self.folder = folder
@@ -67,11 +322,208 @@ class Disk(Cache):
         self._basename = basename
         subfolder = re.sub(r'[^a-z^A-Z^0-9^_]+', '', basename.replace("/","_").lower())
         self.folder = os.path.join(self._basefolder, subfolder)
+        self._index = None
+        self._close_meta()
 
     @Cache.scheme.setter
     def scheme(self, scheme):
         assert scheme in ('wmts', 'xyz', 'tms'), "Unknown scheme %s" % scheme
         self._scheme = 'xyz' if (scheme == 'wmts') else scheme
+        self._index = None
+
+    def _tile_entries(self):
+        """
+        Yield the (z, x, y) and `os.DirEntry` of all tile files, reading the folder tree once.
+        Files of any extension are yielded if `extension` is None.
+        """
+        for z_entry in _subdirs(self.folder):
+            z = int(z_entry.name)
+            for x_entry in _subdirs(z_entry.path):
+                x = int(x_entry.name)
+                try:
+                    entries = list(os.scandir(x_entry.path))
+                except OSError:
+                    continue  # removed meanwhile
+                for entry in entries:
+                    stem, ext = os.path.splitext(entry.name)
+                    if stem.isdigit() and (ext == self.extension or (self.extension is None and ext)):
+                        y = int(stem)
+                        yield (z, x, (y if self.scheme == 'xyz' else flip_y(y, z))), entry
+
+    def _scan(self):
+        """
+        Yield the (z, x, y) of all cached tiles, reading the folder tree once
+        """
+        for z_x_y, entry in self._tile_entries():
+            yield z_x_y
+
+    def usage(self):
+        """
+        Yield (last use time, size, ((z, x, y), path)) of the tile files
+        """
+        for z_x_y, entry in self._tile_entries():
+            try:
+                st = entry.stat()
+            except OSError:
+                continue  # removed meanwhile
+            yield max(st.st_atime, st.st_mtime), st.st_size, (z_x_y, entry.path)
+
+    def evict(self, keys):
+        tiles = []
+        for z_x_y, path in keys:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            tiles.append(z_x_y)
+            self._index_discard(z_x_y)
+            # remove the column and zoom level folders once empty
+            for folder in (os.path.dirname(path), os.path.dirname(os.path.dirname(path))):
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    break
+        if tiles:
+            with self._meta_lock:
+                con = self._meta_connection()
+                con.executemany("DELETE FROM meta WHERE zoom_level=? AND tile_column=? AND tile_row=?", tiles)
+                con.commit()
+
+    def _get_index(self):
+        with self._index_lock:
+            if self._index is None:
+                index = {}
+                for (z, x, y) in self._scan():
+                    index.setdefault(z, set()).add(x << z | y)
+                Logger.debug(_("Indexed %s cached tiles in %s") % (sum(map(len, index.values())), self.folder))
+                self._index = index
+            return self._index
+
+    def _index_add(self, z_x_y):
+        (z, x, y) = z_x_y
+        with self._index_lock:
+            if self._index is not None:
+                self._index.setdefault(z, set()).add(x << z | y)
+
+    def _index_discard(self, z_x_y):
+        (z, x, y) = z_x_y
+        with self._index_lock:
+            if self._index is not None:
+                self._index.get(z, set()).discard(x << z | y)
+
+    def lock(self, z_x_y):
+        if not self.shared:
+            # threads of the process already fetch a tile once, see TilesManager._single_flight
+            return super(Disk, self).lock(z_x_y)
+        (z, x, y) = z_x_y
+        return FileLock(os.path.join(self.folder, '.locks', '%s_%s_%s.lock' % (z, x, y)))
+
+    def _meta_connection(self):
+        # called with self._meta_lock held
+        if self._meta_con is None:
+            os.makedirs(self.folder, exist_ok=True)
+            self._meta_con = sqlite3.connect(os.path.join(self.folder, 'meta.sqlite'),
+                                             timeout=30, check_same_thread=False)
+            self._meta_con.execute("PRAGMA journal_mode=WAL")
+            self._meta_con.execute("PRAGMA synchronous=NORMAL")
+            _create_meta_table(self._meta_con)
+            self._meta_con.commit()
+        return self._meta_con
+
+    def _close_meta(self):
+        with self._meta_lock:
+            if self._meta_con is not None:
+                self._meta_con.close()
+                self._meta_con = None
+
+    def close(self):
+        self._close_meta()
+
+    def read_meta(self, z_x_y):
+        (z, x, y) = z_x_y
+        with self._meta_lock:
+            row = self._meta_connection().execute(
+                "SELECT fetched, etag, last_modified FROM meta WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                (z, x, y)).fetchone()
+        if row is None:
+            return None
+        return {'fetched': row[0], 'etag': row[1], 'last_modified': row[2]}
+
+    def save_meta(self, z_x_y, meta):
+        (z, x, y) = z_x_y
+        with self._meta_lock:
+            con = self._meta_connection()
+            con.execute("INSERT OR REPLACE INTO meta (zoom_level, tile_column, tile_row, fetched, etag, last_modified) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (z, x, y, meta.get('fetched'), meta.get('etag'), meta.get('last_modified')))
+            con.execute("DELETE FROM missing WHERE zoom_level=? AND tile_column=? AND tile_row=?", (z, x, y))
+            con.commit()
+
+    def save_meta_many(self, metas):
+        rows = [(z, x, y, meta.get('fetched'), meta.get('etag'), meta.get('last_modified'))
+                for (z, x, y), meta in metas.items()]
+        with self._meta_lock:
+            con = self._meta_connection()
+            con.executemany("INSERT OR REPLACE INTO meta (zoom_level, tile_column, tile_row, fetched, etag, last_modified) "
+                            "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            con.executemany("DELETE FROM missing WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                            [row[:3] for row in rows])
+            con.commit()
+
+    def read_missing(self, z_x_y):
+        (z, x, y) = z_x_y
+        with self._meta_lock:
+            return self._meta_connection().execute(
+                "SELECT fetched, status_code FROM missing WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                (z, x, y)).fetchone()
+
+    def save_missing(self, z_x_y, status_code):
+        (z, x, y) = z_x_y
+        with self._meta_lock:
+            con = self._meta_connection()
+            con.execute("INSERT OR REPLACE INTO missing (zoom_level, tile_column, tile_row, fetched, status_code) "
+                        "VALUES (?, ?, ?, ?, ?)", (z, x, y, time.time(), status_code))
+            con.commit()
+
+    def _remove_meta(self, z_x_y):
+        (z, x, y) = z_x_y
+        with self._meta_lock:
+            con = self._meta_connection()
+            con.execute("DELETE FROM meta WHERE zoom_level=? AND tile_column=? AND tile_row=?", (z, x, y))
+            con.commit()
+
+    def contains_many(self, tiles):
+        """
+        Return the set of (z, x, y) of `tiles` found in the cache, looked up
+        in an index of the cached tiles instead of the files themselves.
+        Tiles removed behind the cache back (e.g. by `CacheQuota`) are still
+        counted until they are read.
+        """
+        index = self._get_index()
+        return {(z, x, y) for (z, x, y) in tiles if (x << z | y) in index.get(z, ())}
+
+    def count_cached(self, tiles):
+        index = self._get_index()
+        return sum(1 for (z, x, y) in tiles if (x << z | y) in index.get(z, ()))
+
+    def count_cached_tileset(self, tileset):
+        """
+        Return the number of cached tiles within `tileset`, going through
+        whichever is smaller: the tile set or the cached tiles of the zoom level
+        """
+        index = self._get_index()
+        count = 0
+        for z in tileset.zoomlevels():
+            with self._index_lock:
+                keys = index.get(z)
+                if not keys:
+                    continue
+                if tileset.count(z) < len(keys):
+                    count += sum(1 for (z, x, y) in tileset.iter_zoom(z) if (x << z | y) in keys)
+                    continue
+                mask = (1 << z) - 1
+                count += sum(1 for key in keys if (z, key >> z, key & mask) in tileset)
+        return count
 
     def tile_file(self, z_x_y):
         (z, x, y) = z_x_y
@@ -90,6 +542,8 @@ class Disk(Cache):
     def remove(self, z_x_y):
         (z, x, y) = z_x_y
         tile_abs_uri = self.tile_fullpath((z, x, y))
+        self._index_discard((z, x, y))
+        self._remove_meta((z, x, y))
         os.remove(tile_abs_uri)
         parent = os.path.dirname(tile_abs_uri)
         i = 0
@@ -104,23 +558,537 @@ class Disk(Cache):
     def read(self, z_x_y):
         (z, x, y) = z_x_y
         tile_abs_uri = self.tile_fullpath((z, x, y))
-        if os.path.exists(tile_abs_uri):
-            Logger.debug(_("Found %s") % tile_abs_uri)
-            return open(tile_abs_uri, 'rb').read()
-        return None
+        try:
+            with open(tile_abs_uri, 'rb') as f:
+                body = f.read()
+                st = os.fstat(f.fileno())
+        except FileNotFoundError:
+            self._index_discard((z, x, y))
+            return None
+        Logger.debug(_("Found %s") % tile_abs_uri)
+        if time.time() - st.st_atime > TOUCH_INTERVAL:
+            self._touch(tile_abs_uri, st)
+        return body
+
+    def _touch(self, path, st):
+        """
+        Record the use of `path` for LRU eviction, even on filesystems mounted
+        with `relatime`/`noatime`. `st` is the stat result of the file read.
+        """
+        try:
+            os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+        except OSError:
+            pass
+
+    def exists(self, z_x_y):
+        return os.path.exists(self.tile_fullpath(z_x_y))
 
     def save(self, body, z_x_y):
         (z, x, y) = z_x_y
         tile_abs_uri = self.tile_fullpath((z, x, y))
-        tile_abs_dir = os.path.dirname(tile_abs_uri)
-        if not os.path.isdir(tile_abs_dir):
-            os.makedirs(tile_abs_dir)
         Logger.debug(_("Save %s bytes to %s") % (len(body), tile_abs_uri))
-        open(tile_abs_uri, 'wb').write(body)
+        _write_atomic(tile_abs_uri, body)
+        _record_written(self._basefolder, len(body))
+        self._index_add((z, x, y))
 
     def clean(self):
         Logger.debug(_("Clean-up %s") % self.folder)
+        self._index = None
+        self._close_meta()
         try:
             shutil.rmtree(self.folder)
         except OSError:
             Logger.warning(_("%s was missing or read-only.") % self.folder)
+
+
+class Sqlite(Disk):
+    """
+    Stores the tiles of a provider in a single SQLite database
+    (`folder/<basename>/tiles.sqlite`) instead of one file per tile
+    """
+    def __init__(self, basename, folder, **kwargs):
+        self._con = None
+        self._lock = threading.Lock()
+        self._uses = {}  # key -> last use time of entries read, not saved yet
+        self._uses_saved = time.monotonic()
+        super(Sqlite, self).__init__(basename, folder, **kwargs)
+        self._meta_lock = self._lock  # the metadata are stored in the same database
+
+    @Disk.basename.setter
+    def basename(self, basename):
+        Disk.basename.fset(self, basename)
+        self.close()
+        self.filepath = os.path.join(self.folder, 'tiles.sqlite')
+
+    def _connection(self):
+        # called with self._lock held
+        if self._con is None:
+            os.makedirs(self.folder, exist_ok=True)
+            Logger.debug(_("Open cache database %s") % self.filepath)
+            self._con = sqlite3.connect(self.filepath, timeout=30, check_same_thread=False)
+            # lets the eviction give the pages of removed tiles back, for new databases only
+            self._con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self._con.execute("PRAGMA journal_mode=WAL")
+            self._con.execute("PRAGMA synchronous=NORMAL")
+            self._create_tables(self._con)
+            self._con.commit()
+        return self._con
+
+    def _scan(self):
+        with self._lock:
+            rows = self._connection().execute("SELECT zoom_level, tile_column, tile_row FROM tiles").fetchall()
+        return iter(rows)
+
+    def _meta_connection(self):
+        return self._connection()
+
+    def _close_meta(self):
+        pass
+
+    def _create_tables(self, con):
+        con.execute("""CREATE TABLE IF NOT EXISTS tiles (
+            zoom_level integer, tile_column integer, tile_row integer, tile_data blob, used real,
+            PRIMARY KEY (zoom_level, tile_column, tile_row))""")
+        _add_column(con, 'tiles', 'used', 'real')
+        _create_meta_table(con)
+
+    def _record_use(self, key):
+        """
+        Record the use of an entry for LRU eviction. Use times are saved by batches
+        every USE_FLUSH_INTERVAL s, not on each read. Called with self._lock held
+        """
+        self._uses[key] = time.time()
+        if time.monotonic() - self._uses_saved > USE_FLUSH_INTERVAL:
+            self._flush_uses()
+
+    def _flush_uses(self):
+        # called with self._lock held
+        self._uses_saved = time.monotonic()
+        if self._uses:
+            uses, self._uses = self._uses, {}
+            con = self._connection()
+            self._save_uses(con, uses)
+            con.commit()
+
+    def _save_uses(self, con, uses):
+        con.executemany("UPDATE tiles SET used=? WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                        [(used, z, x, y) for (z, x, y), used in uses.items()])
+
+    def usage(self):
+        """
+        Yield (last use time, size, (z, x, y)) of the stored tiles, tiles stored
+        before use times were recorded come first
+        """
+        with self._lock:
+            self._flush_uses()
+            rows = self._connection().execute(
+                "SELECT zoom_level, tile_column, tile_row, length(tile_data), COALESCE(used, 0) FROM tiles").fetchall()
+        for z, x, y, size, used in rows:
+            yield used, size, (z, x, y)
+
+    def evict(self, keys):
+        keys = [tuple(z_x_y) for z_x_y in keys]
+        with self._lock:
+            con = self._connection()
+            con.executemany("DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", keys)
+            con.executemany("DELETE FROM meta WHERE zoom_level=? AND tile_column=? AND tile_row=?", keys)
+            con.commit()
+            con.executescript("PRAGMA incremental_vacuum")
+        for z_x_y in keys:
+            self._index_discard(z_x_y)
+
+    def read(self, z_x_y):
+        (z, x, y) = z_x_y
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                (z, x, y)).fetchone()
+            if row is not None:
+                self._record_use((z, x, y))
+        if row is None:
+            self._index_discard((z, x, y))
+            return None
+        Logger.debug(_("Found %s in %s") % ((z, x, y), self.filepath))
+        return bytes(row[0])
+
+    def exists(self, z_x_y):
+        (z, x, y) = z_x_y
+        with self._lock:
+            return self._connection().execute(
+                "SELECT 1 FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                (z, x, y)).fetchone() is not None
+
+    def save(self, body, z_x_y):
+        (z, x, y) = z_x_y
+        Logger.debug(_("Save %s bytes of %s to %s") % (len(body), (z, x, y), self.filepath))
+        with self._lock:
+            con = self._connection()
+            con.execute("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, used) "
+                        "VALUES (?, ?, ?, ?, ?)", (z, x, y, sqlite3.Binary(body), time.time()))
+            con.commit()
+        _record_written(self._basefolder, len(body))
+        self._index_add((z, x, y))
+
+    def remove(self, z_x_y):
+        (z, x, y) = z_x_y
+        with self._lock:
+            con = self._connection()
+            con.execute("DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", (z, x, y))
+            con.execute("DELETE FROM meta WHERE zoom_level=? AND tile_column=? AND tile_row=?", (z, x, y))
+            con.commit()
+        self._index_discard((z, x, y))
+
+    def close(self):
+        with self._lock:
+            if self._con is not None:
+                try:
+                    self._flush_uses()
+                except sqlite3.Error as e:
+                    Logger.warning(_("Cannot save use times to %s: %s") % (self.filepath, e))
+                self._con.close()
+                self._con = None
+
+    def clean(self):
+        self.close()
+        super(Sqlite, self).clean()
+
+
+
+class ContentAddressed(Sqlite):
+    """
+    Stores each distinct tile content once, as `folder/<basename>/blobs/<hash>`.
+    An index database maps the tiles to the content hashes and counts the
+    references of each blob, so identical tiles (sea, "no imagery" placeholders...)
+    cost a single file.
+    """
+    @Disk.basename.setter
+    def basename(self, basename):
+        Disk.basename.fset(self, basename)
+        self.close()
+        self.filepath = os.path.join(self.folder, 'index.sqlite')
+        self.blobs_folder = os.path.join(self.folder, 'blobs')
+
+    def _create_tables(self, con):
+        con.execute("""CREATE TABLE IF NOT EXISTS map (
+            zoom_level integer, tile_column integer, tile_row integer, tile_id text,
+            PRIMARY KEY (zoom_level, tile_column, tile_row))""")
+        con.execute("""CREATE INDEX IF NOT EXISTS map_tile_id ON map (tile_id)""")
+        con.execute("""CREATE TABLE IF NOT EXISTS blobs (tile_id text PRIMARY KEY, refs integer, used real)""")
+        _add_column(con, 'blobs', 'used', 'real')
+        _create_meta_table(con)
+
+    def _scan(self):
+        with self._lock:
+            rows = self._connection().execute("SELECT zoom_level, tile_column, tile_row FROM map").fetchall()
+        return iter(rows)
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Run the block in a write transaction, so that the references counts stay
+        right when several processes share the cache. Called with self._lock held
+        """
+        con = self._connection()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            yield con
+        except BaseException:
+            con.rollback()
+            raise
+        con.commit()
+
+    def blob_fullpath(self, tile_id):
+        return os.path.join(self.blobs_folder, tile_id[:2], tile_id + self.extension)
+
+    def _tile_id(self, con, z_x_y):
+        row = con.execute("SELECT tile_id FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                          z_x_y).fetchone()
+        return row[0] if row else None
+
+    def _save_uses(self, con, uses):
+        con.executemany("UPDATE blobs SET used=? WHERE tile_id=?", [(used, tile_id) for tile_id, used in uses.items()])
+
+    def usage(self):
+        """
+        Yield (last use time, size, (tile_id, path)) of the blobs, a blob is used
+        whenever one of its tiles is read
+        """
+        with self._lock:
+            self._flush_uses()
+            used = dict(self._connection().execute("SELECT tile_id, COALESCE(used, 0) FROM blobs"))
+        for prefix_entry in _subdirs_all(self.blobs_folder):
+            try:
+                entries = list(os.scandir(prefix_entry.path))
+            except OSError:
+                continue
+            for entry in entries:
+                tile_id, ext = os.path.splitext(entry.name)
+                if tile_id not in used:
+                    continue  # not committed yet, or left by a failed save
+                try:
+                    size = entry.stat().st_size
+                except OSError:
+                    continue
+                yield used[tile_id], size, (tile_id, entry.path)
+
+    def evict(self, keys):
+        tiles = []
+        with self._lock, self._transaction() as con:
+            for tile_id, path in keys:
+                rows = con.execute("SELECT zoom_level, tile_column, tile_row FROM map WHERE tile_id=?",
+                                   (tile_id,)).fetchall()
+                con.executemany("DELETE FROM meta WHERE zoom_level=? AND tile_column=? AND tile_row=?", rows)
+                con.execute("DELETE FROM map WHERE tile_id=?", (tile_id,))
+                con.execute("DELETE FROM blobs WHERE tile_id=?", (tile_id,))
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                tiles.extend(rows)
+        for z_x_y in tiles:
+            self._index_discard(tuple(z_x_y))
+
+    def _unref(self, con, tile_id):
+        """ Drop a reference to the `tile_id` blob, removing it when unused. Called with self._lock held """
+        con.execute("UPDATE blobs SET refs = refs - 1 WHERE tile_id=?", (tile_id,))
+        if con.execute("SELECT refs FROM blobs WHERE tile_id=?", (tile_id,)).fetchone()[0] <= 0:
+            con.execute("DELETE FROM blobs WHERE tile_id=?", (tile_id,))
+            try:
+                os.remove(self.blob_fullpath(tile_id))
+            except OSError:
+                pass
+
+    def read(self, z_x_y):
+        (z, x, y) = z_x_y
+        with self._lock:
+            tile_id = self._tile_id(self._connection(), (z, x, y))
+        if tile_id is None:
+            self._index_discard((z, x, y))
+            return None
+        blob_path = self.blob_fullpath(tile_id)
+        try:
+            with open(blob_path, 'rb') as f:
+                body = f.read()
+        except OSError:
+            # removed behind the cache back
+            self.remove((z, x, y))
+            return None
+        Logger.debug(_("Found %s in %s") % ((z, x, y), blob_path))
+        with self._lock:
+            self._record_use(tile_id)
+        return body
+
+    def exists(self, z_x_y):
+        (z, x, y) = z_x_y
+        with self._lock:
+            return self._tile_id(self._connection(), (z, x, y)) is not None
+
+    def save(self, body, z_x_y):
+        (z, x, y) = z_x_y
+        tile_id = tile_hash(body)
+        with self._lock, self._transaction() as con:
+            old_tile_id = self._tile_id(con, (z, x, y))
+            if old_tile_id == tile_id:
+                return
+            blob_path = self.blob_fullpath(tile_id)
+            if con.execute("SELECT 1 FROM blobs WHERE tile_id=?", (tile_id,)).fetchone() is None \
+                    or not os.path.exists(blob_path):
+                Logger.debug(_("Save %s bytes to %s") % (len(body), blob_path))
+                _write_atomic(blob_path, body)
+                _record_written(self._basefolder, len(body))
+            else:
+                Logger.debug(_("Tile %s is the same as %s") % ((z, x, y), blob_path))
+            con.execute("INSERT OR IGNORE INTO blobs (tile_id, refs) VALUES (?, 0)", (tile_id,))
+            con.execute("UPDATE blobs SET refs = refs + 1, used = ? WHERE tile_id=?", (time.time(), tile_id))
+            con.execute("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) "
+                        "VALUES (?, ?, ?, ?)", (z, x, y, tile_id))
+            if old_tile_id is not None:
+                self._unref(con, old_tile_id)
+        self._index_add((z, x, y))
+
+    def remove(self, z_x_y):
+        (z, x, y) = z_x_y
+        with self._lock, self._transaction() as con:
+            tile_id = self._tile_id(con, (z, x, y))
+            if tile_id is None:
+                return
+            con.execute("DELETE FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?", (z, x, y))
+            con.execute("DELETE FROM meta WHERE zoom_level=? AND tile_column=? AND tile_row=?", (z, x, y))
+            self._unref(con, tile_id)
+        self._index_discard((z, x, y))
+
+
+class Memory(Cache):
+    """
+    Keeps the most recently used tiles, and their freshness metadata once read,
+    in memory in front of another cache
+    """
+    def __init__(self, backend, max_bytes, **kwargs):
+        """
+        backend -- the wrapped `Cache` tiles are read from and saved to
+        max_bytes -- memory budget for tiles contents, the least recently used ones are evicted beyond it
+        """
+        super(Memory, self).__init__(extension=backend.extension, **kwargs)
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        self._meta = {}  # (z, x, y) -> freshness metadata of tiles held in memory
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # folder, basename, tile_fullpath... of the wrapped cache
+        if name == 'backend':
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+    @property
+    def scheme(self):
+        return self.backend.scheme
+
+    @scheme.setter
+    def scheme(self, scheme):
+        self.backend.scheme = scheme
+        self.clear()
+
+    @property
+    def shared(self):
+        return self.backend.shared
+
+    @property
+    def size(self):
+        """ Number of bytes of tiles held in memory """
+        return self._size
+
+    def tile_file(self, z_x_y):
+        return self.backend.tile_file(z_x_y)
+
+    def _remember(self, z_x_y, body):
+        # called with self._lock held
+        old = self._tiles.pop(z_x_y, None)
+        self._meta.pop(z_x_y, None)
+        if old is not None:
+            self._size -= len(old)
+        if len(body) > self.max_bytes:
+            return
+        self._tiles[z_x_y] = body
+        self._size += len(body)
+        while self._size > self.max_bytes:
+            evicted_z_x_y, evicted = self._tiles.popitem(last=False)
+            self._meta.pop(evicted_z_x_y, None)
+            self._size -= len(evicted)
+
+    def _forget(self, z_x_y):
+        with self._lock:
+            old = self._tiles.pop(z_x_y, None)
+            self._meta.pop(z_x_y, None)
+            if old is not None:
+                self._size -= len(old)
+
+    def read(self, z_x_y):
+        z_x_y = tuple(z_x_y)
+        with self._lock:
+            body = self._tiles.get(z_x_y)
+            if body is not None:
+                self._tiles.move_to_end(z_x_y)
+                self.hits += 1
+                return body
+            self.misses += 1
+        body = self.backend.read(z_x_y)
+        if body is not None:
+            with self._lock:
+                self._remember(z_x_y, body)
+        return body
+
+    def exists(self, z_x_y):
+        z_x_y = tuple(z_x_y)
+        with self._lock:
+            if z_x_y in self._tiles:
+                return True
+        return self.backend.exists(z_x_y)
+
+    def contains_many(self, tiles):
+        return self.backend.contains_many(tiles)
+
+    def count_cached(self, tiles):
+        return self.backend.count_cached(tiles)
+
+    def count_cached_tileset(self, tileset):
+        return self.backend.count_cached_tileset(tileset)
+
+    def read_meta(self, z_x_y):
+        z_x_y = tuple(z_x_y)
+        with self._lock:
+            meta = self._meta.get(z_x_y)
+        if meta is not None:
+            return dict(meta)
+        meta = self.backend.read_meta(z_x_y)
+        if meta is not None:
+            self._remember_meta({z_x_y: meta})
+        return meta
+
+    def _remember_meta(self, metas):
+        with self._lock:
+            for z_x_y, meta in metas.items():
+                if z_x_y in self._tiles:
+                    self._meta[z_x_y] = dict(meta)
+
+    def lock(self, z_x_y):
+        return self.backend.lock(z_x_y)
+
+    def usage(self):
+        return self.backend.usage()
+
+    def evict(self, keys):
+        self.clear()  # the keys are those of the wrapped cache
+        self.backend.evict(keys)
+
+    def close(self):
+        self.backend.close()
+
+    def save_meta(self, z_x_y, meta):
+        self.backend.save_meta(z_x_y, meta)
+        self._remember_meta({tuple(z_x_y): meta})
+
+    def save_meta_many(self, metas):
+        self.backend.save_meta_many(metas)
+        self._remember_meta({tuple(z_x_y): meta for z_x_y, meta in metas.items()})
+
+    def read_missing(self, z_x_y):
+        return self.backend.read_missing(z_x_y)
+
+    def save_missing(self, z_x_y, status_code):
+        self.backend.save_missing(z_x_y, status_code)
+
+    def save(self, body, z_x_y):
+        z_x_y = tuple(z_x_y)
+        self.backend.save(body, z_x_y)
+        with self._lock:
+            self._remember(z_x_y, body)
+
+    def remove(self, z_x_y):
+        z_x_y = tuple(z_x_y)
+        self._forget(z_x_y)
+        self.backend.remove(z_x_y)
+
+    def stats(self):
+        """
+        Return a dict of the hits and misses counters and of the memory held
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'tiles': len(self._tiles), 'bytes': self._size}
+
+    def clear(self):
+        """
+        Drop the tiles held in memory, keeping the wrapped cache
+        """
+        with self._lock:
+            self._tiles.clear()
+            self._meta.clear()
+            self._size = 0
+
+    def clean(self):
+        self.clear()
+        self.backend.clean()
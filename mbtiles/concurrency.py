@@ -0,0 +1,143 @@
+import threading
+import time
+
+from kivy.logger import Logger
+
+from . import DEFAULT_CONNECTION_MAX_TIMEOUT
+
+""" HTTP status codes of a provider asking to slow down """
+THROTTLE_STATUS_CODES = (429, 503)
+""" Weights of a new latency sample in the short-term and long-term latency averages """
+SHORT_LATENCY_WEIGHT = 0.2
+LONG_LATENCY_WEIGHT = 0.02
+
+
+def is_permanent_error(status_code):
+    """
+    Return True if a request answered `status_code` would get the same answer when retried
+    """
+    return status_code is not None and status_code < 500 and status_code not in (408,) + THROTTLE_STATUS_CODES
+
+
+def parse_retry_after(value):
+    """
+    Return delay in s from the `Retry-After` header `value` (seconds or HTTP date)
+    """
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0., parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimit(object):
+    def __init__(self, maximum, minimum=1, initial=None, backoff=0.5, latency_tolerance=2., persistence=10):
+        """
+        Additive-increase/multiplicative-decrease limit of parallel fetches.
+        Grows by one fetch per `limit` successful fetches and is multiplied by
+        `backoff` on throttling responses or on a sustained latency rise: the
+        short-term average latency staying above `latency_tolerance` times the
+        long-term one for `persistence` fetches in a row. Per-fetch jitter is
+        smoothed out by both averages and never cuts the limit.
+        """
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.persistence = persistence
+        self._limit = float(initial if initial is not None else self.minimum)
+        self._active = 0
+        self._latency = None  # short-term average
+        self._long_latency = None  # long-term average
+        self._samples = 0
+        self._rising = 0
+        self._decreased_at = 0
+        self._paused_until = 0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return max(self.minimum, min(self.maximum, int(self._limit)))
+
+    def try_acquire(self):
+        """
+        Take a fetch slot if one is free, return True on success
+        """
+        with self._condition:
+            if self._active < self.limit and time.monotonic() >= self._paused_until:
+                self._active += 1
+                return True
+            return False
+
+    def paused_for(self):
+        """
+        Return the time in s before fetches may start again after a throttling response
+        """
+        return max(0., self._paused_until - time.monotonic())
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                delay = self._paused_until - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                elif self._active >= self.limit:
+                    self._condition.wait()
+                else:
+                    self._active += 1
+                    return
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def on_success(self, latency):
+        with self._condition:
+            self._samples += 1
+            if self._latency is None:
+                self._latency = self._long_latency = latency
+            self._latency += (latency - self._latency) * SHORT_LATENCY_WEIGHT
+            self._long_latency += (latency - self._long_latency) * LONG_LATENCY_WEIGHT
+            if self._samples > self.persistence and self._latency > self._long_latency * self.latency_tolerance:
+                self._rising += 1
+            else:
+                self._rising = 0
+            if self._rising >= self.persistence:
+                self._rising = 0
+                self._decrease()
+            elif not self._rising:
+                self._limit = min(self.maximum, self._limit + 1 / max(1., self._limit))
+            self._condition.notify_all()
+
+    def on_throttle(self, retry_after=None):
+        """
+        Cut the limit and pause all fetches for `retry_after` s (if set)
+        """
+        with self._condition:
+            self._decrease()
+            if retry_after:
+                retry_after = min(retry_after, DEFAULT_CONNECTION_MAX_TIMEOUT * 4)
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def _decrease(self):
+        now = time.monotonic()
+        # responses of fetches started before the last decrease do not count again
+        if now - self._decreased_at < (self._latency or 0):
+            return
+        self._decreased_at = now
+        self._limit = max(self.minimum, self._limit * self.backoff)
+        Logger.debug(f'Parallel fetches limit decreased to {self.limit}')
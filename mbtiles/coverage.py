@@ -0,0 +1,361 @@
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+from gettext import gettext as _
+from math import cos, floor, radians
+
+from consts import MAX_LATITUDE
+from tools.geometry import pointRadialDistance, initialBearing
+from .exceptions import InvalidCoverageError
+from .tileset import TileSet
+from .utils import latlon_to_tile_xy
+
+""" Number of edges per band of the point in polygon lookup """
+EDGES_PER_BAND = 8
+""" Number of sides of the polygons approximating the corridor around route points """
+CORRIDOR_ROUND_SIDES = 16
+""" Routes are simplified within this fraction of the buffer, which is widened to make up for it """
+CORRIDOR_SIMPLIFY_RATIO = 0.1
+
+
+def _geojson_geometries(geojson):
+    """
+    Yield (type, coordinates) of the geometries of a GeoJSON object
+    """
+    geometry_type = geojson.get('type')
+    if geometry_type == 'FeatureCollection':
+        for feature in geojson.get('features', []):
+            yield from _geojson_geometries(feature)
+    elif geometry_type == 'Feature':
+        if geojson.get('geometry'):
+            yield from _geojson_geometries(geojson['geometry'])
+    elif geometry_type == 'GeometryCollection':
+        for geometry in geojson.get('geometries', []):
+            yield from _geojson_geometries(geometry)
+    elif geometry_type is not None:
+        yield geometry_type, geojson.get('coordinates')
+
+
+def geojson_polygons(geojson):
+    """
+    Return the polygons of a GeoJSON object as a list of polygons, each a list
+    of rings of (lon, lat), the exterior ring first. Other geometries are ignored.
+    """
+    polygons = []
+    for geometry_type, coordinates in _geojson_geometries(geojson):
+        if geometry_type == 'Polygon':
+            polygons.append(coordinates)
+        elif geometry_type == 'MultiPolygon':
+            polygons.extend(coordinates)
+    return polygons
+
+
+def geojson_lines(geojson):
+    """
+    Return the lines of a GeoJSON object as a list of lines, each a list of (lon, lat).
+    Other geometries are ignored.
+    """
+    lines = []
+    for geometry_type, coordinates in _geojson_geometries(geojson):
+        if geometry_type == 'LineString':
+            lines.append(coordinates)
+        elif geometry_type == 'MultiLineString':
+            lines.extend(coordinates)
+    return lines
+
+
+def gpx_lines(root):
+    """
+    Return the track segments and routes of a GPX document `root` element
+    as a list of lines, each a list of (lon, lat)
+    """
+    lines = []
+    for element in root.iter():
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag in ('trkseg', 'rte'):
+            lines.append([(float(point.get('lon')), float(point.get('lat')))
+                          for point in element if point.tag.rsplit('}', 1)[-1] in ('trkpt', 'rtept')])
+    return [line for line in lines if line]
+
+
+def load_geojson(path):
+    """
+    Return the polygons of the GeoJSON file at `path`, see `geojson_polygons`
+    """
+    try:
+        with open(path) as f:
+            polygons = geojson_polygons(json.load(f))
+    except (OSError, ValueError, KeyError, AttributeError) as e:
+        raise InvalidCoverageError(_("Cannot read GeoJSON file %s: %s") % (path, e))
+    if not polygons:
+        raise InvalidCoverageError(_("No polygon found in GeoJSON file %s") % path)
+    return polygons
+
+
+def load_route(path):
+    """
+    Return the lines of the GPX or GeoJSON file at `path`, see `gpx_lines` and `geojson_lines`
+    """
+    try:
+        if os.path.splitext(path)[1].lower() == '.gpx':
+            lines = gpx_lines(ElementTree.parse(path).getroot())
+        else:
+            with open(path) as f:
+                lines = geojson_lines(json.load(f))
+    except (OSError, ValueError, KeyError, AttributeError, TypeError, ElementTree.ParseError) as e:
+        raise InvalidCoverageError(_("Cannot read route file %s: %s") % (path, e))
+    if not lines:
+        raise InvalidCoverageError(_("No route found in file %s") % path)
+    return lines
+
+
+def polygons_bounds(polygons):
+    """
+    Return the (xmin, ymin, xmax, ymax) bounding box of `polygons` exterior rings
+    """
+    points = [point for polygon in polygons for point in polygon[0]]
+    return (min(p[0] for p in points), min(p[1] for p in points),
+            max(p[0] for p in points), max(p[1] for p in points))
+
+
+def _project(lon_lat):
+    """
+    Return the position of (lon, lat) in the world tile at zoom 0, XYZ scheme
+    """
+    lon, lat = lon_lat[0], lon_lat[1]
+    if abs(lon) > 180 or abs(lat) > 90:
+        raise InvalidCoverageError(_("Some coordinates exceed [-180,+180], [-90, 90]."))
+    return latlon_to_tile_xy(max(min(MAX_LATITUDE, lat), -MAX_LATITUDE), lon, 0)
+
+
+def _segment_in_rect(edge, xmin, ymin, xmax, ymax):
+    """
+    Return whether segment `edge` (x0, y0, x1, y1) touches the rectangle (Liang-Barsky clipping)
+    """
+    x0, y0, x1, y1 = edge
+    if max(x0, x1) < xmin or min(x0, x1) > xmax or max(y0, y1) < ymin or min(y0, y1) > ymax:
+        return False
+    t0, t1 = 0.0, 1.0
+    dx, dy = x1 - x0, y1 - y0
+    for p, q in ((-dx, x0 - xmin), (dx, xmax - x0), (-dy, y0 - ymin), (dy, ymax - y0)):
+        if p == 0:
+            if q < 0:
+                return False
+        elif p < 0:
+            t0 = max(t0, q / p)
+        else:
+            t1 = min(t1, q / p)
+        if t0 > t1:
+            return False
+    return True
+
+
+class _Polygon(object):
+    def __init__(self, rings):
+        """
+        Polygon with holes projected in the world tile, filled with the even-odd rule.
+        Its edges are bucketed in horizontal bands to test points against a few of them.
+        """
+        self.edges = []
+        for ring in rings:
+            points = [_project(point) for point in ring]
+            if len(points) < 3:
+                continue
+            for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]):
+                if (x0, y0) != (x1, y1):
+                    self.edges.append((x0, y0, x1, y1))
+        if not self.edges:
+            raise InvalidCoverageError(_("Polygon has less than 3 points."))
+        self.ymin = min(min(e[1], e[3]) for e in self.edges)
+        self.ymax = max(max(e[1], e[3]) for e in self.edges)
+        self._bands = [[] for _band in range(max(1, len(self.edges) // EDGES_PER_BAND))]
+        for edge in self.edges:
+            first = self._band(min(edge[1], edge[3]))
+            last = self._band(max(edge[1], edge[3]))
+            for band in range(first, last + 1):
+                self._bands[band].append(edge)
+
+    def _band(self, y):
+        if self.ymax == self.ymin:
+            return 0
+        return min(len(self._bands) - 1, int((y - self.ymin) / (self.ymax - self.ymin) * len(self._bands)))
+
+    def contains(self, x, y):
+        if not self.ymin <= y <= self.ymax:
+            return False
+        inside = False
+        for x0, y0, x1, y1 in self._bands[self._band(y)]:
+            if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+                inside = not inside
+        return inside
+
+
+def polygon_tile_ranges(rings, zoomlevels):
+    """
+    Return a dict zoom -> list of tile ranges (xmin, xmax, ymin, ymax), XYZ scheme,
+    of the tiles touching the polygon of `rings`.
+    The world tile is split as a quadtree: a tile crossed by the polygon edges is
+    refined into its children, which only test the edges of their parent, and a
+    tile without edges is inside or outside the polygon with all its descendants.
+    """
+    polygon = _Polygon(rings)
+    levels = set(zoomlevels)
+    maxzoom = max(levels)
+    ranges = {z: [] for z in levels}
+    stack = [(0, 0, 0, polygon.edges)]
+    while stack:
+        z, x, y, edges = stack.pop()
+        size = 1 / 2 ** z
+        xmin, ymin = x * size, y * size
+        edges = [edge for edge in edges if _segment_in_rect(edge, xmin, ymin, xmin + size, ymin + size)]
+        if not edges:
+            if polygon.contains(xmin + size / 2, ymin + size / 2):
+                for level in levels:
+                    if level >= z:
+                        d = level - z
+                        ranges[level].append((x << d, (x + 1) << d, y << d, (y + 1) << d))
+            continue
+        if z in levels:
+            ranges[z].append((x, x + 1, y, y + 1))
+        if z < maxzoom:
+            for child_x in (2 * x, 2 * x + 1):
+                for child_y in (2 * y, 2 * y + 1):
+                    stack.append((z + 1, child_x, child_y, edges))
+    return ranges
+
+
+def polygons_tileset(polygons, zoomlevels, scheme='xyz'):
+    """
+    Return the `TileSet` of the tiles touching `polygons` at `zoomlevels`,
+    y in `scheme` ('xyz' or 'tms')
+    """
+    if not zoomlevels:
+        raise InvalidCoverageError(_("Wrong zoom levels."))
+    ranges = {}
+    for rings in polygons:
+        for z, zoom_ranges in polygon_tile_ranges(rings, zoomlevels).items():
+            if scheme == 'tms':
+                zoom_ranges = [(x0, x1, 2 ** z - y1, 2 ** z - y0) for x0, x1, y0, y1 in zoom_ranges]
+            ranges.setdefault(z, []).extend(zoom_ranges)
+    return TileSet.from_ranges(ranges)
+
+
+def _simplify_line(line, tolerance_km):
+    """
+    Return the points of `line` (lon, lat) kept by the Douglas-Peucker algorithm:
+    the line stays within `tolerance_km` of the removed points
+    """
+    if len(line) < 3:
+        return list(line)
+    # local equirectangular approximation, accurate enough for a tolerance
+    kx = 111.32 * cos(radians(sum(p[1] for p in line) / len(line)))
+    ky = 110.57
+    points = [(p[0] * kx, p[1] * ky) for p in line]
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x0, y0), (x1, y1) = points[first], points[last]
+        dx, dy = x1 - x0, y1 - y0
+        length2 = dx * dx + dy * dy
+        farthest, distance2 = None, tolerance_km * tolerance_km
+        for i in range(first + 1, last):
+            px, py = points[i]
+            t = max(0, min(1, ((px - x0) * dx + (py - y0) * dy) / length2)) if length2 else 0
+            d2 = (px - x0 - t * dx) ** 2 + (py - y0 - t * dy) ** 2
+            if d2 > distance2:
+                farthest, distance2 = i, d2
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [point for point, kept in zip(line, keep) if kept]
+
+
+def _unwrap(lon, reference):
+    """
+    Return `lon` shifted by a multiple of 360 to lie within 180 of `reference`
+    """
+    return reference + (lon - reference + 180) % 360 - 180
+
+
+def _offset(lon, lat, bearing, distance_km):
+    """
+    Return the (lon, lat) at `distance_km` from (lon, lat) towards `bearing`,
+    its longitude unwrapped around `lon`, so possibly beyond [-180, 180]
+    """
+    offset_lat, offset_lon = pointRadialDistance(lat, lon, bearing, distance_km)
+    return _unwrap(offset_lon, lon), offset_lat
+
+
+def _round(lon, lat, buffer_km):
+    return [_offset(lon, lat, 360 * i / CORRIDOR_ROUND_SIDES, buffer_km) for i in range(CORRIDOR_ROUND_SIDES)]
+
+
+def _clip_lon(ring, lon_min, lon_max):
+    """
+    Return the part of `ring` (lon, lat) between `lon_min` and `lon_max` (Sutherland-Hodgman clipping)
+    """
+    for inside, bound in ((lambda lon: lon >= lon_min, lon_min), (lambda lon: lon <= lon_max, lon_max)):
+        clipped = []
+        for (lon0, lat0), (lon1, lat1) in zip(ring[-1:] + ring[:-1], ring):
+            if inside(lon1) != inside(lon0):
+                clipped.append((bound, lat0 + (bound - lon0) * (lat1 - lat0) / (lon1 - lon0)))
+            if inside(lon1):
+                clipped.append((lon1, lat1))
+        ring = clipped
+        if not ring:
+            break
+    return ring
+
+
+def _split_antimeridian(ring):
+    """
+    Return the rings covering `ring`, whose longitudes may be beyond [-180, 180],
+    within [-180, 180]: its parts beyond the antimeridian are moved to the other side
+    """
+    if all(-180 <= lon <= 180 for lon, lat in ring):
+        return [ring]
+    turns = floor((ring[0][0] + 180) / 360)  # of routes going around the world
+    ring = [(lon - 360 * turns, lat) for lon, lat in ring]
+    rings = []
+    for shift in (-360, 0, 360):
+        clipped = _clip_lon([(lon + shift, lat) for lon, lat in ring], -180, 180)
+        if len(clipped) >= 3:
+            rings.append(clipped)
+    return rings
+
+
+def corridor_polygons(lines, buffer_km):
+    """
+    Return polygons covering the corridor of `buffer_km` around `lines`, each a list of (lon, lat):
+    a polygon around each point and a quadrilateral along each segment, offset with
+    `pointRadialDistance`. Lines are simplified first and the buffer widened accordingly.
+    Polygons crossing the antimeridian are split there.
+    """
+    if buffer_km <= 0:
+        raise InvalidCoverageError(_("Corridor width must be positive."))
+    tolerance_km = buffer_km * CORRIDOR_SIMPLIFY_RATIO
+    buffer_km += tolerance_km  # also covers the sides of the polygons around points
+    rings = []
+    for line in lines:
+        # follow the line across the antimeridian instead of jumping back around the world
+        unwrapped = []
+        for p in line:
+            unwrapped.append((_unwrap(p[0], unwrapped[-1][0]) if unwrapped else p[0], p[1]))
+        line = _simplify_line(unwrapped, tolerance_km)
+        for lon, lat in line:
+            rings.append(_round(lon, lat, buffer_km))
+        for (lon0, lat0), (lon1, lat1) in zip(line, line[1:]):
+            if (lon0, lat0) == (lon1, lat1):
+                continue
+            start_bearing = initialBearing(lat0, lon0, lat1, lon1)
+            end_bearing = (initialBearing(lat1, lon1, lat0, lon0) + 180) % 360
+            rings.append([
+                _offset(lon0, lat0, start_bearing - 90, buffer_km),
+                _offset(lon1, lat1, end_bearing - 90, buffer_km),
+                _offset(lon1, lat1, end_bearing + 90, buffer_km),
+                _offset(lon0, lat0, start_bearing + 90, buffer_km),
+            ])
+    return [[split] for ring in rings for split in _split_antimeridian(ring)]
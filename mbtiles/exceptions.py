@@ -6,10 +6,20 @@ class InvalidFormatError(Exception):
     """ Raised when reading of MBTiles content has failed """
     pass
 
+class UpdateMismatchError(Exception):
+    """ Raised when the tiles to add to an existing MBTiles file do not match its format or source """
+    pass
+
 class DownloadError(Exception):
     """ Raised when download at tiles URL fails DOWNLOAD_RETRIES times """
-    def __init__(self, *args, status_code=None, **kwargs):
+    def __init__(self, *args, status_code=None, retry_after=None, **kwargs):
+        super().__init__(*args)
         self.status_code = status_code
+        self.retry_after = retry_after
+
+class TileNotFoundError(DownloadError):
+    """ Raised when the provider has no tile at the requested position """
+    pass
 
 class InvalidCoverageError(Exception):
     """ Raised when coverage bounds are invalid """
@@ -0,0 +1,155 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from gettext import gettext as _
+
+from kivy.logger import Logger
+
+""" Number of newly done tiles after which the journal is written to disk """
+FLUSH_EVERY_TILES = 500
+""" Time in s after which newly done tiles are written to disk """
+FLUSH_EVERY_SECONDS = 5
+""" Side of the square chunks of tiles whose done flags are stored together """
+CHUNK_SIZE = 64
+CHUNK_BYTES = CHUNK_SIZE * CHUNK_SIZE // 8
+
+
+class TileBitmap(object):
+    """
+    Done flags of tiles, stored by chunks of CHUNK_SIZE x CHUNK_SIZE tiles
+    allocated on first use, so far apart coverages cost no more than close ones
+    """
+    def __init__(self):
+        self.chunks = {}  # (z, chunk column, chunk row) -> bytearray of the flags
+        self.dirty = set()  # keys of the chunks changed since they were last written
+        self.count = 0
+
+    @staticmethod
+    def _locate(z_x_y):
+        (z, x, y) = z_x_y
+        i = (x % CHUNK_SIZE) * CHUNK_SIZE + (y % CHUNK_SIZE)
+        return (z, x // CHUNK_SIZE, y // CHUNK_SIZE), i >> 3, 1 << (i & 7)
+
+    def load(self, key, bitmap):
+        assert len(bitmap) == CHUNK_BYTES, _("Wrong bitmap size")
+        self.chunks[key] = bytearray(bitmap)
+        self.count += sum(bin(byte).count('1') for byte in bitmap)
+
+    def __contains__(self, z_x_y):
+        key, offset, mask = self._locate(z_x_y)
+        chunk = self.chunks.get(key)
+        return chunk is not None and bool(chunk[offset] & mask)
+
+    def add(self, z_x_y):
+        key, offset, mask = self._locate(z_x_y)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = bytearray(CHUNK_BYTES)
+        elif chunk[offset] & mask:
+            return False
+        chunk[offset] |= mask
+        self.dirty.add(key)
+        self.count += 1
+        return True
+
+
+class JobJournal(object):
+    def __init__(self, path):
+        """
+        Persistent progress of a MBTiles building job: its parameters and
+        the done tiles, stored in a SQLite file. Only the chunks of done
+        tiles changed since the last flush are written.
+        """
+        self.path = path
+        self._con = None
+        self._extents = {}
+        self._bitmap = TileBitmap()
+        self._unflushed = 0
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def open(self, params, extents):
+        """
+        Open the journal of the job described by `params` (JSON-serializable)
+        with tiles within `extents` ({zoom: (xmin, ymin, xmax, ymax)}).
+        Return True if the journal of the same job was found and resumed.
+        """
+        params = json.dumps({'params': params, 'extents': sorted(extents.items())}, sort_keys=True)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self._lock:
+            self._con = sqlite3.connect(self.path, check_same_thread=False)
+            self._con.execute("CREATE TABLE IF NOT EXISTS job (params text)")
+            self._con.execute("""CREATE TABLE IF NOT EXISTS chunks
+                (zoom_level integer, chunk_column integer, chunk_row integer, bitmap blob,
+                 PRIMARY KEY (zoom_level, chunk_column, chunk_row))""")
+            row = self._con.execute("SELECT params FROM job").fetchone()
+            resumed = row is not None and row[0] == params
+            self._extents = dict(extents)
+            self._bitmap = TileBitmap()
+            if resumed:
+                for z, chunk_column, chunk_row, bitmap in self._con.execute(
+                        "SELECT zoom_level, chunk_column, chunk_row, bitmap FROM chunks"):
+                    self._bitmap.load((z, chunk_column, chunk_row), bitmap)
+            else:
+                self._con.execute("DELETE FROM job")
+                self._con.execute("DELETE FROM chunks")
+                self._con.execute("INSERT INTO job (params) VALUES (?)", (params,))
+            self._con.commit()
+        if resumed:
+            Logger.info(_("Resume job from %s, %s tiles done") % (self.path, self.done_count()))
+        return resumed
+
+    def is_done(self, z_x_y):
+        return z_x_y in self._bitmap
+
+    def mark_done(self, z_x_y):
+        (z, x, y) = z_x_y
+        with self._lock:
+            extent = self._extents.get(z)
+            if extent is None:
+                return
+            xmin, ymin, xmax, ymax = extent
+            if not (xmin <= x <= xmax and ymin <= y <= ymax) or not self._bitmap.add((z, x, y)):
+                return
+            self._unflushed += 1
+            flush = (self._unflushed >= FLUSH_EVERY_TILES
+                     or time.monotonic() - self._flushed_at >= FLUSH_EVERY_SECONDS)
+        if flush:
+            self.flush()
+
+    def done_count(self):
+        return self._bitmap.count
+
+    def flush(self):
+        with self._lock:
+            if self._con is None:
+                return
+            self._con.executemany("""INSERT OR REPLACE INTO chunks
+                (zoom_level, chunk_column, chunk_row, bitmap) VALUES (?, ?, ?, ?)""",
+                                  [(*key, sqlite3.Binary(bytes(self._bitmap.chunks[key])))
+                                   for key in self._bitmap.dirty])
+            self._con.commit()
+            self._bitmap.dirty.clear()
+            self._unflushed = 0
+            self._flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._con is not None:
+                self._con.close()
+                self._con = None
+
+    def remove(self):
+        with self._lock:
+            if self._con is not None:
+                self._con.close()
+                self._con = None
+            self._extents = {}
+            self._bitmap = TileBitmap()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -9,14 +9,15 @@
 # for additional reference on schema see:
 # https://github.com/mapbox/node-mbtiles/blob/master/lib/schema.sql
 
-import sqlite3, sys, logging, time, os, json, zlib, re
+import sqlite3, sys, logging, time, os, json, zlib, re, hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 from kivy.logger import Logger
 
 from .utils import flip_y
 
 
-def mbtiles_setup(cur):
+def mbtiles_setup(cur, index=True):
     cur.execute("""
         create table tiles (
             zoom_level integer,
@@ -31,9 +32,71 @@ def mbtiles_setup(cur):
     cur.execute("""CREATE TABLE grid_data (zoom_level integer, tile_column
     integer, tile_row integer, key_name text, key_json text);""")
     cur.execute("""create unique index name on metadata (name);""")
+    if index:
+        mbtiles_create_index(cur)
+
+def mbtiles_create_index(cur):
     cur.execute("""create unique index tile_index on tiles
         (zoom_level, tile_column, tile_row);""")
 
+def mbtiles_setup_dedup(cur):
+    """
+    Same as mbtiles_setup, but every distinct tile content is stored once in
+    `images` (keyed by its hash) and `tiles` is a view over `map` and `images`
+    """
+    cur.execute("""create table metadata
+        (name text, value text);""")
+    cur.execute("""CREATE TABLE grids (zoom_level integer, tile_column integer,
+    tile_row integer, grid blob);""")
+    cur.execute("""CREATE TABLE grid_data (zoom_level integer, tile_column
+    integer, tile_row integer, key_name text, key_json text);""")
+    cur.execute("""create unique index name on metadata (name);""")
+    # text ids: hashes made of digits only must not get integer affinity
+    cur.execute("""
+      CREATE TABLE images (
+        tile_data blob,
+        tile_id text);
+    """)
+    cur.execute("""
+      CREATE TABLE map (
+        zoom_level integer,
+        tile_column integer,
+        tile_row integer,
+        tile_id text);
+    """)
+    cur.execute("""
+          CREATE UNIQUE INDEX map_index on map
+            (zoom_level, tile_column, tile_row);""")
+    cur.execute("""
+          CREATE UNIQUE INDEX images_id on images
+            (tile_id);""")
+    cur.execute("""create view tiles as
+        select map.zoom_level as zoom_level,
+        map.tile_column as tile_column,
+        map.tile_row as tile_row,
+        images.tile_data as tile_data FROM
+        map JOIN images on images.tile_id = map.tile_id;""")
+
+def mbtiles_is_dedup(cur):
+    return cur.execute("""select 1 from sqlite_master
+        where type='table' and name='map'""").fetchone() is not None
+
+def tile_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def insert_tiles_dedup(cur, rows):
+    """
+    Insert `rows` [(z, x, y, tile_hash, data)], storing each content once
+    """
+    cur.executemany("""insert or ignore into images (tile_id, tile_data) values (?, ?)""",
+        [(h, sqlite3.Binary(data)) for z, x, y, h, data in rows])
+    cur.executemany("""insert or replace into map
+        (zoom_level, tile_column, tile_row, tile_id) values (?, ?, ?, ?)""",
+        [(z, x, y, h) for z, x, y, h, data in rows])
+
+def remove_unused_images(cur):
+    cur.execute("""delete from images where tile_id not in (select tile_id from map)""")
+
 def mbtiles_connect(mbtiles_file, silent):
     try:
         con = sqlite3.connect(mbtiles_file)
@@ -49,6 +112,40 @@ def optimize_connection(cur):
     cur.execute("""PRAGMA locking_mode=EXCLUSIVE""")
     cur.execute("""PRAGMA journal_mode=DELETE""")
 
+def safe_connection(cur):
+    """
+    Settings to write into a file that must survive a crash and stay readable meanwhile:
+    every commit is synced to disk, readers are only locked out while it is written
+    """
+    cur.execute("""PRAGMA synchronous=FULL""")
+    cur.execute("""PRAGMA locking_mode=NORMAL""")
+    cur.execute("""PRAGMA journal_mode=DELETE""")
+
+def optimize_bulk_load(cur, cache_size_mb=64, page_size=4096):
+    # page_size only applies to a database without tables yet
+    cur.execute("""PRAGMA page_size=%d""" % page_size)
+    cur.execute("""PRAGMA cache_size=-%d""" % (cache_size_mb * 1024))
+    cur.execute("""PRAGMA temp_store=MEMORY""")
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def insert_tiles(cur, con, executor, batch, dedup=False):
+    """
+    Read the files of `batch` [(z, x, y, path)] in parallel and insert them in one transaction
+    """
+    contents = executor.map(read_file, [path for z, x, y, path in batch])
+    if dedup:
+        insert_tiles_dedup(cur, [(z, x, y, tile_hash(content), content)
+                                 for (z, x, y, path), content in zip(batch, contents)])
+    else:
+        cur.executemany("""insert into tiles (zoom_level,
+            tile_column, tile_row, tile_data) values
+            (?, ?, ?, ?);""",
+            [(z, x, y, sqlite3.Binary(content)) for (z, x, y, path), content in zip(batch, contents)])
+    con.commit()
+
 def compression_prepare(cur, silent):
     if not silent: 
         Logger.debug('Prepare database compression.')
@@ -89,30 +186,29 @@ def compression_do(cur, con, chunk, silent):
     res = cur.fetchone()
     total_tiles = res[0]
     last_id = 0
+    ids = {}  # content hash -> tile_id, shared by all chunks
     logging.debug("%d total tiles to fetch" % total_tiles)
     for i in range(total_tiles // chunk + 1):
         logging.debug("%d / %d rounds done" % (i, (total_tiles / chunk)))
-        ids = []
-        files = []
         start = time.time()
         cur.execute("""select zoom_level, tile_column, tile_row, tile_data
             from tiles where rowid > ? and rowid <= ?""", ((i * chunk), ((i + 1) * chunk)))
         rows = cur.fetchall()
         for r in rows:
             total = total + 1
-            if r[3] in files:
+            h = tile_hash(r[3])
+            if h in ids:
                 overlapping = overlapping + 1
                 start = time.time()
                 query = """insert into map
                     (zoom_level, tile_column, tile_row, tile_id)
                     values (?, ?, ?, ?)"""
-                cur.execute(query, (r[0], r[1], r[2], ids[files.index(r[3])]))
+                cur.execute(query, (r[0], r[1], r[2], ids[h]))
             else:
                 unique = unique + 1
                 last_id += 1
 
-                ids.append(last_id)
-                files.append(r[3])
+                ids[h] = last_id
 
                 start = time.time()
                 query = """insert into images
@@ -156,10 +252,17 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
         Logger.info("Importing disk to MBTiles")
         Logger.debug("%s --> %s" % (directory_path, mbtiles_file))
 
+    batch_size = kwargs.get('batch_size', 1000)
     con = mbtiles_connect(mbtiles_file, silent)
     cur = con.cursor()
     optimize_connection(cur)
-    mbtiles_setup(cur)
+    optimize_bulk_load(cur, kwargs.get('cache_size_mb', 64), kwargs.get('page_size', 4096))
+    dedup = kwargs.get('dedup', False)
+    if dedup:
+        mbtiles_setup_dedup(cur)
+    else:
+        mbtiles_setup(cur, index=False)
+    batch = []
     #~ image_format = 'png'
     image_format = kwargs.get('format', 'png')
 
@@ -179,79 +282,86 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
     start_time = time.time()
     msg = ""
 
-    for zoom_dir in get_dirs(directory_path):
-        if kwargs.get("scheme") == 'ags':
-            if not "L" in zoom_dir:
-                if not silent: 
-                    Logger.warning("You appear to be using an ags scheme on an non-arcgis Server cache.")
-            z = int(zoom_dir.replace("L", ""))
-        elif kwargs.get("scheme") == 'gwc':
-            z=int(zoom_dir[-2:])
-        else:
-            if "L" in zoom_dir:
-                if not silent: 
-                    Logger.warning("You appear to be using a %s scheme on an arcgis Server cache. Try using --scheme=ags instead" % kwargs.get("scheme"))
-            z = int(zoom_dir)
-        for row_dir in get_dirs(os.path.join(directory_path, zoom_dir)):
+    # the pool threads are stopped whether the import succeeds or not
+    with ThreadPoolExecutor(max_workers=kwargs.get('workers', 4)) as executor:
+        for zoom_dir in get_dirs(directory_path):
             if kwargs.get("scheme") == 'ags':
-                y = flip_y(int(row_dir.replace("R", ""), 16), z)
+                if not "L" in zoom_dir:
+                    if not silent: 
+                        Logger.warning("You appear to be using an ags scheme on an non-arcgis Server cache.")
+                z = int(zoom_dir.replace("L", ""))
             elif kwargs.get("scheme") == 'gwc':
-                pass
+                z=int(zoom_dir[-2:])
             else:
-                x = int(row_dir)
-            for current_file in os.listdir(os.path.join(directory_path, zoom_dir, row_dir)):
-                if current_file == ".DS_Store" and not silent:
-                    Logger.warning("Your OS is MacOS,and the .DS_Store file will be ignored.")
+                if "L" in zoom_dir:
+                    if not silent: 
+                        Logger.warning("You appear to be using a %s scheme on an arcgis Server cache. Try using --scheme=ags instead" % kwargs.get("scheme"))
+                z = int(zoom_dir)
+            for row_dir in get_dirs(os.path.join(directory_path, zoom_dir)):
+                if kwargs.get("scheme") == 'ags':
+                    y = flip_y(int(row_dir.replace("R", ""), 16), z)
+                elif kwargs.get("scheme") == 'gwc':
+                    pass
                 else:
-                    file_name, ext = current_file.split('.',1)
-                    f = open(os.path.join(directory_path, zoom_dir, row_dir, current_file), 'rb')
-                    file_content = f.read()
-                    f.close()
-                    if kwargs.get('scheme') == 'xyz':
-                        y = flip_y(int(file_name), int(z))
-                    elif kwargs.get("scheme") == 'ags':
-                        x = int(file_name.replace("C", ""), 16)
-                    elif kwargs.get("scheme") == 'gwc':
-                        x, y = file_name.split('_')
-                        x = int(x)
-                        y = int(y)
+                    x = int(row_dir)
+                for current_file in os.listdir(os.path.join(directory_path, zoom_dir, row_dir)):
+                    if current_file == ".DS_Store" and not silent:
+                        Logger.warning("Your OS is MacOS,and the .DS_Store file will be ignored.")
                     else:
-                        y = int(file_name)
-
-                    if (ext == image_format):
-                        if not silent:
-                            Logger.debug(' Read tile from Zoom (z): %i\tCol (x): %i\tRow (y): %i' % (z, x, y))
-                        cur.execute("""insert into tiles (zoom_level,
-                            tile_column, tile_row, tile_data) values
-                            (?, ?, ?, ?);""",
-                            (z, x, y, sqlite3.Binary(file_content)))
-                        count = count + 1
-                        if (count % 100) == 0:
-                            msg = "%s tiles inserted (%d tiles/sec)" % (count, count / (time.time() - start_time))
-                            Logger.debug(msg)
-                    elif (ext == 'grid.json'):
-                        if not silent:
-                            Logger.debug(' Read grid from Zoom (z): %i\tCol (x): %i\tRow (y): %i' % (z, x, y))
-                        # Remove potential callback with regex
-                        file_content = file_content.decode('utf-8')
-                        has_callback = re.match(r'[\w\s=+-/]+\(({(.|\n)*})\);?', file_content)
-                        if has_callback:
-                            file_content = has_callback.group(1)
-                        utfgrid = json.loads(file_content)
-
-                        data = utfgrid.pop('data')
-                        compressed = zlib.compress(json.dumps(utfgrid).encode())
-                        cur.execute("""insert into grids (zoom_level, tile_column, tile_row, grid) values (?, ?, ?, ?) """, (z, x, y, sqlite3.Binary(compressed)))
-                        grid_keys = [k for k in utfgrid['keys'] if k != ""]
-                        for key_name in grid_keys:
-                            key_json = data[key_name]
-                            cur.execute("""insert into grid_data (zoom_level, tile_column, tile_row, key_name, key_json) values (?, ?, ?, ?, ?);""", (z, x, y, key_name, json.dumps(key_json)))
+                        file_name, ext = current_file.split('.',1)
+                        file_path = os.path.join(directory_path, zoom_dir, row_dir, current_file)
+                        if kwargs.get('scheme') == 'xyz':
+                            y = flip_y(int(file_name), int(z))
+                        elif kwargs.get("scheme") == 'ags':
+                            x = int(file_name.replace("C", ""), 16)
+                        elif kwargs.get("scheme") == 'gwc':
+                            x, y = file_name.split('_')
+                            x = int(x)
+                            y = int(y)
+                        else:
+                            y = int(file_name)
+
+                        if (ext == image_format):
+                            batch.append((z, x, y, file_path))
+                            if len(batch) >= batch_size:
+                                insert_tiles(cur, con, executor, batch, dedup)
+                                count = count + len(batch)
+                                batch = []
+                                if not silent:
+                                    msg = "%s tiles inserted (%d tiles/sec)" % (count, count / (time.time() - start_time))
+                                    Logger.debug(msg)
+                        elif (ext == 'grid.json'):
+                            if not silent:
+                                Logger.debug(' Read grid from Zoom (z): %i\tCol (x): %i\tRow (y): %i' % (z, x, y))
+                            # Remove potential callback with regex
+                            file_content = read_file(file_path).decode('utf-8')
+                            has_callback = re.match(r'[\w\s=+-/]+\(({(.|\n)*})\);?', file_content)
+                            if has_callback:
+                                file_content = has_callback.group(1)
+                            utfgrid = json.loads(file_content)
+
+                            data = utfgrid.pop('data')
+                            compressed = zlib.compress(json.dumps(utfgrid).encode())
+                            cur.execute("""insert into grids (zoom_level, tile_column, tile_row, grid) values (?, ?, ?, ?) """, (z, x, y, sqlite3.Binary(compressed)))
+                            grid_keys = [k for k in utfgrid['keys'] if k != ""]
+                            for key_name in grid_keys:
+                                key_json = data[key_name]
+                                cur.execute("""insert into grid_data (zoom_level, tile_column, tile_row, key_name, key_json) values (?, ?, ?, ?, ?);""", (z, x, y, key_name, json.dumps(key_json)))
+        if batch:
+            insert_tiles(cur, con, executor, batch, dedup)
+            count = count + len(batch)
+    if not dedup:
+        # a tile found twice in the folder (e.g. 1.png and 01.png) is kept once
+        cur.execute("""delete from tiles where rowid not in
+            (select max(rowid) from tiles group by zoom_level, tile_column, tile_row)""")
+        # building the index once after the load is cheaper than updating it per row
+        mbtiles_create_index(cur)
     con.commit()
 
     if not silent:
         Logger.debug('tiles (and grids) inserted.')
 
-    if kwargs.get('compression', False):
+    if kwargs.get('compression', False) and not dedup:
         compression_prepare(cur, silent)
         compression_do(cur, con, 256, silent)
         compression_finalize(cur)
@@ -98,7 +98,11 @@ class GoogleProjection(object):
         lat = 2 * atan(exp(y/EARTH_RADIUS)) - pi/2 * RAD_TO_DEG
         return (lng, lat)
 
-    def tileslist(self, bbox):
+    def tile_ranges(self, bbox):
+        """
+        Return a dict zoom -> (xmin, xmax, ymin, ymax) of the tiles covering
+        `bbox` at each level, max bounds excluded
+        """
         if len(bbox) != 4:
             raise InvalidCoverageError(_("Wrong format of bounding box."))
         xmin, ymin, xmax, ymax = bbox
@@ -112,20 +116,27 @@ class GoogleProjection(object):
         ll0 = (xmin, ymax)  # left top
         ll1 = (xmax, ymin)  # right bottom
 
-        l = []
+        ranges = {}
         for z in self.levels:
             px0 = self.project_pixels(ll0,z)
             px1 = self.project_pixels(ll1,z)
+            x0 = max(0, int(px0[0]/self.tilesize))
+            x1 = min(2**z, int(ceil(px1[0]/self.tilesize)))
+            y0 = max(0, int(px0[1]/self.tilesize))
+            y1 = min(2**z, int(ceil(px1[1]/self.tilesize)))
+            if self.scheme == 'tms':
+                y0, y1 = 2**z - y1, 2**z - y0
+            ranges[z] = (x0, max(x0, x1), y0, max(y0, y1))
+        return ranges
+
+    def iter_tiles(self, bbox):
+        """
+        Yield the (z, x, y) tiles covering `bbox`, zoom level by zoom level
+        """
+        for z, (x0, x1, y0, y1) in self.tile_ranges(bbox).items():
+            for x in range(x0, x1):
+                for y in range(y0, y1):
+                    yield z, x, y
 
-            for x in range(int(px0[0]/self.tilesize),
-                           int(ceil(px1[0]/self.tilesize))):
-                if (x < 0) or (x >= 2**z):
-                    continue
-                for y in range(int(px0[1]/self.tilesize),
-                               int(ceil(px1[1]/self.tilesize))):
-                    if (y < 0) or (y >= 2**z):
-                        continue
-                    if self.scheme == 'tms':
-                        y = ((2**z-1) - y)
-                    l.append((z, x, y))
-        return l
+    def tileslist(self, bbox):
+        return list(self.iter_tiles(bbox))
@@ -0,0 +1,144 @@
+import os
+import threading
+import time
+from gettext import gettext as _
+
+from kivy.logger import Logger
+
+from . import DEFAULT_CACHE_QUOTA_INTERVAL
+from .cache import ContentAddressed, Disk, Sqlite, take_written
+
+""" Eviction frees the cache down to this fraction of the quota, so it does not run on every new tile """
+LOW_WATERMARK = 0.9
+""" Tiles used more recently than this (s) are never evicted: they likely belong to a running build """
+MIN_AGE = 60
+""" The cache is walked again after this time (s), for the tiles saved or removed by other processes """
+RESCAN_INTERVAL = 3600
+
+
+class CacheQuota(object):
+    def __init__(self, folder, max_bytes, interval=None):
+        """
+        Bounds the size of a tiles cache folder by evicting the least recently
+        used tiles from a background thread. Each provider cache removes its own
+        entries (see `Cache.usage`), so databases and lock files in use are kept.
+        The size is that of the cached tiles, without the databases overhead.
+        It is kept as a running total of the tiles saved by this process, the
+        cache being walked only when over the quota or every RESCAN_INTERVAL.
+
+        folder -- root of the tiles cache, shared by all providers
+        max_bytes -- size quota, 0 for no limit
+        interval -- time between two checks of the cache size in s (default DEFAULT_CACHE_QUOTA_INTERVAL)
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        if interval is None:
+            interval = DEFAULT_CACHE_QUOTA_INTERVAL
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._total = None  # running size of the cached tiles in bytes, None until walked
+        self._walked = None  # time of the last walk
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='map-db-cache. Evicting cached tiles',
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.evict()
+            except Exception as e:
+                Logger.warning(_("Cache eviction failed: %s") % e)
+            self._stop_event.wait(self.interval)
+
+    def _caches(self):
+        """
+        Return the caches of the providers folders, one per backend found in each
+        """
+        caches = []
+        try:
+            entries = sorted(os.scandir(self.folder), key=lambda entry: entry.name)
+        except OSError:
+            return caches
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            for cache_class, filename in ((Disk, None), (Sqlite, 'tiles.sqlite'), (ContentAddressed, 'index.sqlite')):
+                if filename and not os.path.exists(os.path.join(entry.path, filename)):
+                    continue
+                cache = cache_class(entry.name, self.folder, extension=None)
+                if os.path.normcase(cache.folder) == os.path.normcase(entry.path):
+                    caches.append(cache)
+        return caches
+
+    def _entries(self, caches):
+        """
+        Return the list of (last use time, size, cache, key) of the entries of `caches`
+        """
+        return [(last_use, size, cache, key) for cache in caches for last_use, size, key in cache.usage()]
+
+    def size(self):
+        """
+        Return the size of the cached tiles in bytes
+        """
+        caches = self._caches()
+        try:
+            return sum(entry[1] for entry in self._entries(caches))
+        finally:
+            for cache in caches:
+                cache.close()
+
+    def evict(self):
+        """
+        Remove the least recently used tiles until the cache fits in its quota.
+        Return the number of bytes freed
+        """
+        if not self.max_bytes or not os.path.isdir(self.folder):
+            return 0
+        written = take_written(self.folder)
+        if self._total is not None and time.monotonic() - self._walked < RESCAN_INTERVAL:
+            self._total += written
+            if self._total <= self.max_bytes:
+                return 0
+        caches = self._caches()
+        try:
+            entries = self._entries(caches)
+            total = sum(entry[1] for entry in entries)
+            self._walked = time.monotonic()
+            self._total = total
+            if total <= self.max_bytes:
+                return 0
+            target = self.max_bytes * LOW_WATERMARK
+            now = time.time()
+            freed = 0
+            evicted = {}  # cache -> keys of its entries to remove
+            for last_use, size, cache, key in sorted(entries, key=lambda entry: entry[0]):
+                if total - freed <= target or now - last_use < MIN_AGE:
+                    break
+                evicted.setdefault(cache, []).append(key)
+                freed += size
+            for cache, keys in evicted.items():
+                if self._stop_event.is_set():
+                    break
+                cache.evict(keys)
+            else:
+                self._total -= freed
+        finally:
+            for cache in caches:
+                cache.close()
+        Logger.info(_("Evicted %.1f MB from cache %s") % (freed / 1024 / 1024, self.folder))
+        return freed
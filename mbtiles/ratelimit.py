@@ -0,0 +1,72 @@
+import threading
+import time
+
+from . import DEFAULT_RATE_BURST
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        """
+        Limits the rate of requests shared by many threads.
+
+        rate -- average number of requests per s, 0 or None for no limit
+        burst -- number of requests allowed at once after idle time (default DEFAULT_RATE_BURST)
+        """
+        self._lock = threading.Lock()
+        self.rate = None
+        self.burst = None
+        self._tokens = None  # full until configured
+        self._updated = time.monotonic()
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst=None):
+        if burst is None:
+            burst = DEFAULT_RATE_BURST
+        with self._lock:
+            self.rate = rate or 0
+            self.burst = max(1, burst)
+            if self.rate and self._tokens is not None:
+                self._tokens = min(self._tokens, self.burst)
+            else:
+                self._tokens = self.burst
+
+    def reserve(self, tokens=1):
+        """
+        Take `tokens` from the bucket, return time in s to wait before using them
+        """
+        with self._lock:
+            if not self.rate:
+                return 0
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens  # may go below zero, later callers wait longer
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self, tokens=1):
+        """
+        Block until `tokens` requests are allowed
+        """
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(key, rate, burst=None):
+    """
+    Return the token bucket shared by all requests to `key` (provider host),
+    reconfigured with `rate` and `burst`
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = TokenBucket(rate, burst)
+        elif (limiter.rate, limiter.burst) != (rate or 0, max(1, burst or DEFAULT_RATE_BURST)):
+            limiter.configure(rate, burst)
+        return limiter
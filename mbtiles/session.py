@@ -0,0 +1,79 @@
+import threading
+import time
+from contextlib import contextmanager
+from gettext import gettext as _
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from kivy.logger import Logger
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+from . import DEFAULT_POOL_MAXSIZE, DEFAULT_POOL_IDLE_TIMEOUT
+
+
+class SessionPool(object):
+    def __init__(self, pool_maxsize=None, idle_timeout=None):
+        """
+        Keeps one keep-alive `requests.Session` per tiles host, shared between threads.
+
+        pool_maxsize -- max number of open connections per host (default DEFAULT_POOL_MAXSIZE)
+        idle_timeout -- close host connections unused for this time in s (default DEFAULT_POOL_IDLE_TIMEOUT)
+        """
+        if pool_maxsize is None:
+            pool_maxsize = DEFAULT_POOL_MAXSIZE
+        self.pool_maxsize = pool_maxsize
+        if idle_timeout is None:
+            idle_timeout = DEFAULT_POOL_IDLE_TIMEOUT
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._sessions = {}  # host -> [session, users count, last use time]
+
+    @contextmanager
+    def session(self, url):
+        """
+        Borrow the session of the `url` host
+        """
+        host = urlparse(url).netloc
+        with self._lock:
+            self._close_idle()
+            entry = self._sessions.get(host)
+            if entry is None:
+                Logger.debug(_("Open connection pool to %s") % host)
+                entry = self._sessions[host] = [self._create_session(), 0, 0]
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                entry[2] = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            for session, _users, _last_use in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, pool_block=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _close_idle(self):
+        now = time.monotonic()
+        for host, (session, users, last_use) in list(self._sessions.items()):
+            if not users and now - last_use > self.idle_timeout:
+                Logger.debug(_("Close idle connection pool to %s") % host)
+                session.close()
+                del self._sessions[host]
+
+
+""" Connection pools shared by all tile downloaders """
+SESSION_POOL = SessionPool()
@@ -1,5 +1,6 @@
 import os
 import sqlite3
+import threading
 import time
 import requests
 
@@ -16,8 +17,37 @@ except ImportError:
     from urllib import urlencode
     from urllib2 import urlopen, Request
 
+from .concurrency import THROTTLE_STATUS_CODES, is_permanent_error, parse_retry_after
+from .ratelimit import get_limiter
+from .session import SESSION_POOL
 from .utils import flip_y
-from . import DEFAULT_TILE_SIZE, DEFAULT_DOWNLOAD_RETRIES, DEFAULT_TIMEOUT
+from . import DEFAULT_TILE_SIZE, DEFAULT_DOWNLOAD_RETRIES, DEFAULT_RATE_LIMIT, DEFAULT_REQUEST_TIMEOUT
+
+
+def conditional_headers(meta):
+    """
+    Return the HTTP headers asking to send a tile only if it changed since `meta`
+    """
+    headers = {}
+    if meta:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+
+def response_meta(headers, previous=None):
+    """
+    Return the freshness metadata of a tile fetched now with the response `headers`,
+    keeping the validators of `previous` metadata the response does not repeat
+    """
+    previous = previous or {}
+    return {
+        'fetched': time.time(),
+        'etag': headers.get('ETag') or previous.get('etag'),
+        'last_modified': headers.get('Last-Modified') or previous.get('last_modified'),
+    }
 
 
 class TileSource(object):
@@ -30,6 +60,13 @@ class TileSource(object):
     def tile(self, z, x, y):
         raise NotImplementedError
 
+    def tile_with_meta(self, z, x, y, meta=None):
+        """
+        Return the tile content and its freshness metadata (fetch time, HTTP validators).
+        The content is None if the tile did not change since `meta` of a cached copy.
+        """
+        return self.tile(z, x, y), {'fetched': time.time()}
+
     def metadata(self):
         return dict()
 
@@ -41,20 +78,42 @@ class MBTilesReader(TileSource):
         self.basename = os.path.basename(self.filename)
         self._con = None
         self._cur = None
+        self._table = None
+        self._lock = threading.Lock()  # readers may be shared by downloading threads
 
     def _query(self, sql, *args):
-        """ Executes the specified `sql` query and returns the cursor """
-        if not self._con:
-            Logger.debug(_("Open MBTiles file '%s'") % self.filename)
-            self._con = sqlite3.connect(self.filename)
-            self._cur = self._con.cursor()
-        sql = ' '.join(sql.split())
-        Logger.debug(_("Execute query '%s' %s") % (sql, args))
-        try:
-            self._cur.execute(sql, *args)
-        except (sqlite3.OperationalError, sqlite3.DatabaseError)as e:
-            raise InvalidFormatError(_("%s while reading %s") % (e, self.filename))
-        return self._cur
+        """ Executes the specified `sql` query and returns the rows """
+        with self._lock:
+            if not self._con:
+                Logger.debug(_("Open MBTiles file '%s'") % self.filename)
+                self._con = sqlite3.connect(self.filename, check_same_thread=False)
+                self._cur = self._con.cursor()
+            sql = ' '.join(sql.split())
+            Logger.debug(_("Execute query '%s' %s") % (sql, args))
+            try:
+                return self._cur.execute(sql, *args).fetchall()
+            except (sqlite3.OperationalError, sqlite3.DatabaseError)as e:
+                raise InvalidFormatError(_("%s while reading %s") % (e, self.filename))
+
+    def _iter_query(self, sql, *args, batch_size=1000):
+        """ Executes the specified `sql` query and yields its rows, fetched by batches """
+        with self._lock:
+            if not self._con:
+                Logger.debug(_("Open MBTiles file '%s'") % self.filename)
+                self._con = sqlite3.connect(self.filename, check_same_thread=False)
+                self._cur = self._con.cursor()
+            sql = ' '.join(sql.split())
+            Logger.debug(_("Execute query '%s' %s") % (sql, args))
+            try:
+                cursor = self._con.execute(sql, *args)
+            except (sqlite3.OperationalError, sqlite3.DatabaseError)as e:
+                raise InvalidFormatError(_("%s while reading %s") % (e, self.filename))
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
 
     def metadata(self):
         rows = self._query('SELECT name, value FROM metadata')
@@ -65,63 +124,153 @@ class MBTilesReader(TileSource):
         rows = self._query('SELECT DISTINCT(zoom_level) FROM tiles ORDER BY zoom_level')
         return [int(row[0]) for row in rows]
 
+    def _tiles_table(self):
+        # the `tiles` view of deduplicated files joins the blobs, `map` alone is enough
+        if self._table is None:
+            is_dedup = self._query("SELECT 1 FROM sqlite_master WHERE type='table' AND name='map'")
+            self._table = 'map' if is_dedup else 'tiles'
+        return self._table
+
+    def tileslist(self):
+        """
+        Return the list of (z, x, y) tuples (XYZ scheme) of stored tiles
+        """
+        rows = self._query('SELECT zoom_level, tile_column, tile_row FROM %s' % self._tiles_table())
+        return [(z, x, flip_y(y, z)) for z, x, y in rows]
+
+    def iter_tiles(self, scheme='xyz'):
+        """
+        Yield the (z, x, y) of stored tiles (y in `scheme`: 'tms', or XYZ for any other
+        such as 'xyz' or 'wmts') sorted by zoom level, column and row, without loading them all
+        """
+        tms = scheme == 'tms'
+        order = 'ASC' if tms else 'DESC'
+        rows = self._iter_query('SELECT zoom_level, tile_column, tile_row FROM %s '
+                                'ORDER BY zoom_level, tile_column, tile_row %s' % (self._tiles_table(), order))
+        for z, x, y in rows:
+            yield z, x, (y if tms else flip_y(y, z))
+
+    def close(self):
+        with self._lock:
+            if self._con:
+                self._con.close()
+                self._con = None
+                self._cur = None
+                self._table = None
+
+    def has_tile(self, z, x, y):
+        """
+        Return True if the tile (XYZ scheme) is stored, without reading it
+        """
+        tms_y = flip_y(int(y), int(z))
+        rows = self._query('SELECT 1 FROM %s WHERE zoom_level=? AND tile_column=? AND tile_row=? LIMIT 1'
+                           % self._tiles_table(), (z, x, tms_y))
+        return bool(rows)
+
     def tile(self, z, x, y):
         Logger.debug(_("Extract tile %s") % ((z, x, y),))
         tms_y = flip_y(int(y), int(z))
         rows = self._query('''SELECT tile_data FROM tiles
                               WHERE zoom_level=? AND tile_column=? AND tile_row=?;''', (z, x, tms_y))
-        t = rows.fetchone()
-        if not t:
+        if not rows:
             raise ExtractionError(_("Could not extract tile %s from %s") % ((z, x, y), self.filename))
-        return t[0]
+        return rows[0][0]
 
 
 class TileDownloader(TileSource):
-    def __init__(self, url, timeout=None, download_retries=None, headers=None, subdomains=None, tilesize=None):
+    def __init__(self, url, rate_limit=None, rate_burst=None, download_retries=None, headers=None, subdomains=None,
+                 tilesize=None, session_pool=None, request_timeout=None):
         super(TileDownloader, self).__init__(tilesize)
         self.tiles_url = url
-        if timeout is None:
-            timeout = DEFAULT_TIMEOUT
-        self.timeout = timeout
+        if rate_limit is None:
+            rate_limit = DEFAULT_RATE_LIMIT
         if download_retries is None:
             download_retries = DEFAULT_DOWNLOAD_RETRIES
         self.download_retries = download_retries
+        if request_timeout is None:
+            request_timeout = DEFAULT_REQUEST_TIMEOUT
+        self.request_timeout = request_timeout
         self.tiles_subdomains = subdomains or ['a', 'b', 'c']
         parsed = urlparse(self.tiles_url)
         self.basename = parsed.netloc+parsed.path
         self.headers = headers or {}
+        # shared by all downloaders of the provider host, whatever the subdomain
+        self.limiter = get_limiter(parsed.netloc, rate_limit, rate_burst)
+        self.session_pool = session_pool or SESSION_POOL
+        self.concurrency = None  # optional AdaptiveLimit of parallel requests
 
-    def tile(self, z, x, y):
+    def tile_url(self, z, x, y):
         """
-        Download the specified tile from `tiles_url`
+        Render each keyword in URL ({s}, {x}, {y}, {z}, {size} ... )
         """
-        Logger.debug(_("Download tile %s") % ((z, x, y),))
-        # Render each keyword in URL ({s}, {x}, {y}, {z}, {size} ... )
         size = self.tilesize
         s = self.tiles_subdomains[(x + y) % len(self.tiles_subdomains)]
         try:
-            url = self.tiles_url.format(s=s, x=x, y=y, z=z, size=size)
+            return self.tiles_url.format(s=s, x=x, y=y, z=z, size=size)
         except KeyError as e:
             raise DownloadError(_("Unknown keyword %s in URL") % e)
 
+    def tile(self, z, x, y):
+        """
+        Download the specified tile from `tiles_url`
+        """
+        return self.tile_with_meta(z, x, y)[0]
+
+    def tile_with_meta(self, z, x, y, meta=None):
+        """
+        Download the specified tile from `tiles_url`, only if it changed since `meta`
+        """
+        Logger.debug(_("Download tile %s") % ((z, x, y),))
+        url = self.tile_url(z, x, y)
+        headers = conditional_headers(meta)
+
         Logger.debug(_("Retrieve tile at %s") % url)
         r = self.download_retries
         sleeptime = 1
+        error = None
         while r >= 0:
             try:
-                time.sleep(self.timeout)
-                request = requests.get(url, headers=self.headers)
+                request = self._get(url, headers)
                 if request.status_code == 200:
-                    return request.content
+                    return request.content, response_meta(request.headers)
+                if request.status_code == 304 and headers:
+                    Logger.debug(_("Tile %s did not change") % ((z, x, y),))
+                    return None, response_meta(request.headers, meta)
                 raise DownloadError(
                     _("Status code : %s, url : %s") % (request.status_code, url),
-                    status_code=request.status_code
+                    status_code=request.status_code,
+                    retry_after=parse_retry_after(request.headers.get('Retry-After')),
                 )
-            except (requests.exceptions.ConnectionError, DownloadError) as e:
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, DownloadError) as e:
                 Logger.debug(_("Download error, retry (%s left). (%s)") % (r, e))
+                error = e
                 r -= 1
-                time.sleep(sleeptime)
+                if r < 0 or is_permanent_error(getattr(e, 'status_code', None)):
+                    break
+                time.sleep(getattr(e, 'retry_after', None) or sleeptime)
                 # progressivly sleep longer to wait for this tile
                 if (sleeptime <= 10) and (r % 2 == 0):
                     sleeptime += 1  # increase wait
-        raise DownloadError(_("Cannot download URL %s") % url)
+        raise DownloadError(_("Cannot download URL %s") % url,
+                            status_code=getattr(error, 'status_code', None),
+                            retry_after=getattr(error, 'retry_after', None))
+
+    def _get(self, url, headers=None):
+        """
+        Request `url` within the rate and parallel requests limits
+        """
+        headers = dict(self.headers, **headers) if headers else self.headers
+        self.limiter.acquire()
+        concurrency = self.concurrency
+        if concurrency is None:
+            with self.session_pool.session(url) as session:
+                return session.get(url, headers=headers, timeout=self.request_timeout)
+        with concurrency:
+            start_time = time.monotonic()
+            with self.session_pool.session(url) as session:
+                request = session.get(url, headers=headers, timeout=self.request_timeout)
+        if request.status_code in THROTTLE_STATUS_CODES:
+            concurrency.on_throttle(parse_retry_after(request.headers.get('Retry-After')))
+        elif request.status_code in (200, 304):
+            concurrency.on_success(time.monotonic() - start_time)
+        return request
@@ -0,0 +1,220 @@
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import CancelledError
+from gettext import gettext as _
+
+from kivy.logger import Logger
+
+from . import (DEFAULT_ASYNC_CONCURRENCY, DEFAULT_ASYNC_HOST_CONCURRENCY,
+               DEFAULT_POOL_IDLE_TIMEOUT, DEFAULT_CONNECTION_MAX_TIMEOUT)
+from .concurrency import THROTTLE_STATUS_CODES, is_permanent_error, parse_retry_after
+from .exceptions import DownloadError
+from .sources import TileDownloader, conditional_headers, response_meta
+
+has_aiohttp = False
+try:
+    import aiohttp
+    has_aiohttp = True
+except ImportError:
+    pass
+
+
+class EventLoopThread(object):
+    """
+    Runs an asyncio event loop in a daemon thread
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(
+            target=self.loop.run_forever,
+            name='map-db-cache. Asynchronous downloading',
+            daemon=True
+        ).start()
+
+    @classmethod
+    def shared(cls):
+        """
+        Return the event loop thread shared by all asynchronous downloaders
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def submit(self, coro):
+        """
+        Schedule `coro` in the loop, return a `concurrent.futures.Future`
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+class AsyncTileDownloader(TileDownloader):
+    def __init__(self, url, max_concurrency=None, host_concurrency=None, request_timeout=None, **kwargs):
+        """
+        Downloads tiles on a single asyncio event loop, keeping many requests in flight.
+        The synchronous `tile` method waits for the result in the calling thread.
+
+        max_concurrency -- max number of requests in flight (default DEFAULT_ASYNC_CONCURRENCY)
+        host_concurrency -- max number of requests in flight per host (default DEFAULT_ASYNC_HOST_CONCURRENCY)
+        request_timeout -- timeout of a single request in s (default DEFAULT_REQUEST_TIMEOUT)
+        """
+        assert has_aiohttp, _("Cannot download asynchronously without python aiohttp")
+        super(AsyncTileDownloader, self).__init__(url, request_timeout=request_timeout, **kwargs)
+        if max_concurrency is None:
+            max_concurrency = DEFAULT_ASYNC_CONCURRENCY
+        self.max_concurrency = max_concurrency
+        if host_concurrency is None:
+            host_concurrency = DEFAULT_ASYNC_HOST_CONCURRENCY
+        self.host_concurrency = host_concurrency
+        self._loop_thread = EventLoopThread.shared()
+        self._session = None
+        self._prefetched = {}
+        self._prefetched_lock = threading.Lock()
+        self._slot_condition = asyncio.Condition()  # notified when a `concurrency` slot is released
+
+    async def _get_session(self):
+        # always called from the loop thread, so no locking is needed
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency,
+                limit_per_host=self.host_concurrency,
+                keepalive_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+            )
+        return self._session
+
+    async def fetch(self, z, x, y, meta=None):
+        """
+        Download the specified tile if it changed since `meta`, retrying with exponential backoff.
+        Return the content (None if unchanged) and its freshness metadata
+        """
+        url = self.tile_url(z, x, y)
+        Logger.debug(_("Retrieve tile at %s") % url)
+        headers = conditional_headers(meta)
+        status_code = None
+        retry_after = None
+        sleeptime = 0.5
+        for r in range(self.download_retries, -1, -1):
+            try:
+                status, content, response_headers = await self._get(url, headers)
+                if status == 304:
+                    return None, response_meta(response_headers, meta)
+                return content, response_meta(response_headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError, DownloadError) as e:
+                Logger.debug(_("Download error, retry (%s left). (%s)") % (r, e))
+                status_code = getattr(e, 'status_code', None)
+                retry_after = getattr(e, 'retry_after', None)
+                if is_permanent_error(status_code):
+                    break
+                if r:
+                    await asyncio.sleep(retry_after or sleeptime * random.uniform(0.5, 1.5))
+                    sleeptime = min(sleeptime * 2, DEFAULT_CONNECTION_MAX_TIMEOUT)
+        raise DownloadError(_("Cannot download URL %s") % url, status_code=status_code, retry_after=retry_after)
+
+    async def _get(self, url, headers=None):
+        """
+        Request `url` within the rate and parallel requests limits,
+        return its status (200 or 304 to a conditional request), content and headers
+        """
+        conditional = bool(headers)
+        headers = dict(self.headers, **headers) if headers else self.headers
+        session = await self._get_session()
+        delay = self.limiter.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        concurrency = self.concurrency
+        if concurrency is not None:
+            await self._acquire_slot(concurrency)
+        try:
+            start_time = time.monotonic()
+            async with session.get(url, headers=headers) as response:
+                if response.status == 200 or (response.status == 304 and conditional):
+                    content = await response.read()
+                    if concurrency is not None:
+                        concurrency.on_success(time.monotonic() - start_time)
+                    return response.status, content, response.headers
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if concurrency is not None and response.status in THROTTLE_STATUS_CODES:
+                    concurrency.on_throttle(retry_after)
+                raise DownloadError(
+                    _("Status code : %s, url : %s") % (response.status, url),
+                    status_code=response.status,
+                    retry_after=retry_after,
+                )
+        finally:
+            if concurrency is not None:
+                concurrency.release()
+                async with self._slot_condition:
+                    self._slot_condition.notify()
+
+    async def _acquire_slot(self, concurrency):
+        """
+        Wait for a free slot of the `concurrency` limit, woken by released slots
+        or at the end of a throttling pause
+        """
+        async with self._slot_condition:
+            while not concurrency.try_acquire():
+                try:
+                    await asyncio.wait_for(self._slot_condition.wait(), concurrency.paused_for() or None)
+                except asyncio.TimeoutError:
+                    pass
+
+    def submit(self, z, x, y, meta=None):
+        """
+        Schedule download of the specified tile, return a `concurrent.futures.Future`
+        of its content and freshness metadata
+        """
+        return self._loop_thread.submit(self.fetch(z, x, y, meta))
+
+    def prefetch(self, z, x, y):
+        """
+        Start downloading the specified tile before `tile` asks for it
+        """
+        with self._prefetched_lock:
+            if (z, x, y) not in self._prefetched:
+                self._prefetched[(z, x, y)] = self.submit(z, x, y)
+
+    def discard_prefetch(self, z, x, y):
+        """
+        Cancel the download of the specified tile started by `prefetch`, if any
+        """
+        with self._prefetched_lock:
+            future = self._prefetched.pop((z, x, y), None)
+        if future is not None:
+            future.cancel()
+
+    def cancel_prefetch(self):
+        with self._prefetched_lock:
+            for future in self._prefetched.values():
+                future.cancel()
+            self._prefetched.clear()
+
+    def tile(self, z, x, y):
+        return self.tile_with_meta(z, x, y)[0]
+
+    def tile_with_meta(self, z, x, y, meta=None):
+        future = None
+        if meta is None:  # only missing tiles are prefetched
+            with self._prefetched_lock:
+                future = self._prefetched.pop((z, x, y), None)
+        if future is None:
+            Logger.debug(_("Download tile %s") % ((z, x, y),))
+            future = self.submit(z, x, y, meta)
+        try:
+            return future.result()
+        except CancelledError:
+            raise DownloadError(_("Download of tile %s was cancelled") % ((z, x, y),))
+
+    def close(self):
+        self.cancel_prefetch()
+        if self._session is not None:
+            self._loop_thread.submit(self._session.close()).result()
+            self._session = None
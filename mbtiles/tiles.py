@@ -1,11 +1,14 @@
+import glob
 import json
 import mimetypes
 import os
 import random
 import shutil
 import sys
+import threading
 import time
 import uuid
+from concurrent.futures import Future
 from gettext import gettext as _
 from io import BytesIO
 
@@ -13,14 +16,23 @@ from kivy.logger import Logger
 
 from . import (DEFAULT_TILES_URL, DEFAULT_TILES_SUBDOMAINS,
                DEFAULT_TMP_DIR, DEFAULT_FILEPATH, DEFAULT_TILE_SIZE,
-               DEFAULT_TILE_FORMAT, DEFAULT_TILE_SCHEME, DEFAULT_TIMEOUT,
-               DEFAULT_DOWNLOAD_RETRIES, MAX_DOWNLOAD_TIME)
-from .cache import Disk, Dummy
-from .exceptions import EmptyCoverageError
+               DEFAULT_TILE_FORMAT, DEFAULT_TILE_SCHEME, DEFAULT_RATE_LIMIT,
+               DEFAULT_DOWNLOAD_RETRIES, DEFAULT_CACHE_BACKEND, DEFAULT_MEMORY_CACHE_MB,
+               DEFAULT_CACHE_TTL, DEFAULT_META_BACKFILL_BATCH_SIZE, DEFAULT_MISSING_STATUS_CODES,
+               DEFAULT_MISSING_TTL, DEFAULT_TILES_ORDER, MAX_DOWNLOAD_TIME, DEFAULT_CACHE_SHARED)
+from .cache import ContentAddressed, Disk, Dummy, Memory, Sqlite
+from .concurrency import THROTTLE_STATUS_CODES
+from .coverage import corridor_polygons, polygons_bounds, polygons_tileset
+from .exceptions import (EmptyCoverageError, DownloadError, TileNotFoundError, ExtractionError, InvalidFormatError,
+                         UpdateMismatchError)
+from .journal import JobJournal
 from .mbutil import disk_to_mbtiles
 from .proj import GoogleProjection
 from .sources import TileDownloader, MBTilesReader
-from .utils import tile_to_latlon
+from .sources_async import AsyncTileDownloader, has_aiohttp
+from .tileset import TileSet
+from .utils import tile_to_latlon, flip_y
+from .writer import MBTilesWriter
 
 has_pil = False
 try:
@@ -35,6 +47,14 @@ except ImportError:
         pass
 
 
+def _same_format(format1, format2):
+    """
+    Return whether the `format` metadata of MBTiles files are the same image format
+    """
+    aliases = {'jpg': 'jpeg'}
+    return aliases.get(format1, format1) == aliases.get(format2, format2)
+
+
 class TilesManager(object):
 
     def __init__(self, **kwargs):
@@ -44,17 +64,43 @@ class TilesManager(object):
 
         Keyword arguments:
         cache -- use a local cache to share tiles between runs (default True)
+        cache_backend -- 'disk' (file per tile), 'sqlite' (database per provider)
+                         or 'dedup' (file per distinct tile content)
+                         (default DEFAULT_CACHE_BACKEND)
+        memory_cache_mb -- keep recently used tiles of the cache in memory up to this size, 0 to disable
+                           (default DEFAULT_MEMORY_CACHE_MB)
+        cache_ttl -- revalidate cached tiles older than this time in s with conditional requests,
+                     0 to use them forever (default DEFAULT_CACHE_TTL)
+        missing_status_codes -- HTTP status codes of the provider meaning it has no tile there
+                                (default DEFAULT_MISSING_STATUS_CODES)
+        missing_ttl -- time during which a missing tile is not requested again in s, 0 to always request it
+                       (default DEFAULT_MISSING_TTL)
+        cache_shared -- the cache folder is used by other processes at the same time: lock tiles
+                        while they are fetched so that a single process downloads each (default DEFAULT_CACHE_SHARED)
 
         tiles_dir -- Local folder containing existing tiles if cache is
                      True, or where temporary tiles will be written otherwise
                      (default DEFAULT_TMP_DIR)
 
         tiles_url -- remote URL to download tiles (*default DEFAULT_TILES_URL*)
-        timeout -- timeout between tiles downloading requests (default DEFAULT_TIMEOUT)
+        rate_limit -- max average number of requests per s to the tiles host, 0 for no limit
+                      (default DEFAULT_RATE_LIMIT)
+        rate_burst -- number of requests allowed at once after idle time (default DEFAULT_RATE_BURST)
         tiles_headers -- HTTP headers to send (*default empty*)
+        session_pool -- keep-alive connection pools to download with (default SESSION_POOL)
+        async_download -- download tiles on an asyncio event loop (default False)
+        max_concurrency -- max number of asynchronous requests in flight (default DEFAULT_ASYNC_CONCURRENCY)
+        host_concurrency -- max number of asynchronous requests in flight per host
+                            (default DEFAULT_ASYNC_HOST_CONCURRENCY)
 
 
         mbtiles_file -- A MBTiles file providing tiles (*to extract its tiles*)
+        mbtiles_sources -- MBTiles files, or folders of them, to take tiles from before downloading them.
+                           Only files of the same tile format built from the same `tiles_url` are used.
+                           A file without `source` metadata (built by earlier versions) is used if it is
+                           listed itself rather than through its folder, or if it has the same
+                           attribution as the tiles (*default empty*)
+        attribution -- attribution of the tiles provider (*default None*)
 
         tile_size -- default tile size (default DEFAULT_TILE_SIZE)
         tile_format -- default tile format (default DEFAULT_TILE_FORMAT)
@@ -67,12 +113,22 @@ class TilesManager(object):
         # Tiles Download
         self.tiles_url = kwargs.get('tiles_url', DEFAULT_TILES_URL)
         self.tiles_subdomains = kwargs.get('tiles_subdomains', DEFAULT_TILES_SUBDOMAINS)
-        self.timeout = kwargs.get('timeout', DEFAULT_TIMEOUT)
+        self.rate_limit = kwargs.get('rate_limit', DEFAULT_RATE_LIMIT)
+        self.rate_burst = kwargs.get('rate_burst')
         self.download_retries = kwargs.get('download_retries', DEFAULT_DOWNLOAD_RETRIES)
         self.tiles_headers = kwargs.get('tiles_headers')
+        self.async_download = kwargs.get('async_download', False)
 
         # MBTiles reading
         self.mbtiles_file = kwargs.get('mbtiles_file')
+        self.mbtiles_sources = kwargs.get('mbtiles_sources') or []
+        self.attribution = kwargs.get('attribution')
+        self._local_readers = None
+        self._local_readers_lock = threading.Lock()
+        self._inflight = {}  # (z, x, y) -> Future of the tile being fetched
+        self._inflight_lock = threading.Lock()
+        self._meta_backfill = {}  # (z, x, y) -> fetch time of cached tiles without metadata, not saved yet
+        self._meta_backfill_lock = threading.Lock()
 
         if self.mbtiles_file:
             self.reader = MBTilesReader(self.mbtiles_file, self.tile_size)
@@ -81,12 +137,27 @@ class TilesManager(object):
             if mimetype and mimetype != self.tile_format:
                 self.tile_format = mimetype
                 Logger.info(_("Tile format set to %s") % self.tile_format)
-            self.reader = TileDownloader(self.tiles_url,
-                                         timeout=self.timeout,
-                                         download_retries=self.download_retries,
-                                         headers=self.tiles_headers,
-                                         subdomains=self.tiles_subdomains,
-                                         tilesize=self.tile_size)
+            if self.async_download and not has_aiohttp:
+                Logger.warning(_("Cannot download asynchronously without python aiohttp, download with threads"))
+            if self.async_download and has_aiohttp:
+                self.reader = AsyncTileDownloader(self.tiles_url,
+                                                  max_concurrency=kwargs.get('max_concurrency'),
+                                                  host_concurrency=kwargs.get('host_concurrency'),
+                                                  rate_limit=self.rate_limit,
+                                                  rate_burst=self.rate_burst,
+                                                  download_retries=self.download_retries,
+                                                  headers=self.tiles_headers,
+                                                  subdomains=self.tiles_subdomains,
+                                                  tilesize=self.tile_size)
+            else:
+                self.reader = TileDownloader(self.tiles_url,
+                                             rate_limit=self.rate_limit,
+                                             rate_burst=self.rate_burst,
+                                             download_retries=self.download_retries,
+                                             headers=self.tiles_headers,
+                                             subdomains=self.tiles_subdomains,
+                                             tilesize=self.tile_size,
+                                             session_pool=kwargs.get('session_pool'))
 
         # Tile files extensions
         self._tile_extension = mimetypes.guess_extension(self.tile_format, strict=False)
@@ -96,10 +167,19 @@ class TilesManager(object):
 
         # Cache
         tiles_dir = kwargs.get('tiles_dir', DEFAULT_TMP_DIR)
+        self.cache_backend = kwargs.get('cache_backend', DEFAULT_CACHE_BACKEND)
+        self.cache_ttl = kwargs.get('cache_ttl', DEFAULT_CACHE_TTL)
+        self.missing_status_codes = kwargs.get('missing_status_codes', DEFAULT_MISSING_STATUS_CODES)
+        self.missing_ttl = kwargs.get('missing_ttl', DEFAULT_MISSING_TTL)
         if kwargs.get('cache', True):
-            self.cache = Disk(self.reader.basename, tiles_dir, extension=self._tile_extension)
+            cache_class = {'disk': Disk, 'sqlite': Sqlite, 'dedup': ContentAddressed}[self.cache_backend]
+            self.cache = cache_class(self.reader.basename, tiles_dir, extension=self._tile_extension,
+                                     shared=kwargs.get('cache_shared', DEFAULT_CACHE_SHARED))
             if kwargs.get('cache_scheme'):
                 self.cache.scheme = kwargs.get('cache_scheme')
+            memory_cache_mb = kwargs.get('memory_cache_mb', DEFAULT_MEMORY_CACHE_MB)
+            if memory_cache_mb:
+                self.cache = Memory(self.cache, int(memory_cache_mb * 1024 * 1024))
         else:
             self.cache = Dummy(extension=self._tile_extension)
 
@@ -112,6 +192,101 @@ class TilesManager(object):
         proj = GoogleProjection(self.tile_size, zoomlevels, self.tile_scheme)
         return proj.tileslist(bbox)
 
+    def _get_local_readers(self):
+        with self._local_readers_lock:
+            if self._local_readers is None:
+                self._local_readers = self._open_local_readers()
+            return self._local_readers
+
+    def _open_local_readers(self):
+        """
+        Return readers of the `mbtiles_sources` files built from the same tiles source
+        """
+        if self.mbtiles_file:
+            return []
+        paths = []
+        for path in self.mbtiles_sources:
+            if os.path.isdir(path):
+                paths.extend((found, False) for found in sorted(glob.glob(os.path.join(path, '*.mbtiles'))))
+            else:
+                paths.append((path, True))
+        readers = []
+        for path, listed in paths:
+            reader = MBTilesReader(path, self.tile_size)
+            try:
+                metadata = reader.metadata()
+            except InvalidFormatError as e:
+                Logger.warning(e)
+                metadata = {}
+            if self._same_tiles(metadata, listed):
+                Logger.info(_("Reuse tiles of %s") % path)
+                readers.append(reader)
+            else:
+                reader.close()
+        return readers
+
+    def _same_tiles(self, metadata, listed):
+        """
+        Return whether the tiles of a MBTiles file of `metadata` are those of `tiles_url`.
+        The source of files without `source` metadata is unknown, they are trusted
+        if `listed` by the user one by one or if their attribution is the same.
+        """
+        if not _same_format(metadata.get('format'), self._tile_extension[1:]):
+            return False
+        if 'source' in metadata:
+            return metadata['source'] == str(self.tiles_url)
+        return listed or bool(self.attribution and metadata.get('attribution') == self.attribution)
+
+    def refresh_mbtiles_sources(self):
+        """
+        Look for `mbtiles_sources` files again on next tile request
+        """
+        with self._local_readers_lock:
+            readers, self._local_readers = self._local_readers, None
+        for reader in readers or []:
+            reader.close()
+
+    def _is_output(self, path):
+        """
+        Return True if `path` is written by this manager, so it cannot provide tiles
+        """
+        return False
+
+    def _local_tile(self, z, x, y):
+        """
+        Return the tile from existing MBTiles files, None if none has it
+        """
+        readers = self._get_local_readers()
+        if not readers:
+            return None
+        xyz_y = flip_y(y, z) if self.tile_scheme == 'tms' else y
+        for reader in readers:
+            if self._is_output(reader.filename):
+                continue
+            try:
+                return reader.tile(z, x, xyz_y)
+            except (ExtractionError, InvalidFormatError):
+                continue
+        return None
+
+    def _has_local_tile(self, z, x, y):
+        """
+        Return True if one of the existing MBTiles files has the tile, without reading it
+        """
+        readers = self._get_local_readers()
+        if not readers:
+            return False
+        xyz_y = flip_y(y, z) if self.tile_scheme == 'tms' else y
+        for reader in readers:
+            if self._is_output(reader.filename):
+                continue
+            try:
+                if reader.has_tile(z, x, xyz_y):
+                    return True
+            except InvalidFormatError:
+                continue
+        return False
+
     def tile(self, z_x_y):
         """
         Return the tile (binary) content of the tile and seed the cache.
@@ -119,11 +294,164 @@ class TilesManager(object):
         (z, x, y) = z_x_y
         Logger.debug(_("tile method called with %s") % ([z, x, y]))
 
+        return self._tile((z, x, y))[0]
+
+    def _tile(self, z_x_y):
+        """
+        Return the tile content and whether it was found locally: in the cache
+        or in `mbtiles_sources` files, before the network.
+        Raise TileNotFoundError if the provider has no such tile.
+        """
+        (z, x, y) = z_x_y
         output = self.cache.read((z, x, y))
         if output is None:
-            output = self.reader.tile(z, x, y)
+            return self._single_flight((z, x, y), self._fetch)
+        if not self._is_fresh((z, x, y)):
+            return self._single_flight((z, x, y), self._revalidate, output)
+        return output, True
+
+    def _single_flight(self, z_x_y, fetch, *args):
+        """
+        Call `fetch(z_x_y, *args)` unless the tile is already being fetched by another
+        thread, then wait for its result instead of requesting the tile again
+        """
+        with self._inflight_lock:
+            future = self._inflight.get(z_x_y)
+            leader = future is None
+            if leader:
+                future = self._inflight[z_x_y] = Future()
+        if not leader:
+            Logger.debug(_("Wait for tile %s fetched by another thread") % (z_x_y,))
+            output, local = future.result()
+            return output, True
+        try:
+            result = fetch(z_x_y, *args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._inflight_lock:
+                del self._inflight[z_x_y]
+
+    def _fetch(self, z_x_y):
+        """
+        Return a tile missing in the cache and whether it was found locally
+        """
+        (z, x, y) = z_x_y
+        with self.cache.lock((z, x, y)):
+            # another process sharing the cache may have fetched it meanwhile
+            output = self.cache.read((z, x, y)) if self.cache.shared else None
+            if output is not None:
+                self._discard_prefetch((z, x, y))
+                return output, True
+            output = self._local_tile(z, x, y)
+            if output is not None:
+                self._discard_prefetch((z, x, y))
+                self.cache.save(output, (z, x, y))
+                return output, True
+            missing = self._known_missing((z, x, y))
+            if missing:
+                self._discard_prefetch((z, x, y))
+                raise TileNotFoundError(_("Tile %s is missing at the provider") % ((z, x, y),),
+                                        status_code=missing[1])
+            try:
+                output, meta = self.reader.tile_with_meta(z, x, y)
+            except DownloadError as e:
+                if e.status_code not in self.missing_status_codes:
+                    raise
+                self.cache.save_missing((z, x, y), e.status_code)
+                raise TileNotFoundError(_("Tile %s is missing at the provider (%s)") % ((z, x, y), e),
+                                        status_code=e.status_code)
             self.cache.save(output, (z, x, y))
-        return output
+            self._save_meta((z, x, y), meta)
+            return output, False
+
+    def _known_missing(self, z_x_y):
+        """
+        Return (fetched, status code) if the tile was recently found missing at the provider, else None
+        """
+        missing = self.cache.read_missing(z_x_y) if self.missing_ttl else None
+        if missing and time.time() - missing[0] < self.missing_ttl:
+            return missing
+        return None
+
+    def _should_download(self, z_x_y):
+        """
+        Return True if the tile is neither cached, nor in `mbtiles_sources`,
+        nor known to be missing at the provider
+        """
+        (z, x, y) = z_x_y
+        return (not self.cache.exists((z, x, y))
+                and not self._known_missing((z, x, y))
+                and not self._has_local_tile(z, x, y))
+
+    def _discard_prefetch(self, z_x_y):
+        """
+        Drop the download of a tile started ahead by the reader, resolved without it
+        """
+        discard = getattr(self.reader, 'discard_prefetch', None)
+        if discard is not None:
+            discard(*z_x_y)
+
+    def _is_fresh(self, z_x_y):
+        """
+        Return False if the cached tile is older than `cache_ttl`
+        """
+        if not self.cache_ttl:
+            return True
+        with self._meta_backfill_lock:
+            fetched = self._meta_backfill.get(z_x_y)
+        if fetched is None:
+            meta = self.cache.read_meta(z_x_y)
+            fetched = meta and meta.get('fetched')
+        if fetched is None:
+            # cached before fetch times were recorded, its age is counted from now
+            self._backfill_meta(z_x_y, time.time())
+            return True
+        return time.time() - fetched < self.cache_ttl
+
+    def _backfill_meta(self, z_x_y, fetched):
+        """
+        Record the fetch time of a cached tile without metadata, saved by batches
+        """
+        with self._meta_backfill_lock:
+            self._meta_backfill[z_x_y] = fetched
+            full = len(self._meta_backfill) >= DEFAULT_META_BACKFILL_BATCH_SIZE
+        if full:
+            self._flush_meta_backfill()
+
+    def _save_meta(self, z_x_y, meta):
+        with self._meta_backfill_lock:
+            self._meta_backfill.pop(z_x_y, None)
+        self.cache.save_meta(z_x_y, meta)
+
+    def _flush_meta_backfill(self):
+        with self._meta_backfill_lock:
+            backfill, self._meta_backfill = self._meta_backfill, {}
+        if backfill:
+            self.cache.save_meta_many({z_x_y: {'fetched': fetched} for z_x_y, fetched in backfill.items()})
+
+    def _revalidate(self, z_x_y, output):
+        """
+        Return the up to date content of the expired cached tile `output`, and whether it was unchanged
+        """
+        (z, x, y) = z_x_y
+        Logger.debug(_("Revalidate expired tile %s") % ((z, x, y),))
+        meta = self.cache.read_meta((z, x, y))
+        try:
+            content, meta = self.reader.tile_with_meta(z, x, y, meta)
+        except DownloadError as e:
+            Logger.warning(_("Cannot revalidate tile %s, use the cached one (%s)") % ((z, x, y), e))
+            return output, True
+        if content is None:  # not modified
+            self._save_meta((z, x, y), meta)
+            return output, False
+        self.cache.save(content, (z, x, y))
+        self._save_meta((z, x, y), meta)
+        return content, False
 
 
 class MBTilesBuilder(TilesManager):
@@ -134,34 +462,123 @@ class MBTilesBuilder(TilesManager):
         filepath -- output MBTiles file (default DEFAULT_FILEPATH)
         tmp_dir -- temporary folder for gathering tiles (default DEFAULT_TMP_DIR/filepath)
         ignore_errors -- ignore download errors during MBTiles
+        resume -- keep gathered tiles of interrupted runs and continue them (default True)
+        stream -- insert tiles straight into the MBTiles file instead of gathering
+                  them as files in tmp_dir (default True)
+        dedup -- store identical tiles once in the MBTiles file (default True)
+        skip_missing -- leave out tiles the provider does not have instead of failing,
+                        they are listed in `missing_tiles` (default True)
+        order -- gather the zoom levels in 'asc' or 'desc' order (default DEFAULT_TILES_ORDER)
         """
         super(MBTilesBuilder, self).__init__(**kwargs)
         self.filepath = kwargs.get('filepath', DEFAULT_FILEPATH)
-        self.attribution = kwargs.get('attribution')
         self.use_attribution = kwargs.get('use_attribution', True)
         self.ignore_errors = kwargs.get('ignore_errors', False)
         basename, ext = os.path.splitext(os.path.basename(self.filepath))
         self.tmp_dir = kwargs.get('tmp_dir', DEFAULT_TMP_DIR)
         self.tmp_dir = os.path.join(self.tmp_dir, basename)
         self.tile_format = kwargs.get('tile_format', DEFAULT_TILE_FORMAT)
+        self.resumable = kwargs.get('resume', True)
+        self.stream = kwargs.get('stream', True)
+        self.dedup = kwargs.get('dedup', True)
+        self.skip_missing = kwargs.get('skip_missing', True)
+        self.order = kwargs.get('order', DEFAULT_TILES_ORDER)
+        assert self.order in ('asc', 'desc'), _("Unknown tiles order %s") % self.order
+        self.missing_tiles = []
+        self._journal = None
+        self._writer = None
 
         self._bboxes = []
+        self._polygons = []  # (polygons, zoomlevels, tileset)
+        self._coverage_version = 0  # changed with the coverage, for results computed meanwhile
+        self._coverage_cached_tiles = None  # cached tiles of the coverage, see count_cached_tiles_full
         self._fetched_tiles = 0
         self._total_tiles = 0
-        self._tile_download_time_list = [self.timeout + 0.15]
+        self._cached_tiles = 0  # tiles of the run found in the cache at its start
+        self._fetched_cached_tiles = 0
+        self._tile_download_time_list = [(1 / self.rate_limit if self.rate_limit else 0) + 0.15]
+        self._counters_lock = threading.Lock()
 
     def tileslist_full(self):
-        tileslist = set()
+        return self.tileset_full()
+
+    def tileset_full(self):
+        """
+        Return the `TileSet` of all coverages
+        """
+        tileset = TileSet.from_ranges(self.tile_ranges_full())
+        for polygons, levels, polygons_tiles in self._polygons:
+            tileset = tileset | polygons_tiles
+        return tileset
+
+    def iter_tiles_full(self, order=None):
+        """
+        Yield each tile (z, x, y) of all coverages once, zoom level by zoom level
+        in `order` ('asc' or 'desc', default `self.order`), with memory use independent of the number of tiles
+        """
+        return self.tileset_full().iter(order or self.order)
+
+    def tile_ranges(self, bbox, zoomlevels):
+        """
+        Return a dict zoom -> (xmin, xmax, ymin, ymax) of the tiles within the bounding box,
+        max bounds excluded
+        """
+        proj = GoogleProjection(self.tile_size, zoomlevels, self.tile_scheme)
+        return proj.tile_ranges(bbox)
+
+    def tile_ranges_full(self):
+        """
+        Return a dict zoom -> list of tile ranges (xmin, xmax, ymin, ymax) of all bounding box coverages
+        """
+        ranges = {}
         for bbox, levels in self._bboxes:
-            tileslist = tileslist.union(self.tileslist(bbox, levels))
-        return tileslist
+            for z, zoom_range in self.tile_ranges(bbox, levels).items():
+                ranges.setdefault(z, []).append(zoom_range)
+        return ranges
+
+    def count_tiles_per_zoom(self):
+        """
+        Return a dict zoom -> number of tiles of all coverages, without listing them
+        """
+        tileset = self.tileset_full()
+        return {z: tileset.count(z) for z in self.zoomlevels}
+
+    def count_tiles_full(self):
+        """
+        Return the number of tiles of all coverages, without listing them
+        """
+        return len(self.tileset_full())
+
+    @staticmethod
+    def _sample_tiles(ranges, count):
+        """
+        Return up to `count` random tiles (z, x, y) of `ranges`, pairs (zoom, tile range)
+        """
+        weighted = [(z, r, (r[1] - r[0]) * (r[3] - r[2])) for z, r in ranges]
+        weighted = [(z, r, area) for z, r, area in weighted if area]
+        if not weighted:
+            return []
+        total = sum(area for z, r, area in weighted)
+        if total <= count:
+            return [(z, x, y) for z, r, area in weighted for x in range(r[0], r[1]) for y in range(r[2], r[3])]
+        sample = set()
+        while len(sample) < count:
+            z, r, area = random.choices(weighted, weights=[w[2] for w in weighted])[0]
+            sample.add((z, random.randrange(r[0], r[1]), random.randrange(r[2], r[3])))
+        return list(sample)
 
     def get_approximate_size_mb(self, bbox, zoomlevels, max_sample_count=20):
-        tileslist = self.tileslist(bbox, zoomlevels)
-        total_tiles = len(tileslist)
+        return self._approximate_size_mb(self.tile_ranges(bbox, zoomlevels).items(), max_sample_count)
+
+    def _approximate_size_mb(self, ranges, max_sample_count):
+        """
+        Return the size estimated from a sample of the tiles of `ranges`, pairs (zoom, tile range)
+        """
+        ranges = list(ranges)
+        total_tiles = sum((x1 - x0) * (y1 - y0) for z, (x0, x1, y0, y1) in ranges)
         if total_tiles:
             sample_count = min(max_sample_count, max(5, int(total_tiles / 200)))
-            tileslist = random.sample(tileslist, min(total_tiles, sample_count))
+            tileslist = self._sample_tiles(ranges, sample_count)
             sizes_b = []
             for z_x_y in tileslist:
                 content = self.tile(z_x_y, run_process=False)
@@ -177,35 +594,104 @@ class MBTilesBuilder(TilesManager):
         return sum([
             self.get_approximate_size_mb(bbox, levels, max_sample_count=max_sample_count)
             for bbox, levels in self._bboxes
+        ] + [
+            self._approximate_size_mb(
+                ((z, r) for z in tileset.zoomlevels() for r in tileset.ranges(z)), max_sample_count)
+            for polygons, levels, tileset in self._polygons
         ])
 
+    def count_tiles_to_download(self):
+        """
+        Return the number of tiles left to gather that are not in the cache
+        """
+        if self._total_tiles:
+            with self._counters_lock:
+                remaining = self._total_tiles - self._fetched_tiles
+                cached = self._cached_tiles - self._fetched_cached_tiles
+            return max(0, remaining - max(0, cached))
+        return max(0, self.count_tiles_full() - (self._coverage_cached_tiles or 0))
+
+    def count_cached_tiles_full(self):
+        """
+        Return the number of cached tiles of all coverages and remember it for
+        `count_tiles_to_download`. It goes through the index of the whole cache,
+        so may take a while with a large cache.
+        """
+        version = self._coverage_version
+        cached = self.cache.count_cached_tileset(self.tileset_full())
+        if version == self._coverage_version:
+            self._coverage_cached_tiles = cached
+        return cached
+
+    def _coverage_changed(self):
+        self._coverage_version += 1
+        self._coverage_cached_tiles = None
+
     def calculate_average_download_time(self, tiles_num: int = None, reset=False):
         if tiles_num is None:
-            total_tiles = self._total_tiles or len(self.tileslist_full())
-            tiles_num = total_tiles - self._fetched_tiles
-        tile_download_time_list = self._tile_download_time_list or [MAX_DOWNLOAD_TIME]
+            tiles_num = self.count_tiles_to_download()
+        with self._counters_lock:
+            tile_download_time_list = list(self._tile_download_time_list) or [MAX_DOWNLOAD_TIME]
+            if reset:
+                self._tile_download_time_list.clear()
         tile_download_time = sum(tile_download_time_list) / len(tile_download_time_list)
-        if reset:
-            self._tile_download_time_list.clear()
-        return min(tile_download_time * tiles_num, MAX_DOWNLOAD_TIME)
+        download_time = tile_download_time * tiles_num / self.parallelism
+        if self.rate_limit:
+            download_time = max(download_time, tiles_num / self.rate_limit)
+        return min(download_time, MAX_DOWNLOAD_TIME)
+
+    @property
+    def parallelism(self):
+        """
+        Return the number of tiles fetched at the same time
+        """
+        return 1
 
     def add_coverage(self, bbox, zoomlevels):
         """
         Add a coverage to be included in the resulting mbtiles file.
         """
         self._bboxes.append((bbox, zoomlevels))
+        self._coverage_changed()
 
     def set_coverage(self, bbox, zoomlevels):
         """
         Set the only coverage to be included in the resulting mbtiles file.
         """
         self._bboxes = [(bbox, zoomlevels)]
+        self._polygons = []
+        self._coverage_changed()
+
+    def add_polygon_coverage(self, polygons, zoomlevels):
+        """
+        Add a coverage of the tiles touching `polygons`, a list of polygons
+        each a list of rings of (lon, lat) as in GeoJSON (see `coverage.load_geojson`).
+        """
+        tileset = polygons_tileset(polygons, zoomlevels, self.tile_scheme)
+        self._polygons.append((polygons, zoomlevels, tileset))
+        self._coverage_changed()
+
+    def add_corridor_coverage(self, lines, buffer_km, zoomlevels):
+        """
+        Add a coverage of the tiles within `buffer_km` of `lines`, a list of
+        routes each a list of (lon, lat) (see `coverage.load_route`).
+        """
+        self.add_polygon_coverage(corridor_polygons(lines, buffer_km), zoomlevels)
+
+    def set_polygon_coverage(self, polygons, zoomlevels):
+        """
+        Set the only coverage to the tiles touching `polygons`.
+        """
+        self.clear_coverage()
+        self.add_polygon_coverage(polygons, zoomlevels)
 
     def clear_coverage(self):
         """
         Set the only coverage to be included in the resulting mbtiles file.
         """
         self._bboxes = []
+        self._polygons = []
+        self._coverage_changed()
 
     @property
     def zoomlevels(self):
@@ -213,7 +699,7 @@ class MBTilesBuilder(TilesManager):
         Return the list of covered zoom levels, in ascending order
         """
         zooms = set()
-        for coverage in self._bboxes:
+        for coverage in self._bboxes + self._polygons:
             for zoom in coverage[1]:
                 zooms.add(zoom)
         return sorted(zooms)
@@ -223,17 +709,25 @@ class MBTilesBuilder(TilesManager):
         """
         Return the bounding box of covered areas
         """
+        if not self._bboxes and self._polygons:
+            return polygons_bounds(self._polygons[0][0])
         return self._bboxes[0][0]  #TODO: merge all coverages
 
     def get_bounds(self, tiles_list = None):
         """
         Return the bounds of minimum zoom level
         """
-        tiles_list = tiles_list or self.tileslist_full()
-        minz = min([z for z,x,y in tiles_list])
-        tiles_with_min_zoom = [tile for tile in tiles_list if tile[0] == minz]
-        x_list = [x for z,x,y in tiles_with_min_zoom]
-        y_list = [y for z, x, y in tiles_with_min_zoom]
+        if tiles_list:
+            minz = min([z for z,x,y in tiles_list])
+            tiles_with_min_zoom = [tile for tile in tiles_list if tile[0] == minz]
+            x_list = [x for z,x,y in tiles_with_min_zoom]
+            y_list = [y for z, x, y in tiles_with_min_zoom]
+        else:
+            tileset = self.tileset_full()
+            minz = tileset.zoomlevels()[0]
+            xmin, xmax, ymin, ymax = tileset.extent(minz)
+            x_list = [xmin, xmax - 1]
+            y_list = [ymin, ymax - 1]
         minx = min(x_list)
         maxx = max(x_list)
         miny = min(y_list)
@@ -246,53 +740,185 @@ class MBTilesBuilder(TilesManager):
         run_process = kwargs.get('run_process', True)
         try:
             start_time = time.time()
-            result = super().tile(z_x_y)
-            self._tile_download_time_list.append(time.time() - start_time)
-            if run_process:
-                self._fetched_tiles += 1
+            result, cached = self._tile(z_x_y)
+            with self._counters_lock:
+                if not cached:  # cache hits do not tell the download time
+                    self._tile_download_time_list.append(time.time() - start_time)
+                if run_process:
+                    self._fetched_tiles += 1
+                    if cached:
+                        self._fetched_cached_tiles += 1
             return result
+        except TileNotFoundError as e:
+            if not self.skip_missing:
+                raise
+            Logger.info(_("Skip tile %s: %s") % (z_x_y, e))
+            if run_process:
+                with self._counters_lock:
+                    self._fetched_tiles += 1
+                    self.missing_tiles.append(tuple(z_x_y))
+            return None
         except Exception as e:
-            self._tile_download_time_list.append(MAX_DOWNLOAD_TIME)
+            if not (isinstance(e, DownloadError) and e.status_code in THROTTLE_STATUS_CODES):
+                # a throttled tile is retried, its wait is no download time
+                with self._counters_lock:
+                    self._tile_download_time_list.append(MAX_DOWNLOAD_TIME)
             Logger.warning(e)
             if not self.ignore_errors:
                 raise
 
-    def run(self, force=False):
+    def run(self, force=False, update=False):
+        finished = False
         try:
-            self._run(force)
+            self._run(force, update)
+            finished = True
         finally:
-            self._clean_run()
+            self._flush_meta_backfill()
+            if finished or not self.resumable:
+                self._clean_run()
+            else:
+                self._close_run()
 
-    def _run(self, force):
+    def _run(self, force, update=False):
         """
         Build a MBTile file.
 
         force -- overwrite if MBTiles file already exists.
+        update -- add the missing tiles of the coverage to the existing MBTiles file.
         """
         if os.path.exists(self.filepath):
-            if force:
+            if update:
+                Logger.info(_("%s already exists and will be updated.") % self.filepath)
+            elif force:
                 Logger.warning(_("%s already exists and will be overwritten.") % self.filepath)
             else:
                 # Already built, do not do anything.
                 Logger.info(_("%s already exists. Nothing to do.") % self.filepath)
                 return
+        else:
+            update = False
 
-        # Clean previous runs
-        self._clean_run()
-
-        # Compute list of tiles
-        tileslist = self.tileslist_full()
-        Logger.debug(_("%s tiles in total.") % len(tileslist))
-        self._total_tiles = len(tileslist)
-        if not self._total_tiles:
+        # Count tiles, they are listed lazily while gathered
+        self.refresh_mbtiles_sources()
+        tileset = self.tileset_full()
+        total_tiles = len(tileset)
+        Logger.debug(_("%s tiles in total.") % total_tiles)
+        if not total_tiles:
             raise EmptyCoverageError(_("No tiles are covered by bounding boxes : %s") % self._bboxes)
+        if update:
+            return self._run_update()
+
+        # Continue the interrupted run of the same job or clean previous runs
+        self._open_journal()
+        self.missing_tiles = []
+        self._total_tiles = total_tiles
+        self._fetched_tiles = self._journal.done_count()
+        self._count_cached(tileset, self._fetched_tiles)
         Logger.debug(_("%s tiles to be packaged.") % self._total_tiles)
 
-        # Go through whole list of tiles and gather them in tmp_dir
-        for (z, x, y) in tileslist:
-            self._gather((z, x, y))
+        # Go through whole list of tiles and gather them in tmp_dir or the MBTiles file
+        temp_filepath = os.path.join(self.tmp_dir, 'tmp.mbtiles')
+        if self.stream:
+            self._writer = MBTilesWriter(temp_filepath, on_commit=self._on_tiles_written, dedup=self.dedup).start()
+        self._gather_all(z_x_y for z_x_y in tileset.iter(self.order) if not self._journal.is_done(z_x_y))
 
-        # Some metadata
+        # Package it!
+        Logger.info(_("Build MBTiles file '%s'.") % self.filepath)
+        metadata = self._metadata()
+        if self.stream:
+            writer, self._writer = self._writer, None
+            writer.close(metadata)
+        else:
+            self._journal.flush()
+            self._package_gathered(temp_filepath, metadata)
+        self._report_missing()
+
+        overwritten = os.path.exists(self.filepath)
+        shutil.move(temp_filepath, self.filepath)
+        if overwritten:
+            Logger.warning(_("%s was successfully overwritten.") % self.filepath)
+
+    def _run_update(self):
+        """
+        Insert the tiles of the coverage missing in the existing MBTiles file in place
+        and extend its metadata to the new coverage.
+        """
+        reader = MBTilesReader(self.filepath)
+        try:
+            existing_metadata = reader.metadata()
+            self._check_update(existing_metadata)
+            existing = TileSet.from_sorted_tiles(reader.iter_tiles(self.tile_scheme))
+        finally:
+            reader.close()
+        tileset = self.tileset_full()
+        missing = tileset - existing
+        Logger.info(_("%s of %s tiles are missing in %s.") % (len(missing), len(tileset), self.filepath))
+
+        self._open_journal(update=True)
+        self.missing_tiles = []
+        # tiles written by an interrupted update are in the file, so out of `missing`
+        self._fetched_tiles = self._journal.done_count()
+        self._total_tiles = len(missing) + self._fetched_tiles
+        self._count_cached(missing, 0)
+        # the user's file is updated in place: keep it consistent if the run is killed
+        self._writer = MBTilesWriter(self.filepath, on_commit=self._on_tiles_written, dedup=self.dedup,
+                                     safe=True).start()
+        self._gather_all(z_x_y for z_x_y in missing.iter(self.order) if not self._journal.is_done(z_x_y))
+
+        metadata = self._metadata()
+        writer, self._writer = self._writer, None
+        writer.close(self._merge_metadata(existing_metadata, metadata))
+        self._report_missing()
+        Logger.info(_("%s was successfully updated.") % self.filepath)
+
+    def _is_output(self, path):
+        return os.path.abspath(path) == os.path.abspath(self.filepath)
+
+    def _check_update(self, existing_metadata):
+        """
+        Raise UpdateMismatchError if the tiles of this builder cannot go into the existing file:
+        other image format, or other tiles source. Files without `source` are assumed to match.
+        """
+        existing_format = existing_metadata.get('format')
+        tile_format = self._tile_extension[1:]
+        if existing_format and not _same_format(existing_format, tile_format):
+            raise UpdateMismatchError(_("%s holds %s tiles, cannot add %s tiles to it") % (
+                self.filepath, existing_format, tile_format))
+        existing_source = existing_metadata.get('source')
+        if existing_source and not self.mbtiles_file and existing_source != str(self.tiles_url):
+            raise UpdateMismatchError(_("%s holds tiles of %s, cannot add tiles of %s to it") % (
+                self.filepath, existing_source, self.tiles_url))
+
+    def _report_missing(self):
+        if self.missing_tiles:
+            Logger.warning(_("%s tiles are missing at the provider and were left out: %s") % (
+                len(self.missing_tiles), ', '.join(str(z_x_y) for z_x_y in sorted(self.missing_tiles)[:20])))
+
+    @staticmethod
+    def _merge_metadata(existing, metadata):
+        """
+        Return `existing` metadata extended to zoom levels and bounds of the new `metadata`
+        """
+        try:
+            old_bounds = [float(v) for v in existing['bounds'].split(',')]
+            new_bounds = [float(v) for v in metadata['bounds'].split(',')]
+            minzoom = min(int(existing['minzoom']), int(metadata['minzoom']))
+            maxzoom = max(int(existing['maxzoom']), int(metadata['maxzoom']))
+        except (KeyError, ValueError):
+            return dict(metadata, **{k: v for k, v in existing.items() if k in ('name', 'format')})
+        bounds = (min(old_bounds[0], new_bounds[0]), min(old_bounds[1], new_bounds[1]),
+                  max(old_bounds[2], new_bounds[2]), max(old_bounds[3], new_bounds[3]))
+        merged = dict(existing)
+        merged['minzoom'] = minzoom
+        merged['maxzoom'] = maxzoom
+        merged['bounds'] = '%s,%s,%s,%s' % bounds
+        merged['center'] = '%s,%s,%s' % ((bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2,
+                                         (minzoom + maxzoom) // 2)
+        if 'attribution' in metadata:
+            merged.setdefault('attribution', metadata['attribution'])
+        return merged
+
+    def _metadata(self):
         middlezoom = self.zoomlevels[len(self.zoomlevels) // 2]
         lat = self.bbox_bounds[1] + (self.bbox_bounds[3] - self.bbox_bounds[1])/2
         lon = self.bbox_bounds[0] + (self.bbox_bounds[2] - self.bbox_bounds[0])/2
@@ -303,44 +929,124 @@ class MBTilesBuilder(TilesManager):
         metadata['maxzoom'] = self.zoomlevels[-1]
         metadata['bounds'] = '%s,%s,%s,%s' % tuple(self.get_bounds())
         metadata['center'] = '%s,%s,%s' % (lon, lat, middlezoom)
+        if not self.mbtiles_file:
+            metadata['source'] = str(self.tiles_url)  # lets later jobs reuse the tiles
         if self.attribution and self.use_attribution:
             metadata['attribution'] = self.attribution
+        return metadata
+
+    def _package_gathered(self, temp_filepath, metadata):
         metadatafile = os.path.join(self.tmp_dir, 'metadata.json')
         with open(metadatafile, 'w') as output:
             json.dump(metadata, output)
 
-        # Package it!
-        Logger.info(_("Build MBTiles file '%s'.") % self.filepath)
         extension = self.tile_format.split("image/")[-1]
-
-        temp_filepath = os.path.join(self.tmp_dir, 'tmp.mbtiles')
+        if os.path.exists(temp_filepath):  # left by interrupted packaging
+            os.remove(temp_filepath)
         disk_to_mbtiles(
             self.tmp_dir,
             temp_filepath,
             format=extension,
             scheme=self.cache.scheme,
+            dedup=self.dedup,
         )
 
-        overwritten = os.path.exists(self.filepath)
-        shutil.move(temp_filepath, self.filepath)
-        if overwritten:
-            Logger.warning(_("%s was successfully overwritten.") % self.filepath)
+    def _gather_all(self, tileslist):
+        for (z, x, y) in tileslist:
+            self._gather((z, x, y))
 
     def _gather(self, z_x_y):
         (z, x, y) = z_x_y
+        if self._writer is not None:
+            tilecontent = self.tile((z, x, y))
+            if tilecontent is not None:
+                tms_y = y if self.tile_scheme == 'tms' else flip_y(y, z)
+                self._writer.put((z, x, y), tms_y, tilecontent)
+            return
         files_dir, tile_name = self.cache.tile_file((z, x, y))
         tmp_dir = os.path.join(self.tmp_dir, files_dir)
-        if not os.path.isdir(tmp_dir):
-            os.makedirs(tmp_dir)
+        os.makedirs(tmp_dir, exist_ok=True)
         tilecontent = self.tile((z, x, y))
+        if tilecontent is None:
+            return
         tilepath = os.path.join(tmp_dir, tile_name)
         with open(tilepath, 'wb') as f:
             f.write(tilecontent)
+        self._journal.mark_done((z, x, y))
+
+    def _count_cached(self, tileset, gathered):
+        """
+        Count the tiles left to gather that are already cached, for the remaining time estimate.
+        The `gathered` tiles of `tileset` already gathered by an interrupted run are assumed to be cached.
+        """
+        cached = max(0, self.cache.count_cached_tileset(tileset) - gathered)
+        Logger.debug(_("%s tiles to be gathered are cached.") % cached)
+        with self._counters_lock:
+            self._cached_tiles = cached
+            self._fetched_cached_tiles = 0
+
+    def _on_tiles_written(self, tileslist):
+        for z_x_y in tileslist:
+            self._journal.mark_done(z_x_y)
+
+    def _job_params(self):
+        """
+        Parameters identifying the job, an interrupted run is resumed only if they match
+        """
+        return {
+            'filepath': os.path.abspath(self.filepath),
+            'tiles_url': self.tiles_url,
+            'tile_format': self.tile_format,
+            'tile_scheme': self.tile_scheme,
+            'cache_scheme': self.cache.scheme,
+            'coverages': [[list(bbox), list(levels)] for bbox, levels in self._bboxes],
+            'polygons': [[polygons, list(levels)] for polygons, levels, tileset in self._polygons],
+            'stream': self.stream,
+            'dedup': self.dedup,
+        }
+
+    def _open_journal(self, update=False):
+        extents = {}
+        tileset = self.tileset_full()
+        for z in tileset.zoomlevels():
+            xmin, xmax, ymin, ymax = tileset.extent(z)
+            extents[z] = (xmin, ymin, xmax - 1, ymax - 1)
+        journal = JobJournal(os.path.join(self.tmp_dir, 'journal.sqlite'))
+        params = dict(self._job_params(), update=update)
+        if not (self.resumable and os.path.exists(journal.path) and journal.open(params, extents)):
+            journal.close()
+            self._clean_run()
+            journal.open(params, extents)
+        self._journal = journal
+
+    def _close_writer(self):
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception as e:
+                Logger.warning(e)
+
+    def _close_run(self):
+        self._close_writer()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self._fetched_tiles = 0
+        self._total_tiles = 0
+        self._cached_tiles = 0
+        self._fetched_cached_tiles = 0
 
     def _clean_run(self):
+        self._close_writer()
+        if self._journal is not None:
+            self._journal.remove()
+            self._journal = None
         self._clean_gather()
         self._fetched_tiles = 0
         self._total_tiles = 0
+        self._cached_tiles = 0
+        self._fetched_cached_tiles = 0
 
     def _clean_gather(self):
         Logger.debug(_("Clean-up %s") % self.tmp_dir)
@@ -355,10 +1061,6 @@ class MBTilesBuilder(TilesManager):
                 pass
         except OSError:
             pass
-        try:
-            os.remove("%s-journal" % self.filepath)  # created by mbutil
-        except OSError as e:
-            pass
 
 
 
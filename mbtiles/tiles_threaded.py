@@ -1,10 +1,12 @@
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 from typing import Callable
 
 from kivy.logger import Logger
 
-from . import DEFAULT_CONNECTION_MAX_TIMEOUT
+from . import DEFAULT_CONNECTION_MAX_TIMEOUT, DEFAULT_THROTTLE_RETRIES, DEFAULT_WORKERS
+from .concurrency import AdaptiveLimit, THROTTLE_STATUS_CODES
 from .exceptions import StopException, DownloadError
 from .tiles import MBTilesBuilder
 
@@ -18,6 +20,9 @@ class MBTilesBuilderThreaded(MBTilesBuilder):
             connection_lost_cb: Callable[[], None] = None,
             final_cb: Callable[[], None] = None,
             wait_connection = True,
+            workers: int = DEFAULT_WORKERS,
+            adaptive_concurrency = True,
+            throttle_retries: int = DEFAULT_THROTTLE_RETRIES,
             **kwargs
     ):
         kwargs.setdefault('download_retries', 0)
@@ -28,6 +33,13 @@ class MBTilesBuilderThreaded(MBTilesBuilder):
         self._connection_lost_cb = connection_lost_cb
         self._final_cb = final_cb
         self.wait_connection = wait_connection
+        self.workers = max(1, int(workers))
+        self.throttle_retries = throttle_retries
+        self.error = None  # exception that interrupted the last run
+        if adaptive_concurrency and hasattr(self.reader, 'concurrency'):
+            maximum = max(self.workers, getattr(self.reader, 'max_concurrency', 0))
+            # start below the cap, so that additive increase has room to find the limit
+            self.reader.concurrency = AdaptiveLimit(maximum, initial=min(DEFAULT_WORKERS, max(1, maximum // 2)))
 
         self._resume_event = threading.Event()
         self._stop_event = threading.Event()
@@ -65,9 +77,25 @@ class MBTilesBuilderThreaded(MBTilesBuilder):
             daemon=True
         ).start()
 
+    def count_cached_tiles_full(self, **kwargs):
+        setter_cb: Callable[[int], None] = kwargs.get('setter_cb')
+        default_func = super().count_cached_tiles_full
+
+        def target():
+            result = default_func()
+            if setter_cb:
+                setter_cb(result)
+
+        threading.Thread(
+            target=target,
+            name='map-db-cache. Counting cached tiles',
+            daemon=True
+        ).start()
+
     def tile(self, z_x_y, **kwargs):
         run_process = kwargs.get('run_process', True)
         sleeptime = 1
+        throttled = 0
         while True:
             if run_process:
                 self._resume_event.wait()
@@ -80,6 +108,14 @@ class MBTilesBuilderThreaded(MBTilesBuilder):
                     self._call_progress_cb()
                 return result
             except DownloadError as exc:
+                if exc.status_code in THROTTLE_STATUS_CODES:
+                    if throttled >= self.throttle_retries:
+                        raise exc
+                    throttled += 1
+                    Logger.info(f'Provider asked to slow down ({exc.status_code}), retry tile {z_x_y}')
+                    self._sleep(exc.retry_after or sleeptime)
+                    sleeptime = min(sleeptime * 2, DEFAULT_CONNECTION_MAX_TIMEOUT)
+                    continue
                 self._call_connection_lost_cb_once()
                 if (
                         not self.wait_connection
@@ -89,24 +125,32 @@ class MBTilesBuilderThreaded(MBTilesBuilder):
                     raise exc
             if sleeptime < DEFAULT_CONNECTION_MAX_TIMEOUT:
                 sleeptime += 1
-            for _ in range(sleeptime * 2):
-                if self._stop_event.is_set():
-                    raise StopException
-                time.sleep(0.5)
-
-    def run(self, force=False):
+            self._sleep(sleeptime)
+
+    def _sleep(self, seconds):
+        """
+        Sleep for `seconds`, raise StopException as soon as stop is requested
+        """
+        for _ in range(int(seconds * 2) or 1):
+            if self._stop_event.is_set():
+                raise StopException
+            time.sleep(0.5)
+
+    def run(self, force=False, update=False):
         if not self._is_running.is_set():
             default_func = super().run
 
-            def target(_force):
+            def target(_force, _update):
                 try:
                     self._is_running.set()
-                    default_func(_force)
+                    self.error = None
+                    default_func(_force, _update)
                     self._call_success_cb()
                 except StopException:
                     Logger.info('Run process was stopped')
                 except Exception as exc:
                     Logger.exception('Run process was interrupted by exception.', exc_info=exc)
+                    self.error = exc
                     self._call_error_cb()
                 finally:
                     self._reset_events()
@@ -114,11 +158,57 @@ class MBTilesBuilderThreaded(MBTilesBuilder):
 
             threading.Thread(
                 target=target,
-                args=(force,),
+                args=(force, update),
                 name='map-db-cache. Building mbtiles',
                 daemon=True
             ).start()
 
+    @property
+    def parallelism(self):
+        return self.workers
+
+    def _gather_all(self, tileslist):
+        """
+        Gather tiles with a pool of `workers` threads. At most two tiles per
+        worker are queued at once, so `tileslist` may be a lazy iterable.
+        An asynchronous reader is fed ahead with up to `max_concurrency` tiles.
+        """
+        prefetch = getattr(self.reader, 'prefetch', None)
+        if self.workers <= 1 and prefetch is None:
+            return super()._gather_all(tileslist)
+        window = self.workers * 2
+        if prefetch is not None:
+            window = max(window, self.reader.max_concurrency)
+        executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix='map-db-cache. Downloading tile'
+        )
+        pending = set()
+        try:
+            for z_x_y in tileslist:
+                if len(pending) >= window:
+                    pending = self._wait_gathered(pending, FIRST_COMPLETED)
+                if prefetch is not None and self._should_download(z_x_y):
+                    prefetch(*z_x_y)
+                pending.add(executor.submit(self._gather, z_x_y))
+            self._wait_gathered(pending, ALL_COMPLETED)
+        except BaseException:
+            # make the remaining workers leave their wait loops
+            self._stop_event.set()
+            self._resume_event.set()
+            raise
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            if prefetch is not None:
+                self.reader.cancel_prefetch()
+
+    @staticmethod
+    def _wait_gathered(futures, return_when):
+        done, pending = wait(futures, return_when=return_when)
+        for future in done:
+            future.result()  # re-raise worker exception
+        return pending
+
     def _call_progress_cb(self):
         Logger.debug(f'progress {self._fetched_tiles}/{self._total_tiles}')
         if self._progress_cb:
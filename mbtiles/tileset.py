@@ -0,0 +1,251 @@
+from bisect import bisect_right
+
+
+def merge_intervals(intervals):
+    """
+    Return the sorted disjoint intervals [start, end) covering the union of `intervals`
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if start >= end:
+            continue
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [tuple(interval) for interval in merged]
+
+
+def _intersect_intervals(a, b):
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start = max(a[i][0], b[j][0])
+        end = min(a[i][1], b[j][1])
+        if start < end:
+            result.append((start, end))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def _subtract_intervals(a, b):
+    result = []
+    j = 0
+    for start, end in a:
+        while j < len(b) and b[j][1] <= start:
+            j += 1
+        k = j
+        while k < len(b) and b[k][0] < end:
+            if b[k][0] > start:
+                result.append((start, b[k][0]))
+            start = max(start, b[k][1])
+            k += 1
+        if start < end:
+            result.append((start, end))
+    return result
+
+
+def _union_intervals(a, b):
+    return merge_intervals(a + b)
+
+
+def _append_run(runs, x0, x1, intervals):
+    """
+    Append the column run [x0, x1) of y `intervals` to `runs`, merged with
+    the previous run when it is adjacent and has the same intervals
+    """
+    if not intervals or x0 >= x1:
+        return
+    intervals = tuple(intervals)
+    if runs and runs[-1][1] == x0 and runs[-1][2] == intervals:
+        runs[-1] = (runs[-1][0], x1, intervals)
+    else:
+        runs.append((x0, x1, intervals))
+
+
+def _combine_runs(a, b, operation):
+    """
+    Return the column runs of `operation` applied to the y intervals of
+    column runs `a` and `b`, slab by slab
+    """
+    xs = sorted({run[0] for run in a} | {run[1] for run in a} | {run[0] for run in b} | {run[1] for run in b})
+    runs = []
+    i = j = 0
+    for x0, x1 in zip(xs, xs[1:]):
+        while i < len(a) and a[i][1] <= x0:
+            i += 1
+        while j < len(b) and b[j][1] <= x0:
+            j += 1
+        a_intervals = list(a[i][2]) if i < len(a) and a[i][0] <= x0 else []
+        b_intervals = list(b[j][2]) if j < len(b) and b[j][0] <= x0 else []
+        _append_run(runs, x0, x1, operation(a_intervals, b_intervals))
+    return runs
+
+
+class TileSet(object):
+    def __init__(self, zooms=None):
+        """
+        Set of tiles (z, x, y) stored per zoom level as sorted runs of
+        adjacent x columns sharing the same y intervals, max bounds excluded.
+        Its size depends on the shape of the covered area, not on its number of tiles.
+
+        zooms -- dict zoom -> list of (xmin, xmax, ((ymin, ymax), ...)) column runs,
+                 sorted and disjoint (default empty)
+        """
+        self._zooms = {z: runs for z, runs in (zooms or {}).items() if runs}
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        """
+        Return the tile set of the union of `ranges`, a dict
+        zoom -> list of tile ranges (xmin, xmax, ymin, ymax)
+        """
+        zooms = {}
+        for z, zoom_ranges in ranges.items():
+            zoom_ranges = sorted(r for r in zoom_ranges if r[0] < r[1] and r[2] < r[3])
+            xs = sorted({r[0] for r in zoom_ranges} | {r[1] for r in zoom_ranges})
+            runs = []
+            active = []
+            i = 0
+            for x0, x1 in zip(xs, xs[1:]):
+                # sweep the column slabs, keeping the ranges spanning the current one
+                active = [r for r in active if r[1] > x0]
+                while i < len(zoom_ranges) and zoom_ranges[i][0] <= x0:
+                    active.append(zoom_ranges[i])
+                    i += 1
+                _append_run(runs, x0, x1, merge_intervals((r[2], r[3]) for r in active))
+            zooms[z] = runs
+        return cls(zooms)
+
+    @classmethod
+    def from_tiles(cls, tiles):
+        """
+        Return the tile set of the (z, x, y) `tiles`
+        """
+        columns = {}
+        for z, x, y in tiles:
+            columns.setdefault(z, {}).setdefault(x, []).append(y)
+        zooms = {}
+        for z, zoom_columns in columns.items():
+            runs = []
+            for x in sorted(zoom_columns):
+                _append_run(runs, x, x + 1, merge_intervals((y, y + 1) for y in zoom_columns[x]))
+            zooms[z] = runs
+        return cls(zooms)
+
+    @classmethod
+    def from_sorted_tiles(cls, tiles):
+        """
+        Return the tile set of the (z, x, y) `tiles` sorted by zoom level, column and row,
+        building the column runs as the tiles come
+        """
+        zooms = {}
+        runs = column = intervals = None
+        for z, x, y in tiles:
+            if (z, x) != column:
+                if column is not None:
+                    _append_run(runs, column[1], column[1] + 1, intervals)
+                runs = zooms.setdefault(z, [])
+                column = (z, x)
+                intervals = []
+            if intervals and intervals[-1][1] >= y:
+                intervals[-1] = (intervals[-1][0], max(intervals[-1][1], y + 1))
+            else:
+                intervals.append((y, y + 1))
+        if column is not None:
+            _append_run(runs, column[1], column[1] + 1, intervals)
+        return cls(zooms)
+
+    def zoomlevels(self):
+        """
+        Return the list of zoom levels with tiles, in ascending order
+        """
+        return sorted(self._zooms)
+
+    def count(self, z):
+        """
+        Return the number of tiles of zoom level `z`
+        """
+        return sum((x1 - x0) * sum(y1 - y0 for y0, y1 in intervals) for x0, x1, intervals in self._zooms.get(z, ()))
+
+    def extent(self, z):
+        """
+        Return the (xmin, xmax, ymin, ymax) extent of zoom level `z` tiles,
+        max bounds excluded, or None without tiles
+        """
+        runs = self._zooms.get(z)
+        if not runs:
+            return None
+        return (runs[0][0], runs[-1][1],
+                min(intervals[0][0] for x0, x1, intervals in runs),
+                max(intervals[-1][1] for x0, x1, intervals in runs))
+
+    def ranges(self, z):
+        """
+        Return the disjoint tile ranges (xmin, xmax, ymin, ymax) of zoom level `z`
+        """
+        return [(x0, x1, y0, y1) for x0, x1, intervals in self._zooms.get(z, ()) for y0, y1 in intervals]
+
+    def iter_zoom(self, z):
+        """
+        Yield the tiles (z, x, y) of zoom level `z`, column by column
+        """
+        for x0, x1, intervals in self._zooms.get(z, ()):
+            for x in range(x0, x1):
+                for y0, y1 in intervals:
+                    for y in range(y0, y1):
+                        yield z, x, y
+
+    def iter(self, order='asc'):
+        """
+        Yield the tiles (z, x, y), zoom level by zoom level in `order` ('asc' or 'desc')
+        """
+        for z in sorted(self._zooms, reverse=(order == 'desc')):
+            yield from self.iter_zoom(z)
+
+    def __iter__(self):
+        return self.iter()
+
+    def __len__(self):
+        return sum(self.count(z) for z in self._zooms)
+
+    def __bool__(self):
+        return bool(self._zooms)
+
+    def __contains__(self, z_x_y):
+        (z, x, y) = z_x_y
+        runs = self._zooms.get(z)
+        if not runs:
+            return False
+        i = bisect_right(runs, (x, float('inf'))) - 1
+        if i < 0 or x >= runs[i][1]:
+            return False
+        intervals = runs[i][2]
+        j = bisect_right(intervals, (y, float('inf'))) - 1
+        return j >= 0 and y < intervals[j][1]
+
+    def _combine(self, other, operation, zooms):
+        return TileSet({z: _combine_runs(self._zooms.get(z, []), other._zooms.get(z, []), operation) for z in zooms})
+
+    def union(self, other):
+        return self._combine(other, _union_intervals, set(self._zooms) | set(other._zooms))
+
+    def intersection(self, other):
+        return self._combine(other, _intersect_intervals, set(self._zooms) & set(other._zooms))
+
+    def difference(self, other):
+        return self._combine(other, _subtract_intervals, set(self._zooms))
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def __eq__(self, other):
+        return isinstance(other, TileSet) and self._zooms == other._zooms
+
+    def __repr__(self):
+        return '<TileSet %s>' % ', '.join('z%s: %s tiles' % (z, self.count(z)) for z in self.zoomlevels())
@@ -0,0 +1,150 @@
+import os
+import queue
+import sqlite3
+import threading
+from gettext import gettext as _
+
+from kivy.logger import Logger
+
+from . import DEFAULT_WRITER_BATCH_SIZE, DEFAULT_WRITER_QUEUE_SIZE
+from .mbutil import (mbtiles_connect, mbtiles_setup, mbtiles_setup_dedup, mbtiles_is_dedup, optimize_connection,
+                     safe_connection, tile_hash, insert_tiles_dedup, remove_unused_images)
+
+_CLOSE = object()
+
+
+class MBTilesWriter(object):
+    def __init__(self, filepath, batch_size=None, queue_size=None, on_commit=None, dedup=True, safe=False):
+        """
+        Inserts tiles into the MBTiles `filepath` from a single thread fed by a
+        bounded queue, committing every `batch_size` tiles. An existing file is
+        appended to.
+
+        dedup -- store identical tiles once (images/map schema with a `tiles` view) if
+                 the file is created, an existing file keeps its schema
+        on_commit -- called with the list of (z, x, y) tiles of each committed batch
+        safe -- sync each commit to disk and let other connections read the file between
+                commits, to update a file in use in place (default False: fast, exclusive writes)
+        """
+        self.filepath = filepath
+        if batch_size is None:
+            batch_size = DEFAULT_WRITER_BATCH_SIZE
+        self.batch_size = batch_size
+        if queue_size is None:
+            queue_size = DEFAULT_WRITER_QUEUE_SIZE
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._on_commit = on_commit
+        self.dedup = dedup
+        self.safe = safe
+        self._error = None
+        self._thread = None
+
+    def start(self):
+        if os.path.exists(self.filepath):
+            con = mbtiles_connect(self.filepath, silent=False)
+            try:
+                if con.execute("SELECT 1 FROM sqlite_master WHERE name='tiles'").fetchone():
+                    self.dedup = mbtiles_is_dedup(con.cursor())
+            finally:
+                con.close()
+        self._thread = threading.Thread(
+            target=self._write,
+            name='map-db-cache. Writing mbtiles',
+            daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def put(self, z_x_y, tms_y, data):
+        """
+        Queue tile `z_x_y` stored in `tile_row` `tms_y`, block while the queue is full
+        """
+        (z, x, y) = z_x_y
+        # hash in the calling worker thread, not in the single writer thread
+        row = (z, x, tms_y, tile_hash(data), data) if self.dedup else (z, x, tms_y, sqlite3.Binary(data))
+        while True:
+            self._raise_error()
+            try:
+                self._queue.put(((z, x, y), row), timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def close(self, metadata=None):
+        """
+        Write queued tiles and `metadata` (if set), stop the writer thread
+        """
+        if self._thread is not None:
+            while self._thread.is_alive():
+                try:
+                    self._queue.put((_CLOSE, metadata), timeout=1)
+                    break
+                except queue.Full:
+                    pass
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _write(self):
+        con = None
+        try:
+            con = mbtiles_connect(self.filepath, silent=False)
+            cur = con.cursor()
+            if self.safe:
+                safe_connection(cur)
+            else:
+                optimize_connection(cur)
+            if not cur.execute("SELECT 1 FROM sqlite_master WHERE name='tiles'").fetchone():
+                if self.dedup:
+                    mbtiles_setup_dedup(cur)
+                else:
+                    mbtiles_setup(cur)
+            dedup = self.dedup
+            tiles, rows = [], []
+            metadata = None
+            while True:
+                try:
+                    z_x_y, row = self._queue.get(timeout=1 if rows else None)
+                except queue.Empty:
+                    z_x_y = None  # idle, commit what we have
+                if z_x_y is _CLOSE:
+                    metadata = row
+                if z_x_y is not None and z_x_y is not _CLOSE:
+                    tiles.append(z_x_y)
+                    rows.append(row)
+                if rows and (z_x_y is None or z_x_y is _CLOSE or len(rows) >= self.batch_size):
+                    if dedup:
+                        insert_tiles_dedup(cur, rows)
+                    else:
+                        cur.executemany("""INSERT OR REPLACE INTO tiles
+                            (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)""", rows)
+                    con.commit()
+                    Logger.debug(_("%s tiles inserted into %s") % (len(rows), self.filepath))
+                    if self._on_commit:
+                        self._on_commit(tiles)
+                    tiles, rows = [], []
+                if z_x_y is _CLOSE:
+                    break
+            if metadata is not None:
+                cur.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+                                list(metadata.items()))
+                if dedup:
+                    remove_unused_images(cur)
+                cur.execute("ANALYZE")
+                con.commit()
+        except Exception as e:
+            Logger.exception(_("Writing %s failed") % self.filepath)
+            self._error = e
+            # do not leave producers blocked on the full queue
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+        finally:
+            if con is not None:
+                con.close()
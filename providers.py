@@ -2,15 +2,19 @@ from dataclasses import dataclass
 
 from kivy_garden.mapview.source import MapSource
 
-from mbtiles import DEFAULT_TILES_SUBDOMAINS, DEFAULT_TILE_FORMAT, DEFAULT_TIMEOUT
+from mbtiles import DEFAULT_TILES_SUBDOMAINS, DEFAULT_TILE_FORMAT, DEFAULT_RATE_LIMIT, DEFAULT_RATE_BURST, \
+    DEFAULT_CACHE_TTL
 from tools.utils import current_year
 
 DEFAULT_PROVIDER = 'Google Satellite'
 KIVY_USER_AGENT = 'Kivy-garden.mapview'
 BROWSER_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/117.0'
-GOOGLE_TIMEOUT = 0.05
-BING_TIMEOUT = 0.2
-ESRI_TIMEOUT = 0.025
+GOOGLE_RATE_LIMIT = 20
+GOOGLE_RATE_BURST = 40
+BING_RATE_LIMIT = 5
+ESRI_RATE_LIMIT = 40
+ESRI_RATE_BURST = 80
+SATELLITE_CACHE_TTL = 180 * 24 * 3600  # imagery is updated rarely
 
 @dataclass
 class ProviderData:
@@ -21,7 +25,9 @@ class ProviderData:
     subdomains: tuple = tuple(DEFAULT_TILES_SUBDOMAINS)
     format: str = DEFAULT_TILE_FORMAT
     user_agent: str = BROWSER_USER_AGENT
-    timeout: float = DEFAULT_TIMEOUT
+    rate_limit: float = DEFAULT_RATE_LIMIT
+    rate_burst: int = DEFAULT_RATE_BURST
+    cache_ttl: float = DEFAULT_CACHE_TTL
 
 
 PROVIDERS = {
@@ -31,7 +37,9 @@ PROVIDERS = {
         url='http://mt{s}.google.com/vt/lyrs=y&x={x}&y={y}&z={z}&hl=uk',
         attribution=f'Map data ©{current_year()} Google',
         subdomains=('0', '1', '2', '3'),
-        timeout=GOOGLE_TIMEOUT,
+        rate_limit=GOOGLE_RATE_LIMIT,
+        rate_burst=GOOGLE_RATE_BURST,
+        cache_ttl=SATELLITE_CACHE_TTL,
     ),
     'Bing Satellite': ProviderData(
         min_zoom = 1,
@@ -39,7 +47,8 @@ PROVIDERS = {
         url = 'http://ak.dynamic.t{s}.tiles.virtualearth.net/comp/ch/{key}?mkt=uk-UA&it=A,G,L&shading=hill&og=8&n=z',
         subdomains=('1', '2', '3'),
         format='image/jpeg',
-        timeout=BING_TIMEOUT,
+        rate_limit=BING_RATE_LIMIT,
+        cache_ttl=SATELLITE_CACHE_TTL,
     ),
     'Bing Satellite 2': ProviderData(
         min_zoom = 1,
@@ -47,7 +56,8 @@ PROVIDERS = {
         url = 'http://ecn.t{s}.tiles.virtualearth.net/tiles/h{key}?g=761&mkt=en-us',
         subdomains=('1', '2', '3'),
         format='image/jpeg',
-        timeout=BING_TIMEOUT,
+        rate_limit=BING_RATE_LIMIT,
+        cache_ttl=SATELLITE_CACHE_TTL,
     ),
     'Esri ArcGIS Satellite': ProviderData(
         min_zoom = 0,
@@ -55,7 +65,9 @@ PROVIDERS = {
         url = 'https://server.arcgisonline.com/arcgis/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
         attribution="© Esri",
         format='image/jpeg',
-        timeout=ESRI_TIMEOUT,
+        rate_limit=ESRI_RATE_LIMIT,
+        rate_burst=ESRI_RATE_BURST,
+        cache_ttl=SATELLITE_CACHE_TTL,
     ),
     "OpenTopoMap": ProviderData(
         min_zoom = 4,
@@ -83,7 +95,8 @@ PROVIDERS = {
         url='https://server.arcgisonline.com/arcgis/rest/services/World_Topo_Map/MapServer/tile/{z}/{y}/{x}',
         attribution="© Esri",
         format='image/jpeg',
-        timeout=ESRI_TIMEOUT,
+        rate_limit=ESRI_RATE_LIMIT,
+        rate_burst=ESRI_RATE_BURST,
     ),
     'OSM': ProviderData(
         min_zoom = MapSource.providers.get('osm')[1],
@@ -105,7 +118,8 @@ PROVIDERS = {
         url='https://server.arcgisonline.com/arcgis/rest/services/World_Street_Map/MapServer/tile/{z}/{y}/{x}',
         attribution="© Esri",
         format='image/jpeg',
-        timeout=ESRI_TIMEOUT,
+        rate_limit=ESRI_RATE_LIMIT,
+        rate_burst=ESRI_RATE_BURST,
     ),
     "Google Terrain": ProviderData(
         min_zoom=0,
@@ -113,7 +127,8 @@ PROVIDERS = {
         url='http://mt{s}.google.com/vt/lyrs=p&x={x}&y={y}&z={z}&hl=uk',
         attribution=f'Map data ©{current_year()} Google',
         subdomains=('0', '1', '2', '3'),
-        timeout=GOOGLE_TIMEOUT,
+        rate_limit=GOOGLE_RATE_LIMIT,
+        rate_burst=GOOGLE_RATE_BURST,
     ),
     "Google Roads": ProviderData(
         min_zoom=0,
@@ -121,6 +136,7 @@ PROVIDERS = {
         url='http://mt{s}.google.com/vt/lyrs=m&x={x}&y={y}&z={z}&hl=uk',
         attribution=f'Map data ©{current_year()} Google',
         subdomains=('0', '1', '2', '3'),
-        timeout=GOOGLE_TIMEOUT,
+        rate_limit=GOOGLE_RATE_LIMIT,
+        rate_burst=GOOGLE_RATE_BURST,
     ),
 }
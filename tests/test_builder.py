@@ -0,0 +1,514 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from mbtiles.exceptions import DownloadError, TileNotFoundError, UpdateMismatchError
+from mbtiles.sources import TileSource, MBTilesReader
+from mbtiles.tiles import MBTilesBuilder
+from mbtiles.tiles_threaded import MBTilesBuilderThreaded
+
+BBOX = (2.0, 48.0, 2.5, 48.5)
+ZOOMS = [8, 9, 10]
+
+
+class FakeSource(TileSource):
+    """
+    Tile source answering the tile position as content and counting the fetches
+    """
+    def __init__(self, fail_after=None, on_fetch=None):
+        """
+        fail_after -- raise after this number of fetches, to interrupt a run
+        on_fetch -- called before each fetch
+        """
+        super(FakeSource, self).__init__()
+        self.basename = 'fake'
+        self.fetched = []
+        self.fail_after = fail_after
+        self.on_fetch = on_fetch
+        self._lock = threading.Lock()
+
+    def tile(self, z, x, y):
+        if self.on_fetch:
+            self.on_fetch()
+        with self._lock:
+            if self.fail_after is not None and len(self.fetched) >= self.fail_after:
+                raise RuntimeError('interrupted')
+            self.fetched.append((z, x, y))
+        return ('%s/%s/%s' % (z, x, y)).encode()
+
+
+class BuilderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder, True)
+        self.filepath = os.path.join(self.folder, 'out.mbtiles')
+
+    def builder(self, source=None, **kwargs):
+        kwargs.setdefault('cache', False)
+        builder = MBTilesBuilder(filepath=self.filepath, tmp_dir=os.path.join(self.folder, 'tmp'),
+                                 tiles_url='http://tiles.test/{z}/{x}/{y}.png', rate_limit=0, **kwargs)
+        builder.reader = source or FakeSource()
+        return builder
+
+    def stored_tiles(self):
+        reader = MBTilesReader(self.filepath)
+        try:
+            return set(reader.iter_tiles())
+        finally:
+            reader.close()
+
+
+class CountTest(BuilderTestCase):
+    def test_counts_overlapping_coverages_like_listing(self):
+        builder = self.builder()
+        builder.add_coverage(BBOX, ZOOMS)
+        builder.add_coverage((2.3, 48.3, 3.0, 48.8), ZOOMS[1:] + [11])
+        builder.add_polygon_coverage([[[(2.4, 47.8), (2.9, 47.9), (2.6, 48.4), (2.4, 47.8)]]], [10, 12])
+        tiles = set()
+        for bbox, levels in builder._bboxes:
+            tiles.update(builder.tileslist(bbox, levels))
+        for polygons, levels, tileset in builder._polygons:
+            tiles.update(tileset)
+        self.assertEqual(builder.count_tiles_full(), len(tiles))
+        self.assertEqual(builder.count_tiles_per_zoom(),
+                         {z: sum(1 for tile in tiles if tile[0] == z) for z in builder.zoomlevels})
+
+    def test_counts_huge_coverage(self):
+        builder = self.builder()
+        builder.set_coverage((-180, -85, 180, 85), list(range(21)))
+        ranges = list(builder.tile_ranges((-180, -85, 180, 85), list(range(21))).values())
+        self.assertEqual(builder.count_tiles_full(), sum((x1 - x0) * (y1 - y0) for x0, x1, y0, y1 in ranges))
+        self.assertEqual(builder.count_tiles_per_zoom()[20], 2 ** 20 * (ranges[-1][3] - ranges[-1][2]))
+
+
+class PlanningTest(BuilderTestCase):
+    def test_gathers_zoom_levels_in_order(self):
+        for order, zooms in (('asc', ZOOMS), ('desc', ZOOMS[::-1])):
+            builder = self.builder(order=order)
+            builder.set_coverage(BBOX, ZOOMS)
+            builder.run(force=True)
+            fetched = [z for z, x, y in builder.reader.fetched]
+            self.assertEqual(fetched, sorted(fetched, key=zooms.index))
+            self.assertEqual(len(fetched), builder.count_tiles_full())
+
+    def test_lists_tiles_lazily(self):
+        builder = self.builder()
+        builder.set_coverage((-180, -85, 180, 85), [20, 4])
+        tiles = builder.iter_tiles_full()
+        self.assertEqual(next(tiles)[0], 4)
+        self.assertEqual(next(builder.iter_tiles_full('desc'))[0], 20)
+
+    def test_gathers_from_an_iterator(self):
+        builder = self.builder()
+        builder.set_coverage(BBOX, ZOOMS)
+        gathered = []
+        builder._gather_all = lambda tileslist: gathered.append(tileslist)
+        builder.run()
+        self.assertFalse(isinstance(gathered[0], (list, set, tuple)))
+
+
+class UpdateTest(BuilderTestCase):
+    def test_update_of_same_coverage_fetches_nothing(self):
+        builder = self.builder()
+        builder.set_coverage(BBOX, ZOOMS)
+        builder.run()
+        self.assertEqual(len(builder.reader.fetched), builder.count_tiles_full())
+
+        builder = self.builder()
+        builder.set_coverage(BBOX, ZOOMS)
+        builder.run(update=True)
+        self.assertEqual(builder.reader.fetched, [])
+
+    def test_update_adds_missing_tiles_only(self):
+        builder = self.builder()
+        builder.set_coverage(BBOX, ZOOMS[:2])
+        builder.run()
+        before = self.stored_tiles()
+
+        builder = self.builder()
+        builder.set_coverage(BBOX, ZOOMS)
+        builder.run(update=True)
+        self.assertEqual(set(builder.reader.fetched), set(builder.tileset_full()) - before)
+        self.assertEqual(self.stored_tiles(), set(builder.tileset_full()))
+
+    def test_refuses_update_with_other_format_or_source(self):
+        builder = self.builder()
+        builder.set_coverage(BBOX, ZOOMS[:1])
+        builder.run()
+        with open(self.filepath, 'rb') as f:
+            content = f.read()
+
+        for tiles_url in ('http://tiles.test/{z}/{x}/{y}.jpg', 'http://other.test/{z}/{x}/{y}.png'):
+            builder = MBTilesBuilder(filepath=self.filepath, tmp_dir=os.path.join(self.folder, 'tmp'),
+                                     tiles_url=tiles_url, rate_limit=0, cache=False)
+            builder.reader = FakeSource()
+            builder.set_coverage(BBOX, ZOOMS)
+            with self.assertRaises(UpdateMismatchError):
+                builder.run(update=True)
+            self.assertEqual(builder.reader.fetched, [])
+            with open(self.filepath, 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+    def test_resumed_update_progress_stays_within_total(self):
+        builder = self.builder()
+        builder.set_coverage(BBOX, ZOOMS[:1])
+        builder.run()
+
+        builder = self.builder(FakeSource(fail_after=10))
+        builder.set_coverage(BBOX, ZOOMS)
+        missing = builder.count_tiles_full() - len(self.stored_tiles())
+        with self.assertRaises(RuntimeError):
+            builder.run(update=True)
+
+        progress = []
+        builder = self.builder()
+        builder.reader.on_fetch = lambda: progress.append((builder._fetched_tiles, builder._total_tiles))
+        builder.set_coverage(BBOX, ZOOMS)
+        builder.run(update=True)
+        self.assertEqual(len(builder.reader.fetched), missing - 10)
+        self.assertEqual(progress[0], (10, missing))
+        self.assertEqual(progress[-1], (missing - 1, missing))
+
+
+class LocalSourcesTest(BuilderTestCase):
+    def test_takes_tiles_from_existing_files(self):
+        for dedup in (True, False):
+            builder = self.builder(dedup=dedup)
+            builder.set_coverage(BBOX, ZOOMS)
+            builder.run(force=True)
+            source = os.path.join(self.folder, 'source%s.mbtiles' % dedup)
+            os.replace(self.filepath, source)
+            reader = MBTilesReader(source)
+            self.assertTrue(all(reader.has_tile(*z_x_y) for z_x_y in builder.tileset_full()))
+            self.assertFalse(reader.has_tile(ZOOMS[0], 0, 0))
+            reader.close()
+
+            builder = self.builder(mbtiles_sources=[source])
+            builder.set_coverage(BBOX, ZOOMS)
+            self.assertFalse(any(builder._should_download(z_x_y) for z_x_y in builder.tileset_full()))
+            builder.run()
+            self.assertEqual(builder.reader.fetched, [])
+            self.assertEqual(self.stored_tiles(), set(builder.tileset_full()))
+            os.remove(self.filepath)
+
+
+    def test_takes_tiles_from_files_without_source_when_trusted(self):
+        builder = self.builder(attribution='(c) Tiles')
+        builder.set_coverage(BBOX, ZOOMS)
+        builder.run()
+        sources = os.path.join(self.folder, 'sources')
+        os.mkdir(sources)
+        source = os.path.join(sources, 'old.mbtiles')
+        os.replace(self.filepath, source)
+        self.execute(source, "DELETE FROM metadata WHERE name IN ('source', 'attribution')")
+
+        for mbtiles_sources, reused in (([sources], False), ([source], True)):
+            builder = self.builder(mbtiles_sources=mbtiles_sources)
+            self.assertEqual(len(builder._get_local_readers()), int(reused), mbtiles_sources)
+
+        self.execute(source, "INSERT INTO metadata (name, value) VALUES ('attribution', '(c) Tiles')")
+        for attribution, reused in (('(c) Tiles', True), ('(c) Other', False), (None, False)):
+            builder = self.builder(mbtiles_sources=[sources], attribution=attribution)
+            self.assertEqual(len(builder._get_local_readers()), int(reused), attribution)
+
+        self.execute(source, "UPDATE metadata SET value='jpg' WHERE name='format'")
+        builder = self.builder(mbtiles_sources=[source])
+        self.assertEqual(builder._get_local_readers(), [])
+
+    @staticmethod
+    def execute(filepath, sql):
+        con = sqlite3.connect(filepath)
+        try:
+            con.execute(sql)
+            con.commit()
+        finally:
+            con.close()
+
+
+class ThreadedTest(BuilderTestCase):
+    def threaded(self, **kwargs):
+        finished = threading.Event()
+        builder = MBTilesBuilderThreaded(filepath=self.filepath, tmp_dir=os.path.join(self.folder, 'tmp'),
+                                         tiles_url='http://tiles.test/{z}/{x}/{y}.png', rate_limit=0,
+                                         cache=False, workers=4, final_cb=finished.set, **kwargs)
+        builder.reader = FakeSource()
+        builder.set_coverage(BBOX, ZOOMS)
+        self.addCleanup(finished.wait, 10)
+        self.addCleanup(builder.stop)
+        return builder, finished
+
+    def test_reports_progress_of_workers(self):
+        progress = []
+        succeeded = threading.Event()
+        builder, finished = self.threaded(progress_cb=lambda done, total: progress.append((done, total)),
+                                          success_cb=succeeded.set)
+        total = builder.count_tiles_full()
+        builder.run()
+        self.assertTrue(finished.wait(10))
+        self.assertTrue(succeeded.is_set())
+        self.assertEqual(len(progress), total)
+        self.assertEqual(sorted(progress), [(done, total) for done in range(1, total + 1)])
+        self.assertEqual(self.stored_tiles(), set(builder.tileset_full()))
+
+    def test_pause_and_resume(self):
+        builder, finished = self.threaded()
+        paused = threading.Event()
+
+        def pause():
+            if len(builder.reader.fetched) == 3:
+                builder.pause()
+                paused.set()
+
+        builder.reader.on_fetch = pause
+        builder.run()
+        self.assertTrue(paused.wait(10))
+        time.sleep(0.3)
+        fetched = len(builder.reader.fetched)
+        self.assertLessEqual(fetched, 3 + builder.workers)
+        time.sleep(0.3)
+        self.assertEqual(len(builder.reader.fetched), fetched)
+        self.assertFalse(finished.is_set())
+        builder.reader.on_fetch = None
+        builder.resume()
+        self.assertTrue(finished.wait(10))
+        self.assertEqual(self.stored_tiles(), set(builder.tileset_full()))
+
+    def test_stop(self):
+        failed = threading.Event()
+        builder, finished = self.threaded(error_cb=failed.set)
+        builder.reader.on_fetch = lambda: len(builder.reader.fetched) == 3 and builder.stop()
+        builder.run()
+        self.assertTrue(finished.wait(10))
+        self.assertFalse(failed.is_set())
+        self.assertLessEqual(len(builder.reader.fetched), 3 + builder.workers)
+        self.assertFalse(os.path.exists(self.filepath))
+
+
+class ThrottledSource(FakeSource):
+    def tile(self, z, x, y):
+        with self._lock:
+            self.fetched.append((z, x, y))
+        raise DownloadError('Status code : 503', status_code=503)
+
+
+class ThrottleTest(BuilderTestCase):
+    def test_gives_up_on_a_provider_always_throttling(self):
+        builder = MBTilesBuilderThreaded(filepath=self.filepath, tmp_dir=os.path.join(self.folder, 'tmp'),
+                                         tiles_url='http://tiles.test/{z}/{x}/{y}.png', rate_limit=0,
+                                         cache=False, throttle_retries=3)
+        builder.reader = ThrottledSource()
+        builder._sleep = lambda seconds: None
+        for run_process in (True, False):
+            with self.assertRaises(DownloadError):
+                builder.tile((3, 1, 2), run_process=run_process)
+        self.assertEqual(len(builder.reader.fetched), 8)
+
+    def test_throttling_is_no_download_time_sample(self):
+        builder = self.builder(ThrottledSource())
+        samples = list(builder._tile_download_time_list)
+        with self.assertRaises(DownloadError):
+            builder.tile((3, 1, 2))
+        self.assertEqual(builder._tile_download_time_list, samples)
+
+
+class VersionedSource(FakeSource):
+    """
+    Tile source answering conditional requests, its tiles change when `version` is bumped
+    """
+    def __init__(self, **kwargs):
+        super(VersionedSource, self).__init__(**kwargs)
+        self.version = 1
+        self.validated = []
+        self.error = None
+
+    def tile_with_meta(self, z, x, y, meta=None):
+        if meta is not None:
+            self.validated.append(meta.get('etag'))
+        if self.error is not None:
+            raise self.error
+        etag = '"%s"' % self.version
+        if meta is not None and meta.get('etag') == etag:
+            return None, {'fetched': time.time(), 'etag': etag}
+        content = self.tile(z, x, y) + (b'@%d' % self.version)
+        return content, {'fetched': time.time(), 'etag': etag}
+
+
+class CacheTestCase(BuilderTestCase):
+    def builder(self, source=None, **kwargs):
+        kwargs.setdefault('memory_cache_mb', 0)
+        return super(CacheTestCase, self).builder(source, cache=True, tiles_dir=os.path.join(self.folder, 'cache'),
+                                                  **kwargs)
+
+    def expire(self, builder, z_x_y):
+        meta = builder.cache.read_meta(z_x_y)
+        builder.cache.save_meta(z_x_y, dict(meta, fetched=meta['fetched'] - builder.cache_ttl - 1))
+
+
+class RevalidationTest(CacheTestCase):
+    def test_uses_fresh_tiles(self):
+        builder = self.builder(VersionedSource())
+        self.assertEqual(builder.tile((3, 1, 2)), b'3/1/2@1')
+        self.assertEqual(builder.tile((3, 1, 2)), b'3/1/2@1')
+        self.assertEqual(builder.reader.fetched, [(3, 1, 2)])
+        self.assertEqual(builder.reader.validated, [])
+
+    def test_revalidates_expired_tiles(self):
+        for backend in ('disk', 'sqlite', 'dedup'):
+            builder = self.builder(VersionedSource(), cache_backend=backend, memory_cache_mb=1)
+            builder.cache.clean()
+            builder.tile((3, 1, 2))
+            self.expire(builder, (3, 1, 2))
+            self.assertEqual(builder.tile((3, 1, 2)), b'3/1/2@1')
+            self.assertEqual(builder.reader.validated, ['"1"'])
+            self.assertEqual(builder.reader.fetched, [(3, 1, 2)])
+            self.assertTrue(builder._is_fresh((3, 1, 2)))
+
+            self.expire(builder, (3, 1, 2))
+            builder.reader.version = 2
+            self.assertEqual(builder.tile((3, 1, 2)), b'3/1/2@2')
+            self.assertEqual(builder.cache.read((3, 1, 2)), b'3/1/2@2')
+            self.assertEqual(builder.cache.read_meta((3, 1, 2))['etag'], '"2"')
+            builder.cache.close()
+
+    def test_keeps_expired_tiles_if_revalidation_fails(self):
+        builder = self.builder(VersionedSource())
+        builder.tile((3, 1, 2))
+        self.expire(builder, (3, 1, 2))
+        builder.reader.error = DownloadError('Status code : 500', status_code=500)
+        self.assertEqual(builder.tile((3, 1, 2)), b'3/1/2@1')
+
+    def test_never_revalidates_without_ttl(self):
+        builder = self.builder(VersionedSource(), cache_ttl=0)
+        builder.tile((3, 1, 2))
+        builder.cache.save_meta((3, 1, 2), {'fetched': 0})
+        builder.tile((3, 1, 2))
+        self.assertEqual(builder.reader.validated, [])
+
+    def test_counts_age_of_tiles_cached_without_meta_from_now(self):
+        builder = self.builder(VersionedSource())
+        builder.cache.save(b'old', (3, 1, 2))
+        self.assertEqual(builder.tile((3, 1, 2)), b'old')
+        builder._flush_meta_backfill()
+        self.assertAlmostEqual(builder.cache.read_meta((3, 1, 2))['fetched'], time.time(), delta=60)
+        self.assertEqual(builder.reader.fetched, [])
+
+
+class SharedCacheTest(CacheTestCase):
+    def test_locks_tiles_of_shared_cache(self):
+        for shared in (False, True):
+            builder = self.builder(cache_shared=shared, memory_cache_mb=1)
+            self.assertEqual(builder.cache.shared, shared)
+            locks = os.path.join(builder.cache.folder, '.locks')
+            with builder.cache.lock((3, 1, 2)):
+                self.assertEqual(os.path.exists(os.path.join(locks, '3_1_2.lock')), shared)
+
+
+class HoleySource(FakeSource):
+    """
+    Tile source without tiles in its even columns
+    """
+    def tile(self, z, x, y):
+        content = super(HoleySource, self).tile(z, x, y)
+        if x % 2 == 0:
+            raise DownloadError('Status code : 404', status_code=404)
+        return content
+
+
+class MissingTilesTest(CacheTestCase):
+    def test_does_not_request_missing_tiles_again(self):
+        builder = self.builder(HoleySource())
+        for i in range(2):
+            with self.assertRaises(TileNotFoundError):
+                builder._tile((3, 0, 2))
+        self.assertEqual(builder.reader.fetched, [(3, 0, 2)])
+        self.assertEqual(builder.cache.read_missing((3, 0, 2))[1], 404)
+        self.assertFalse(builder._should_download((3, 0, 2)))
+        self.assertTrue(builder._should_download((3, 1, 2)))
+
+        builder = self.builder(HoleySource())
+        with self.assertRaises(TileNotFoundError):
+            builder._tile((3, 0, 2))
+        self.assertEqual(builder.reader.fetched, [])
+
+    def test_requests_missing_tiles_again_after_ttl(self):
+        builder = self.builder(HoleySource(), missing_ttl=0)
+        for i in range(2):
+            with self.assertRaises(TileNotFoundError):
+                builder._tile((3, 0, 2))
+        self.assertEqual(len(builder.reader.fetched), 2)
+
+    def test_other_errors_are_not_recorded(self):
+        builder = self.builder(ThrottledSource())
+        with self.assertRaises(DownloadError):
+            builder._tile((3, 1, 2))
+        self.assertIsNone(builder.cache.read_missing((3, 1, 2)))
+
+    def test_builds_without_missing_tiles(self):
+        builder = self.builder(HoleySource())
+        builder.set_coverage(BBOX, ZOOMS)
+        builder.run()
+        expected = {(z, x, y) for z, x, y in builder.tileset_full() if x % 2}
+        self.assertEqual(set(builder.missing_tiles), set(builder.tileset_full()) - expected)
+        self.assertTrue(builder.missing_tiles)
+        self.assertEqual(self.stored_tiles(), expected)
+
+    def test_fails_on_missing_tiles_without_skip_missing(self):
+        builder = self.builder(HoleySource(), skip_missing=False)
+        with self.assertRaises(TileNotFoundError):
+            builder.tile((3, 0, 2))
+
+
+class SingleFlightTest(BuilderTestCase):
+    def concurrent_tiles(self, builder, z_x_y, count=8):
+        """
+        Request `z_x_y` from `count` threads while the first fetch is held, return their results
+        """
+        started, release = threading.Event(), threading.Event()
+
+        def hold():
+            started.set()
+            release.wait(10)
+
+        builder.reader.on_fetch = hold
+        results = [None] * count
+
+        def request(i):
+            try:
+                results[i] = builder._tile(z_x_y)[0]
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(count)]
+        threads[0].start()
+        self.assertTrue(started.wait(10))
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.2)  # let the other threads find the tile in flight
+        release.set()
+        for thread in threads:
+            thread.join(10)
+        builder.reader.on_fetch = None
+        return results
+
+    def test_fetches_tile_requested_concurrently_once(self):
+        builder = self.builder()
+        results = self.concurrent_tiles(builder, (3, 1, 2))
+        self.assertEqual(results, [b'3/1/2'] * 8)
+        self.assertEqual(builder.reader.fetched, [(3, 1, 2)])
+        self.assertEqual(builder._inflight, {})
+
+    def test_shares_fetch_errors(self):
+        builder = self.builder(FakeSource(fail_after=0))
+        results = self.concurrent_tiles(builder, (3, 1, 2))
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+        builder.reader.fail_after = None
+        self.assertEqual(builder._tile((3, 1, 2))[0], b'3/1/2')
+        self.assertEqual(builder.reader.fetched, [(3, 1, 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
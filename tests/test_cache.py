@@ -0,0 +1,189 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mbtiles.cache import ContentAddressed, Disk, Memory, Sqlite
+from mbtiles.mbutil import tile_hash
+from mbtiles.tileset import TileSet
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder, True)
+
+
+class DiskTest(CacheTestCase):
+    def test_read_of_a_file_removed_behind_the_cache(self):
+        cache = Disk('provider', self.folder)
+        cache.save(b'tile', (3, 1, 2))
+        self.assertEqual(cache.count_cached([(3, 1, 2)]), 1)
+        os.remove(cache.tile_fullpath((3, 1, 2)))
+        self.assertIsNone(cache.read((3, 1, 2)))
+        self.assertEqual(cache.count_cached([(3, 1, 2)]), 0)
+
+    def test_locks_with_files_only_when_shared(self):
+        locks = os.path.join(self.folder, 'provider', '.locks')
+        with Disk('provider', self.folder).lock((3, 1, 2)):
+            self.assertFalse(os.path.exists(locks))
+        with Disk('provider', self.folder, shared=True).lock((3, 1, 2)):
+            self.assertEqual(os.listdir(locks), ['3_1_2.lock'])
+        self.assertEqual(os.listdir(locks), [])
+
+
+class CachedIndexTest(CacheTestCase):
+    cached = {(5, x, y) for x in range(3, 9) for y in range(10, 14)} | {(6, 0, 0), (6, 63, 63)}
+
+    def test_counts_cached_tiles(self):
+        for cache_class in (Disk, Sqlite, ContentAddressed):
+            cache = cache_class(cache_class.__name__, self.folder)
+            for z_x_y in self.cached:
+                cache.save(b'tile', z_x_y)
+            # a new instance indexes the stored tiles
+            cache.close()
+            cache = cache_class(cache_class.__name__, self.folder)
+            small = TileSet.from_ranges({5: [(4, 6, 11, 12)], 6: [(0, 1, 0, 1)]})
+            large = TileSet.from_ranges({5: [(0, 32, 12, 32)], 6: [(0, 64, 0, 64)]})
+            for tileset in (small, large):
+                expected = self.cached & set(tileset)
+                self.assertEqual(cache.contains_many(tileset), expected)
+                self.assertEqual(cache.count_cached(tileset), len(expected))
+                self.assertEqual(cache.count_cached_tileset(tileset), len(expected))
+
+            cache.save(b'tile', (5, 0, 31))
+            cache.remove((6, 0, 0))
+            cached = (self.cached | {(5, 0, 31)}) - {(6, 0, 0)}
+            self.assertEqual(cache.contains_many(large), cached & set(large))
+            self.assertEqual(cache.count_cached_tileset(small), len(cached & set(small)))
+            cache.close()
+
+
+class SqliteTest(CacheTestCase):
+    def test_save_read_remove(self):
+        cache = Sqlite('provider', self.folder)
+        self.assertIsNone(cache.read((3, 1, 2)))
+        cache.save(b'tile', (3, 1, 2))
+        cache.save(b'other', (3, 1, 3))
+        cache.save(b'new', (3, 1, 3))
+        self.assertEqual(cache.read((3, 1, 2)), b'tile')
+        self.assertEqual(cache.read((3, 1, 3)), b'new')
+        self.assertTrue(cache.exists((3, 1, 2)))
+        self.assertEqual(cache.count_cached([(3, 1, 2), (3, 1, 3), (3, 0, 0)]), 2)
+        cache.remove((3, 1, 2))
+        self.assertIsNone(cache.read((3, 1, 2)))
+        self.assertFalse(cache.exists((3, 1, 2)))
+        cache.close()
+
+    def test_single_database_file(self):
+        cache = Sqlite('provider', self.folder)
+        for y in range(10):
+            cache.save(b'tile', (4, 3, y))
+        cache.save_meta((4, 3, 0), {'fetched': 1.0, 'etag': '"a"'})
+        cache.close()
+        self.assertEqual([name for name in os.listdir(cache.folder) if not name.startswith('tiles.sqlite-')],
+                         ['tiles.sqlite'])
+
+        cache = Sqlite('provider', self.folder)
+        self.assertEqual(cache.count_cached((4, 3, y) for y in range(16)), 10)
+        self.assertEqual(cache.read((4, 3, 9)), b'tile')
+        self.assertEqual(cache.read_meta((4, 3, 0)), {'fetched': 1.0, 'etag': '"a"', 'last_modified': None})
+        cache.close()
+
+    def test_clean(self):
+        cache = Sqlite('provider', self.folder)
+        cache.save(b'tile', (3, 1, 2))
+        cache.clean()
+        self.assertFalse(os.path.exists(cache.folder))
+
+
+class MemoryTest(CacheTestCase):
+    def setUp(self):
+        super(MemoryTest, self).setUp()
+        self.backend = Disk('provider', self.folder)
+        self.cache = Memory(self.backend, 10)
+
+    def test_reads_through_and_counts_hits(self):
+        self.backend.save(b'abc', (3, 1, 2))
+        self.assertEqual(self.cache.read((3, 1, 2)), b'abc')
+        self.assertEqual(self.cache.read((3, 1, 2)), b'abc')
+        self.assertIsNone(self.cache.read((3, 1, 3)))
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 2, 'tiles': 1, 'bytes': 3})
+
+    def test_evicts_least_recently_used_beyond_budget(self):
+        for y in range(3):
+            self.cache.save(b'abcd', (3, 1, y))
+        self.assertEqual(self.cache.size, 8)
+        self.cache.save(b'abcd', (3, 1, 0))
+        self.cache.save(b'abcd', (3, 1, 3))
+        self.assertEqual(self.cache.stats()['tiles'], 2)
+        os.remove(self.backend.tile_fullpath((3, 1, 0)))
+        os.remove(self.backend.tile_fullpath((3, 1, 2)))
+        self.assertEqual(self.cache.read((3, 1, 0)), b'abcd')
+        self.assertIsNone(self.cache.read((3, 1, 2)))
+        self.assertEqual(self.cache.read((3, 1, 1)), b'abcd')
+
+    def test_does_not_hold_tiles_over_budget(self):
+        self.cache.save(b'x' * 11, (3, 1, 2))
+        self.assertEqual(self.cache.size, 0)
+        self.assertEqual(self.backend.read((3, 1, 2)), b'x' * 11)
+
+    def test_remove_and_clean(self):
+        self.cache.save(b'abc', (3, 1, 2))
+        self.cache.remove((3, 1, 2))
+        self.assertIsNone(self.cache.read((3, 1, 2)))
+        self.cache.save(b'abc', (3, 1, 2))
+        self.cache.clean()
+        self.assertEqual(self.cache.size, 0)
+        self.assertIsNone(self.cache.read((3, 1, 2)))
+
+
+class ContentAddressedTest(CacheTestCase):
+    def setUp(self):
+        super(ContentAddressedTest, self).setUp()
+        self.cache = ContentAddressed('provider', self.folder)
+        self.addCleanup(self.cache.close)
+
+    def blobs(self):
+        return sorted(name for prefix in os.listdir(self.cache.blobs_folder)
+                      for name in os.listdir(os.path.join(self.cache.blobs_folder, prefix)))
+
+    def test_stores_identical_tiles_once(self):
+        for y in range(5):
+            self.cache.save(b'sea', (3, 1, y))
+        self.cache.save(b'land', (3, 2, 0))
+        self.assertEqual(len(self.blobs()), 2)
+        self.assertEqual(self.cache.read((3, 1, 4)), b'sea')
+        self.assertEqual(self.cache.read((3, 2, 0)), b'land')
+        self.assertEqual(self.cache.count_cached((3, x, y) for x in range(8) for y in range(8)), 6)
+
+    def test_removes_unreferenced_blobs(self):
+        self.cache.save(b'sea', (3, 1, 0))
+        self.cache.save(b'sea', (3, 1, 1))
+        self.cache.remove((3, 1, 0))
+        self.assertEqual(len(self.blobs()), 1)
+        self.cache.save(b'land', (3, 1, 1))
+        self.assertEqual(self.blobs(), [tile_hash(b'land') + '.png'])
+        self.assertEqual(self.cache.read((3, 1, 1)), b'land')
+        self.cache.remove((3, 1, 1))
+        self.assertEqual(self.blobs(), [])
+        self.assertIsNone(self.cache.read((3, 1, 1)))
+
+    def test_resaving_same_content_keeps_references(self):
+        self.cache.save(b'sea', (3, 1, 0))
+        self.cache.save(b'sea', (3, 1, 0))
+        self.cache.save(b'sea', (3, 1, 1))
+        self.cache.remove((3, 1, 0))
+        self.assertEqual(self.cache.read((3, 1, 1)), b'sea')
+
+    def test_blob_removed_behind_the_cache(self):
+        self.cache.save(b'sea', (3, 1, 0))
+        os.remove(self.cache.blob_fullpath(tile_hash(b'sea')))
+        self.assertIsNone(self.cache.read((3, 1, 0)))
+        self.assertFalse(self.cache.exists((3, 1, 0)))
+        self.cache.save(b'sea', (3, 1, 1))
+        self.assertEqual(self.cache.read((3, 1, 1)), b'sea')
+
+
+if __name__ == '__main__':
+    unittest.main()
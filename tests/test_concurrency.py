@@ -0,0 +1,33 @@
+import random
+import unittest
+
+from mbtiles.concurrency import AdaptiveLimit
+
+
+class AdaptiveLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(0)
+
+    def feed(self, limit, count, median):
+        for _ in range(count):
+            limit.on_success(median * self.random.lognormvariate(0, 0.5))
+
+    def test_holds_steady_under_jitter(self):
+        limit = AdaptiveLimit(8, initial=4)
+        self.feed(limit, 5000, 0.05)
+        self.assertEqual(limit.limit, 8)
+
+    def test_shrinks_on_sustained_latency_rise(self):
+        limit = AdaptiveLimit(8, initial=4)
+        self.feed(limit, 1000, 0.05)
+        self.feed(limit, 50, 0.5)
+        self.assertLess(limit.limit, 8)
+
+    def test_shrinks_on_throttle(self):
+        limit = AdaptiveLimit(8, initial=8)
+        limit.on_throttle()
+        self.assertEqual(limit.limit, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
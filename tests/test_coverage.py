@@ -0,0 +1,119 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mbtiles.coverage import (_Polygon, _segment_in_rect, corridor_polygons, geojson_polygons, load_geojson,
+                              polygons_tileset)
+from mbtiles.exceptions import InvalidCoverageError
+from mbtiles.proj import GoogleProjection
+from mbtiles.tileset import TileSet
+
+SQUARE = [(2.0, 48.0), (2.5, 48.0), (2.5, 48.5), (2.0, 48.5), (2.0, 48.0)]
+TRIANGLE_WITH_HOLE = [[(-10, -10), (30, -5), (5, 40), (-10, -10)],
+                      [(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)]]
+
+
+class PolygonTest(unittest.TestCase):
+    def brute_force(self, rings, z):
+        """
+        Return the tiles at zoom `z` crossed by an edge of the polygon or with their center inside it
+        """
+        polygon = _Polygon(rings)
+        size = 1 / 2 ** z
+        return {(z, x, y) for x in range(2 ** z) for y in range(2 ** z)
+                if polygon.contains((x + 0.5) * size, (y + 0.5) * size)
+                or any(_segment_in_rect(edge, x * size, y * size, (x + 1) * size, (y + 1) * size)
+                       for edge in polygon.edges)}
+
+    def test_matches_brute_force(self):
+        for rings in ([SQUARE], TRIANGLE_WITH_HOLE):
+            tileset = polygons_tileset([rings], [4, 5, 7])
+            for z in (4, 5, 7):
+                self.assertEqual(set(tileset.iter_zoom(z)), self.brute_force(rings, z))
+
+    def test_rectangle_matches_bounding_box(self):
+        ranges = GoogleProjection(256, [8, 10, 12], 'xyz').tile_ranges((2.0, 48.0, 2.5, 48.5))
+        self.assertEqual(polygons_tileset([[SQUARE]], [8, 10, 12]),
+                         TileSet.from_ranges({z: [zoom_range] for z, zoom_range in ranges.items()}))
+
+    def test_excludes_holes(self):
+        tileset = polygons_tileset([TRIANGLE_WITH_HOLE], [8])
+        filled = polygons_tileset([TRIANGLE_WITH_HOLE[:1]], [8])
+        within_hole = polygons_tileset([[[(2, 2), (8, 2), (8, 8), (2, 8)]]], [8])
+        self.assertFalse(tileset & within_hole)
+        self.assertFalse(within_hole - (filled - tileset))
+        self.assertFalse(tileset - filled)
+
+    def test_tms_scheme(self):
+        xyz = polygons_tileset([[SQUARE]], [9])
+        tms = polygons_tileset([[SQUARE]], [9], scheme='tms')
+        self.assertEqual({(z, x, 2 ** z - 1 - y) for z, x, y in xyz}, set(tms))
+
+    def test_multipolygons_union(self):
+        other = [(x + 1, y) for x, y in SQUARE]
+        self.assertEqual(polygons_tileset([[SQUARE], [other]], [8]),
+                         polygons_tileset([[SQUARE]], [8]) | polygons_tileset([[other]], [8]))
+
+    def test_invalid_polygons(self):
+        with self.assertRaises(InvalidCoverageError):
+            polygons_tileset([[[(0, 0), (1, 1)]]], [3])
+        with self.assertRaises(InvalidCoverageError):
+            polygons_tileset([[[(0, 0), (200, 0), (0, 1)]]], [3])
+        with self.assertRaises(InvalidCoverageError):
+            polygons_tileset([[SQUARE]], [])
+
+
+class GeoJSONTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder, True)
+
+    def test_polygons_of_features(self):
+        geojson = {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'geometry': {'type': 'Polygon', 'coordinates': [SQUARE]}},
+            {'type': 'Feature', 'geometry': {'type': 'MultiPolygon', 'coordinates': [TRIANGLE_WITH_HOLE]}},
+            {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [1, 2]}},
+            {'type': 'Feature', 'geometry': None},
+        ]}
+        self.assertEqual(geojson_polygons(geojson), [[SQUARE], TRIANGLE_WITH_HOLE])
+
+    def test_load(self):
+        path = os.path.join(self.folder, 'coverage.geojson')
+        with open(path, 'w') as f:
+            json.dump({'type': 'Polygon', 'coordinates': [SQUARE]}, f)
+        self.assertEqual(load_geojson(path), [[[list(point) for point in SQUARE]]])
+        with open(path, 'w') as f:
+            json.dump({'type': 'Point', 'coordinates': [1, 2]}, f)
+        with self.assertRaises(InvalidCoverageError):
+            load_geojson(path)
+        with open(path, 'w') as f:
+            f.write('{')
+        with self.assertRaises(InvalidCoverageError):
+            load_geojson(path)
+
+
+class CorridorTest(unittest.TestCase):
+    def columns(self, polygons, z):
+        return sorted({x for z, x, y in polygons_tileset(polygons, [z])})
+
+    def test_keeps_coordinates_within_world(self):
+        polygons = corridor_polygons([[(179.9, 10), (-179.9, 10.1)]], 20)
+        for polygon in polygons:
+            for lon, lat in polygon[0]:
+                self.assertTrue(-180 <= lon <= 180)
+
+    def test_route_crossing_antimeridian(self):
+        polygons = corridor_polygons([[(179.5, 0), (-179.5, 0.2)]], 10)
+        self.assertEqual(self.columns(polygons, 6), [0, 63])
+
+    def test_buffer_crossing_antimeridian(self):
+        polygons = corridor_polygons([[(179.99, 10)]], 5)
+        self.assertEqual(self.columns(polygons, 8), [0, 255])
+        polygons = corridor_polygons([[(-179.99, 10)]], 5)
+        self.assertEqual(self.columns(polygons, 8), [0, 255])
+
+
+if __name__ == '__main__':
+    unittest.main()
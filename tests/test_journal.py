@@ -0,0 +1,156 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from mbtiles.journal import CHUNK_SIZE, JobJournal, TileBitmap
+from mbtiles.tiles_threaded import MBTilesBuilderThreaded
+
+from tests.test_builder import BBOX, ZOOMS, BuilderTestCase, FakeSource
+
+
+class TileBitmapTest(unittest.TestCase):
+    def test_add_and_contains(self):
+        bitmap = TileBitmap()
+        self.assertTrue(bitmap.add((4, 10, 20)))
+        self.assertFalse(bitmap.add((4, 10, 20)))
+        self.assertTrue(bitmap.add((4, 14, 22)))
+        self.assertIn((4, 14, 22), bitmap)
+        self.assertNotIn((4, 11, 20), bitmap)
+        self.assertNotIn((5, 10, 20), bitmap)
+        self.assertEqual(bitmap.count, 2)
+        self.assertEqual(len(bitmap.chunks), 1)
+
+    def test_allocates_chunks_of_done_tiles_only(self):
+        bitmap = TileBitmap()
+        far = 2 ** 18 - 1
+        bitmap.add((18, 0, 0))
+        bitmap.add((18, far, far))
+        self.assertEqual(sorted(bitmap.chunks), [(18, 0, 0), (18, far // CHUNK_SIZE, far // CHUNK_SIZE)])
+        self.assertIn((18, far, far), bitmap)
+        self.assertNotIn((18, far, 0), bitmap)
+
+
+class JobJournalTest(unittest.TestCase):
+    params = {'tiles_url': 'http://tiles.test/{z}/{x}/{y}.png'}
+    extents = {3: (0, 0, 7, 7), 4: (2, 3, 5, 9)}
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder, True)
+        self.path = os.path.join(self.folder, 'journal.sqlite')
+
+    def test_resumes_same_job(self):
+        journal = JobJournal(self.path)
+        self.assertFalse(journal.open(self.params, self.extents))
+        journal.mark_done((3, 1, 2))
+        journal.mark_done((4, 5, 9))
+        journal.mark_done((4, 5, 9))
+        journal.close()
+
+        journal = JobJournal(self.path)
+        self.assertTrue(journal.open(self.params, self.extents))
+        self.assertTrue(journal.is_done((3, 1, 2)))
+        self.assertTrue(journal.is_done((4, 5, 9)))
+        self.assertFalse(journal.is_done((4, 2, 3)))
+        self.assertEqual(journal.done_count(), 2)
+        journal.close()
+
+    def test_restarts_other_job(self):
+        journal = JobJournal(self.path)
+        journal.open(self.params, self.extents)
+        journal.mark_done((3, 1, 2))
+        journal.close()
+
+        for params, extents in ((dict(self.params, tile_format='image/jpeg'), self.extents),
+                                (self.params, {3: (0, 0, 7, 7)})):
+            journal = JobJournal(self.path)
+            self.assertFalse(journal.open(params, extents))
+            self.assertEqual(journal.done_count(), 0)
+            journal.close()
+
+    def test_writes_changed_chunks_only(self):
+        far = 2 ** 18 - 1
+        journal = JobJournal(self.path)
+        journal.open(self.params, {18: (0, 0, far, far)})
+        journal.mark_done((18, 0, 0))
+        journal.flush()
+        con = sqlite3.connect(self.path)
+        con.execute("UPDATE chunks SET bitmap = zeroblob(length(bitmap))")
+        con.commit()
+        con.close()
+        journal.mark_done((18, far, far))
+        self.assertEqual(journal.done_count(), 2)
+        journal.close()
+
+        journal = JobJournal(self.path)
+        self.assertTrue(journal.open(self.params, {18: (0, 0, far, far)}))
+        self.assertFalse(journal.is_done((18, 0, 0)))
+        self.assertTrue(journal.is_done((18, far, far)))
+        self.assertEqual(journal.done_count(), 1)
+        journal.close()
+        self.assertLess(os.path.getsize(self.path), 64 * 1024)
+
+    def test_ignores_tiles_out_of_extents(self):
+        journal = JobJournal(self.path)
+        journal.open(self.params, self.extents)
+        journal.mark_done((4, 6, 9))
+        journal.mark_done((5, 0, 0))
+        self.assertFalse(journal.is_done((4, 6, 9)))
+        self.assertFalse(journal.is_done((5, 0, 0)))
+        self.assertEqual(journal.done_count(), 0)
+        journal.close()
+
+    def test_remove(self):
+        journal = JobJournal(self.path)
+        journal.open(self.params, self.extents)
+        journal.remove()
+        self.assertFalse(os.path.exists(self.path))
+
+
+class ResumeTest(BuilderTestCase):
+    def interrupt(self, **kwargs):
+        builder = self.builder(FakeSource(fail_after=5), **kwargs)
+        builder.set_coverage(BBOX, ZOOMS)
+        with self.assertRaises(RuntimeError):
+            builder.run()
+        self.assertFalse(os.path.exists(self.filepath))
+        return builder.count_tiles_full()
+
+    def test_resumes_interrupted_run(self):
+        for stream in (True, False):
+            total = self.interrupt(stream=stream)
+            builder = self.builder(stream=stream)
+            builder.set_coverage(BBOX, ZOOMS)
+            builder.run()
+            self.assertLessEqual(len(builder.reader.fetched), total - 5)
+            self.assertEqual(self.stored_tiles(), set(builder.tileset_full()))
+            self.assertFalse(os.path.exists(os.path.join(self.folder, 'tmp', 'journal.sqlite')))
+            os.remove(self.filepath)
+
+    def test_restarts_without_resume(self):
+        total = self.interrupt(resume=False)
+        builder = self.builder(resume=False)
+        builder.set_coverage(BBOX, ZOOMS)
+        builder.run()
+        self.assertEqual(len(builder.reader.fetched), total)
+
+    def test_option_does_not_hide_resume_method(self):
+        builder = MBTilesBuilderThreaded(filepath=self.filepath, tmp_dir=os.path.join(self.folder, 'tmp'),
+                                         tiles_url='http://tiles.test/{z}/{x}/{y}.png', resume=False)
+        builder.pause()
+        builder.resume()
+        self.assertTrue(builder._resume_event.is_set())
+
+    def test_restarts_changed_job(self):
+        self.interrupt()
+        builder = self.builder()
+        builder.set_coverage(BBOX, ZOOMS[:2])
+        builder.run()
+        self.assertEqual(len(builder.reader.fetched), builder.count_tiles_full())
+        self.assertEqual(self.stored_tiles(), set(builder.tileset_full()))
+
+
+if __name__ == '__main__':
+    unittest.main()
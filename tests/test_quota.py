@@ -0,0 +1,135 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from mbtiles.cache import TOUCH_INTERVAL, ContentAddressed, Disk, Sqlite
+from mbtiles.quota import CacheQuota
+
+TILE_SIZE = 1000
+OLD = time.time() - 3600
+
+
+class QuotaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder, True)
+
+    def fill(self, cache, count):
+        """
+        Save `count` distinct tiles, the first ones used longest ago
+        """
+        tiles = [(10, x, 0) for x in range(count)]
+        for i, z_x_y in enumerate(tiles):
+            cache.save(bytes([i]) * TILE_SIZE, z_x_y)
+        return tiles
+
+
+class DiskQuotaTest(QuotaTestCase):
+    def test_evicts_least_recently_used_tiles_only(self):
+        cache = Disk('provider', self.folder, shared=True)
+        tiles = self.fill(cache, 10)
+        for i, z_x_y in enumerate(tiles):
+            os.utime(cache.tile_fullpath(z_x_y), (OLD + i, OLD + i))
+        cache.save_meta(tiles[0], {'fetched': OLD})
+        with cache.lock(tiles[0]):
+            freed = CacheQuota(self.folder, 5 * TILE_SIZE).evict()
+            self.assertTrue(os.listdir(os.path.join(cache.folder, '.locks')))
+        self.assertEqual(freed, 6 * TILE_SIZE)
+        self.assertEqual([cache.exists(z_x_y) for z_x_y in tiles], [False] * 6 + [True] * 4)
+        self.assertIsNone(cache.read_meta(tiles[0]))
+        self.assertTrue(os.path.exists(os.path.join(cache.folder, 'meta.sqlite')))
+
+    def test_keeps_recently_used_tiles(self):
+        cache = Disk('provider', self.folder)
+        tiles = self.fill(cache, 10)
+        self.assertEqual(CacheQuota(self.folder, 5 * TILE_SIZE).evict(), 0)
+        self.assertTrue(all(cache.exists(z_x_y) for z_x_y in tiles))
+
+    def test_reads_touch_tiles_not_used_recently(self):
+        cache = Disk('provider', self.folder)
+        z_x_y = self.fill(cache, 1)[0]
+        path = cache.tile_fullpath(z_x_y)
+        os.utime(path, (time.time() - TOUCH_INTERVAL / 2, OLD))
+        with mock.patch('mbtiles.cache.os.utime') as utime:
+            cache.read(z_x_y)
+            utime.assert_not_called()
+        os.utime(path, (OLD, OLD))
+        cache.read(z_x_y)
+        self.assertGreater(os.stat(path).st_atime, time.time() - TOUCH_INTERVAL)
+        self.assertAlmostEqual(os.stat(path).st_mtime, OLD, places=3)
+
+
+class RunningTotalTest(QuotaTestCase):
+    def test_walks_the_cache_only_over_the_quota(self):
+        cache = Disk('provider', self.folder)
+        tiles = self.fill(cache, 4)
+        quota = CacheQuota(self.folder, 5 * TILE_SIZE)
+        with mock.patch.object(quota, '_caches', wraps=quota._caches) as walks:
+            self.assertEqual(quota.evict(), 0)
+            self.assertEqual(quota.evict(), 0)
+            self.assertEqual(walks.call_count, 1)
+            for i, z_x_y in enumerate(tiles):
+                os.utime(cache.tile_fullpath(z_x_y), (OLD + i, OLD + i))
+            cache.save(bytes([4]) * TILE_SIZE, (10, 4, 0))
+            self.assertEqual(quota.evict(), 0)
+            self.assertEqual(walks.call_count, 1)
+            cache.save(bytes([5]) * TILE_SIZE, (10, 5, 0))
+            self.assertEqual(quota.evict(), 2 * TILE_SIZE)
+            self.assertEqual(walks.call_count, 2)
+            self.assertEqual(quota.evict(), 0)
+            self.assertEqual(walks.call_count, 2)
+        self.assertEqual(quota.size(), 4 * TILE_SIZE)
+
+
+class SqliteQuotaTest(QuotaTestCase):
+    def age(self, cache, table):
+        con = sqlite3.connect(cache.filepath)
+        con.execute("UPDATE %s SET used = %s + rowid" % (table, OLD))
+        con.commit()
+        con.close()
+
+    def test_deletes_rows_of_an_open_database(self):
+        cache = Sqlite('provider', self.folder)
+        tiles = self.fill(cache, 10)
+        self.age(cache, 'tiles')
+        quota = CacheQuota(self.folder, 5 * TILE_SIZE)
+        self.assertEqual(quota.evict(), 6 * TILE_SIZE)
+        self.assertEqual([cache.read(z_x_y) is not None for z_x_y in tiles], [False] * 6 + [True] * 4)
+        cache.save(b'new', (10, 0, 1))
+        self.assertEqual(cache.read((10, 0, 1)), b'new')
+        self.assertEqual(quota.size(), 4 * TILE_SIZE + 3)
+
+    def test_reads_delay_eviction(self):
+        cache = Sqlite('provider', self.folder)
+        tiles = self.fill(cache, 10)
+        self.age(cache, 'tiles')
+        cache.read(tiles[0])
+        cache.close()
+        CacheQuota(self.folder, 5 * TILE_SIZE).evict()
+        self.assertIsNotNone(cache.read(tiles[0]))
+        self.assertIsNone(cache.read(tiles[1]))
+
+
+class ContentAddressedQuotaTest(QuotaTestCase):
+    def test_evicts_blobs_with_their_tiles(self):
+        cache = ContentAddressed('provider', self.folder)
+        tiles = self.fill(cache, 10)
+        cache.save(bytes([9]) * TILE_SIZE, (10, 0, 1))  # shares the most recent blob
+        con = sqlite3.connect(cache.filepath)
+        con.execute("UPDATE blobs SET used = ? + (SELECT tile_column FROM map WHERE map.tile_id = blobs.tile_id)",
+                    (OLD,))
+        con.commit()
+        con.close()
+        self.assertEqual(CacheQuota(self.folder, 5 * TILE_SIZE).evict(), 6 * TILE_SIZE)
+        self.assertEqual([cache.read(z_x_y) is not None for z_x_y in tiles], [False] * 6 + [True] * 4)
+        self.assertEqual(cache.read((10, 0, 1)), bytes([9]) * TILE_SIZE)
+        blobs = [name for root, dirs, files in os.walk(cache.blobs_folder) for name in files]
+        self.assertEqual(len(blobs), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
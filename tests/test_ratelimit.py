@@ -0,0 +1,82 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from mbtiles.ratelimit import TokenBucket, get_limiter
+from mbtiles.sources import TileDownloader
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('mbtiles.ratelimit.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_allows_burst_then_rate(self):
+        bucket = TokenBucket(10, burst=5)
+        self.assertEqual([bucket.reserve() for _ in range(5)], [0] * 5)
+        delays = [bucket.reserve() for _ in range(3)]
+        for delay, expected in zip(delays, (0.1, 0.2, 0.3)):
+            self.assertAlmostEqual(delay, expected)
+
+    def test_refills_after_idle_time_up_to_burst(self):
+        bucket = TokenBucket(10, burst=5)
+        for _ in range(5):
+            bucket.reserve()
+        self.clock.now += 0.2
+        self.assertEqual([bucket.reserve() for _ in range(2)], [0, 0])
+        self.assertGreater(bucket.reserve(), 0)
+        self.clock.now += 60
+        self.assertEqual([bucket.reserve() for _ in range(5)], [0] * 5)
+        self.assertGreater(bucket.reserve(), 0)
+
+    def test_no_limit(self):
+        for rate in (0, None):
+            bucket = TokenBucket(rate)
+            self.assertEqual([bucket.reserve() for _ in range(100)], [0] * 100)
+
+    def test_reconfigure(self):
+        bucket = TokenBucket(0, burst=3)
+        bucket.configure(2, burst=1)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.5)
+
+
+class SharedLimiterTest(unittest.TestCase):
+    def test_one_bucket_per_host(self):
+        limiter = get_limiter('tiles.test:1', 5, 2)
+        self.assertIs(get_limiter('tiles.test:1', 5, 2), limiter)
+        self.assertIsNot(get_limiter('tiles.test:2', 5, 2), limiter)
+        self.assertIs(get_limiter('tiles.test:1', 8, 4), limiter)
+        self.assertEqual((limiter.rate, limiter.burst), (8, 4))
+
+    def test_downloaders_of_a_host_share_the_bucket(self):
+        first = TileDownloader('http://{s}.shared.test/a/{z}/{x}/{y}.png', rate_limit=5)
+        second = TileDownloader('http://{s}.shared.test/b/{z}/{x}/{y}.png', rate_limit=5)
+        other = TileDownloader('http://{s}.other.test/a/{z}/{x}/{y}.png', rate_limit=5)
+        self.assertIs(first.limiter, second.limiter)
+        self.assertIsNot(first.limiter, other.limiter)
+
+    def test_rate_across_threads(self):
+        bucket = TokenBucket(100, burst=1)
+        start = time.monotonic()
+        threads = [threading.Thread(target=lambda: [bucket.acquire() for _ in range(5)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mbtiles.exceptions import DownloadError
+from mbtiles.sources import TileDownloader
+from mbtiles.sources_async import AsyncTileDownloader, has_aiohttp
+
+
+class TileServer(ThreadingHTTPServer):
+    """
+    Local tiles server answering `status` after `delay` s, and counting the requests
+    """
+    daemon_threads = True
+
+    def __init__(self, status=200, delay=0):
+        super(TileServer, self).__init__(('127.0.0.1', 0), TileHandler)
+        self.status = status
+        self.delay = delay
+        self.requests = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/{z}/{x}/{y}.png' % self.server_address[1]
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(self.server.delay)
+        body = self.path.encode() if self.server.status == 200 else b''
+        try:
+            self.send_response(self.server.status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            pass  # the client timed out
+
+    def log_message(self, *args):
+        pass
+
+
+class TileServerTestCase(unittest.TestCase):
+    def server(self, **kwargs):
+        server = TileServer(**kwargs)
+        self.addCleanup(server.close)
+        return server
+
+
+class TileDownloaderTest(TileServerTestCase):
+    def test_downloads_tile(self):
+        server = self.server()
+        downloader = TileDownloader(server.url, rate_limit=0)
+        self.assertEqual(downloader.tile(3, 1, 2), b'/3/1/2.png')
+
+    def test_retries_stalled_requests_then_fails(self):
+        server = self.server(delay=2)
+        downloader = TileDownloader(server.url, rate_limit=0, download_retries=1, request_timeout=0.2)
+        start = time.monotonic()
+        with self.assertRaises(DownloadError) as raised:
+            downloader.tile(3, 1, 2)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertIsNone(raised.exception.status_code)
+        self.assertEqual(server.requests, 2)
+
+
+@unittest.skipUnless(has_aiohttp, 'python aiohttp is not installed')
+class AsyncTileDownloaderTest(TileServerTestCase):
+    def downloader(self, server, **kwargs):
+        downloader = AsyncTileDownloader(server.url, rate_limit=0, **kwargs)
+        self.addCleanup(downloader.close)
+        return downloader
+
+    def wait_requests(self, server, count):
+        deadline = time.monotonic() + 10
+        while server.requests < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_downloads_tile(self):
+        server = self.server()
+        self.assertEqual(self.downloader(server).tile(3, 1, 2), b'/3/1/2.png')
+
+    def test_keeps_many_requests_in_flight(self):
+        server = self.server(delay=0.5)
+        downloader = self.downloader(server, max_concurrency=16, host_concurrency=16)
+        start = time.monotonic()
+        for y in range(16):
+            downloader.prefetch(5, 1, y)
+        self.assertEqual([downloader.tile(5, 1, y) for y in range(16)],
+                         [b'/5/1/%d.png' % y for y in range(16)])
+        self.assertLess(time.monotonic() - start, 4)
+        self.assertEqual(server.requests, 16)
+
+    def test_uses_prefetched_tile(self):
+        server = self.server()
+        downloader = self.downloader(server)
+        downloader.prefetch(3, 1, 2)
+        downloader.prefetch(3, 1, 2)
+        self.wait_requests(server, 1)
+        self.assertEqual(downloader.tile(3, 1, 2), b'/3/1/2.png')
+        self.assertEqual(server.requests, 1)
+
+    def test_discards_prefetched_tiles(self):
+        server = self.server(delay=0.5)
+        downloader = self.downloader(server, download_retries=0)
+        downloader.prefetch(3, 1, 2)
+        downloader.prefetch(3, 1, 3)
+        downloader.discard_prefetch(3, 1, 2)
+        downloader.cancel_prefetch()
+        self.assertEqual(downloader._prefetched, {})
+        # a discarded tile is requested again when asked for
+        self.assertEqual(downloader.tile(3, 1, 2), b'/3/1/2.png')
+
+    def test_does_not_retry_permanent_errors(self):
+        server = self.server(status=404)
+        downloader = self.downloader(server, download_retries=3)
+        with self.assertRaises(DownloadError) as raised:
+            downloader.tile(3, 1, 2)
+        self.assertEqual(raised.exception.status_code, 404)
+        self.assertEqual(server.requests, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
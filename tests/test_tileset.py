@@ -0,0 +1,79 @@
+import random
+import unittest
+
+from mbtiles.tileset import TileSet, merge_intervals
+
+
+def tiles_of(ranges):
+    return {(z, x, y) for z, zoom_ranges in ranges.items()
+            for x0, x1, y0, y1 in zoom_ranges for x in range(x0, x1) for y in range(y0, y1)}
+
+
+class TileSetTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(0)
+
+    def random_ranges(self):
+        ranges = {}
+        for z in self.random.sample(range(3, 7), 2):
+            n = 2 ** z
+            for _ in range(self.random.randint(1, 4)):
+                x0, y0 = self.random.randrange(n), self.random.randrange(n)
+                ranges.setdefault(z, []).append(
+                    (x0, self.random.randint(x0, n), y0, self.random.randint(y0, n)))
+        return ranges
+
+    def test_merge_intervals(self):
+        self.assertEqual(merge_intervals([(5, 7), (0, 2), (1, 3), (3, 4), (6, 6)]), [(0, 4), (5, 7)])
+
+    def test_from_ranges_is_union_of_ranges(self):
+        for _ in range(50):
+            ranges = self.random_ranges()
+            tileset = TileSet.from_ranges(ranges)
+            tiles = tiles_of(ranges)
+            self.assertEqual(set(tileset), tiles)
+            self.assertEqual(len(tileset), len(tiles))
+            self.assertEqual(bool(tileset), bool(tiles))
+
+    def test_from_tiles_and_sorted_tiles(self):
+        for _ in range(20):
+            tiles = tiles_of(self.random_ranges())
+            self.assertEqual(set(TileSet.from_tiles(tiles)), tiles)
+            self.assertEqual(TileSet.from_sorted_tiles(sorted(tiles)), TileSet.from_tiles(tiles))
+
+    def test_algebra_matches_sets(self):
+        for _ in range(50):
+            a, b = self.random_ranges(), self.random_ranges()
+            set_a, set_b = TileSet.from_ranges(a), TileSet.from_ranges(b)
+            tiles_a, tiles_b = tiles_of(a), tiles_of(b)
+            self.assertEqual(set(set_a | set_b), tiles_a | tiles_b)
+            self.assertEqual(set(set_a & set_b), tiles_a & tiles_b)
+            self.assertEqual(set(set_a - set_b), tiles_a - tiles_b)
+            self.assertEqual(len(set_a - set_b), len(tiles_a - tiles_b))
+
+    def test_contains(self):
+        ranges = self.random_ranges()
+        tileset = TileSet.from_ranges(ranges)
+        tiles = tiles_of(ranges)
+        for z in tileset.zoomlevels():
+            for x in range(2 ** z):
+                for y in range(2 ** z):
+                    self.assertEqual((z, x, y) in tileset, (z, x, y) in tiles)
+
+    def test_count_extent_and_order(self):
+        tileset = TileSet.from_ranges({4: [(0, 2, 0, 2), (5, 6, 3, 9)], 2: [(1, 2, 1, 3)]})
+        self.assertEqual(tileset.zoomlevels(), [2, 4])
+        self.assertEqual(tileset.count(4), 10)
+        self.assertEqual(tileset.extent(4), (0, 6, 0, 9))
+        self.assertIsNone(tileset.extent(3))
+        self.assertEqual([z for z, x, y in tileset.iter('desc')], [4] * 10 + [2] * 2)
+        self.assertEqual(list(tileset.iter_zoom(2)), [(2, 1, 1), (2, 1, 2)])
+
+    def test_size_depends_on_shape(self):
+        tileset = TileSet.from_ranges({18: [(0, 2 ** 17, 0, 2 ** 17)]})
+        self.assertEqual(len(tileset), 4 ** 17)
+        self.assertEqual(tileset.ranges(18), [(0, 2 ** 17, 0, 2 ** 17)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from mbtiles.mbutil import disk_to_mbtiles
+from mbtiles.writer import MBTilesWriter
+
+
+class WriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder, True)
+        self.filepath = os.path.join(self.folder, 'out.mbtiles')
+
+    def write(self, tiles, metadata=None, **kwargs):
+        writer = MBTilesWriter(self.filepath, **kwargs).start()
+        for z, x, y, data in tiles:
+            writer.put((z, x, y), y, data)
+        writer.close(metadata)
+
+    def gathered(self, tiles, metadata):
+        directory = os.path.join(self.folder, 'tiles')
+        for z, x, y, data in tiles:
+            os.makedirs(os.path.join(directory, str(z), str(x)), exist_ok=True)
+            with open(os.path.join(directory, str(z), str(x), '%s.png' % y), 'wb') as f:
+                f.write(data)
+        with open(os.path.join(directory, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+        return directory
+
+    def rows(self, sql):
+        con = sqlite3.connect(self.filepath)
+        try:
+            return con.execute(sql).fetchall()
+        finally:
+            con.close()
+
+
+class StreamingWriterTest(WriterTestCase):
+    def test_commits_batches(self):
+        batches = []
+        tiles = [(3, x, y, ('%s/%s' % (x, y)).encode()) for x in range(4) for y in range(5)]
+        self.write(tiles, {'name': 'test', 'format': 'png'}, batch_size=8, on_commit=batches.append)
+        self.assertEqual(sorted(tile for batch in batches for tile in batch), [t[:3] for t in tiles])
+        self.assertTrue(all(len(batch) <= 8 for batch in batches))
+        self.assertEqual(sorted(self.rows("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles")),
+                         [(z, x, y, data) for z, x, y, data in tiles])
+        self.assertEqual(dict(self.rows("SELECT name, value FROM metadata")), {'name': 'test', 'format': 'png'})
+
+    def test_appends_to_existing_file(self):
+        self.write([(1, 0, 0, b'a'), (1, 0, 1, b'b')], {'name': 'test'})
+        self.write([(1, 0, 1, b'c'), (1, 1, 1, b'd')])
+        self.assertEqual(sorted(self.rows("SELECT tile_column, tile_row, tile_data FROM tiles")),
+                         [(0, 0, b'a'), (0, 1, b'c'), (1, 1, b'd')])
+        self.assertEqual(self.rows("SELECT name, value FROM metadata"), [('name', 'test')])
+
+    def test_raises_write_errors_in_producer(self):
+        writer = MBTilesWriter(os.path.join(self.folder, 'missing', 'out.mbtiles'), queue_size=1).start()
+        with self.assertRaises(sqlite3.Error):
+            for y in range(10):
+                writer.put((1, 0, y), y, b'a')
+            writer.close()
+
+
+class SafeWriterTest(WriterTestCase):
+    def test_lets_readers_in_between_commits(self):
+        self.write([(1, 0, 0, b'a')], {'name': 'test'})
+        committed = threading.Event()
+        writer = MBTilesWriter(self.filepath, safe=True, on_commit=lambda tiles: committed.set()).start()
+        try:
+            writer.put((1, 0, 1), 1, b'b')
+            self.assertTrue(committed.wait(10))
+            con = sqlite3.connect(self.filepath, timeout=0)
+            try:
+                self.assertEqual(len(con.execute("SELECT * FROM tiles").fetchall()), 2)
+                self.assertEqual(con.execute("PRAGMA journal_mode").fetchone()[0], 'delete')
+            finally:
+                con.close()
+        finally:
+            writer.close()
+
+
+class DiskToMBTilesTest(WriterTestCase):
+    def test_inserts_in_batches(self):
+        tiles = [(4, x, y, ('%s/%s' % (x, y)).encode()) for x in range(5) for y in range(7)]
+        directory = self.gathered(tiles, {'name': 'test'})
+        disk_to_mbtiles(directory, self.filepath, format='png', batch_size=4, workers=2, silent=True)
+        self.assertEqual(sorted(self.rows("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles")),
+                         [(z, x, y, data) for z, x, y, data in tiles])
+        self.assertEqual(self.rows("SELECT name, value FROM metadata"), [('name', 'test')])
+        self.assertIn(('tile_index',), self.rows("SELECT name FROM sqlite_master WHERE type='index'"))
+
+    def test_keeps_tiles_found_twice_once(self):
+        directory = self.gathered([(2, 1, 0, b'a')], {})
+        with open(os.path.join(directory, '2', '1', '00.png'), 'wb') as f:
+            f.write(b'b')
+        disk_to_mbtiles(directory, self.filepath, format='png', silent=True)
+        self.assertEqual(len(self.rows("SELECT tile_data FROM tiles")), 1)
+
+    def test_stops_workers_on_error(self):
+        directory = self.gathered([(2, 1, 0, b'a')], {})
+        os.mkdir(os.path.join(directory, '2', '1', '1.png'))
+        threads = threading.active_count()
+        with self.assertRaises(OSError):
+            disk_to_mbtiles(directory, self.filepath, format='png', silent=True)
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_flips_xyz_rows(self):
+        directory = self.gathered([(2, 1, 0, b'a')], {})
+        disk_to_mbtiles(directory, self.filepath, format='png', scheme='xyz', silent=True)
+        self.assertEqual(self.rows("SELECT zoom_level, tile_column, tile_row FROM tiles"), [(2, 1, 3)])
+
+
+class DedupTest(WriterTestCase):
+    tiles = [(3, x, y, b'sea' if x < 3 else ('%s/%s' % (x, y)).encode()) for x in range(5) for y in range(4)]
+
+    def test_writer_stores_identical_tiles_once(self):
+        self.write(self.tiles, {'name': 'test'})
+        self.assertEqual(self.rows("SELECT count(*) FROM map"), [(20,)])
+        self.assertEqual(self.rows("SELECT count(*) FROM images"), [(9,)])
+        self.assertEqual(sorted(self.rows("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles")),
+                         [(z, x, y, data) for z, x, y, data in self.tiles])
+
+    def test_writer_removes_replaced_images(self):
+        self.write([(1, 0, 0, b'a'), (1, 0, 1, b'b')], {'name': 'test'})
+        self.write([(1, 0, 1, b'a')], {'name': 'test'})
+        self.assertEqual(self.rows("SELECT tile_data FROM images"), [(b'a',)])
+
+    def test_writer_keeps_schema_of_existing_file(self):
+        self.write([(1, 0, 0, b'a')], dedup=False)
+        self.write([(1, 0, 1, b'a')], dedup=True)
+        self.assertEqual(self.rows("SELECT count(*) FROM sqlite_master WHERE name IN ('map', 'images')"), [(0,)])
+        self.assertEqual(self.rows("SELECT count(*) FROM tiles"), [(2,)])
+
+    def test_disk_to_mbtiles_stores_identical_tiles_once(self):
+        directory = self.gathered(self.tiles, {'name': 'test'})
+        disk_to_mbtiles(directory, self.filepath, format='png', dedup=True, batch_size=6, silent=True)
+        self.assertEqual(self.rows("SELECT count(*) FROM images"), [(9,)])
+        self.assertEqual(sorted(self.rows("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles")),
+                         [(z, x, y, data) for z, x, y, data in self.tiles])
+
+
+if __name__ == '__main__':
+    unittest.main()
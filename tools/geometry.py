@@ -28,3 +28,15 @@ def pointRadialDistanceRad(rlat1, rlon1, rbearing, distance):
                          cos(rdistance) - sin(rlat1) * sin(rlat))
     return (rlat, rlon)
 
+
+
+def initialBearing(lat1, lon1, lat2, lon2):
+    """
+    Return the initial bearing [in degrees, 0-360] of the great circle
+    from (lat1,lon1) to (lat2,lon2) [in degrees]
+    """
+    rlat1, rlon1, rlat2, rlon2 = map(radians, (lat1, lon1, lat2, lon2))
+    rdlon = rlon2 - rlon1
+    y = sin(rdlon) * cos(rlat2)
+    x = cos(rlat1) * sin(rlat2) - sin(rlat1) * cos(rlat2) * cos(rdlon)
+    return degrees(atan2(y, x)) % 360
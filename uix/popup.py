@@ -42,7 +42,7 @@ class InfoPopup(Popup):
 
 class FileExistsPopup(Popup):
     text = StringProperty('')
-    __events__ = ['on_cancel', 'on_overwrite', 'on_copy']
+    __events__ = ['on_cancel', 'on_overwrite', 'on_update', 'on_copy']
 
     def __init__(self, **kwargs):
         kwargs.setdefault('title', 'Make a choice')
@@ -63,17 +63,21 @@ class FileExistsPopup(Popup):
 
         control_buttons_layout = BoxLayout(size_hint=(1, 0.2), spacing=10)
 
-        cancel_button = Button(text="Cancel", size_hint_x=0.3)
+        cancel_button = Button(text="Cancel", size_hint_x=0.25)
         cancel_button.bind(on_release=self._make_cancel)
 
-        overwrite_button = Button(text="Overwrite", size_hint_x=0.3)
+        overwrite_button = Button(text="Overwrite", size_hint_x=0.25)
         overwrite_button.bind(on_release=self._make_overwrite)
 
-        ok_button = Button(text="Save copy", size_hint_x=0.3)
+        update_button = Button(text="Update", size_hint_x=0.25)
+        update_button.bind(on_release=self._make_update)
+
+        ok_button = Button(text="Save copy", size_hint_x=0.25)
         ok_button.bind(on_release=self._make_copy)
 
         control_buttons_layout.add_widget(cancel_button)
         control_buttons_layout.add_widget(overwrite_button)
+        control_buttons_layout.add_widget(update_button)
         control_buttons_layout.add_widget(ok_button)
 
         container.add_widget(label)
@@ -94,6 +98,13 @@ class FileExistsPopup(Popup):
     def on_overwrite(self, *_):
         pass
 
+    def _make_update(self, *_):
+        self.dispatch('on_update')
+        self.dismiss()
+
+    def on_update(self, *_):
+        pass
+
     def _make_copy(self, *_):
         self.dispatch('on_copy')
         self.dismiss()